@@ -0,0 +1,41 @@
+'''Compare the latency of Witty Pi 4 commands in the shared utilities session with spawning bash for each command'''
+from time import perf_counter
+import logging
+import sys
+from witty_pi_4 import WittyPi4
+
+COMMANDS = ["get_temperature", "get_input_voltage", "get_output_voltage", "get_low_voltage_threshold", "get_recovery_voltage_threshold"]
+
+def measure(run_command, repetitions: int) -> list:
+    '''Run all commands repetitions times and return the latencies in ms'''
+    latencies = []
+    for _ in range(repetitions):
+        for command in COMMANDS:
+            start = perf_counter()
+            run_command(command)
+            latencies.append((perf_counter() - start) * 1000)
+    return latencies
+
+def summarize(name: str, latencies: list) -> None:
+    '''Print mean, median and maximum latency'''
+    latencies = sorted(latencies)
+    print(f"{name}: mean {sum(latencies)/len(latencies):.1f} ms, median {latencies[len(latencies)//2]:.1f} ms, max {latencies[-1]:.1f} ms")
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.WARNING)
+
+    # Usage: python3 benchmark_witty_pi.py [repetitions] [wittypi directory]
+    REPETITIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    witty_pi = WittyPi4()
+    if len(sys.argv) > 2:
+        witty_pi.WITTYPI_DIRECTORY = sys.argv[2]
+
+    # First command of the session includes starting bash and sourcing utilities.sh
+    start_time = perf_counter()
+    witty_pi.run_command("true")
+    print(f"Session start: {(perf_counter() - start_time) * 1000:.1f} ms")
+
+    summarize("Session", measure(witty_pi.run_command, REPETITIONS))
+    summarize("Spawn per command", measure(witty_pi.run_command_once, REPETITIONS))
+    witty_pi.close()
@@ -0,0 +1,153 @@
+'''Pack the text artifacts of a wake cycle into one compressed archive and merge the archives on the server side'''
+from io import BytesIO
+from os import path, listdir, remove, replace
+import tarfile
+import logging
+
+BUNDLE_PREFIX = "diagnostics_"
+BUNDLE_SUFFIX = ".tar.gz"
+
+class DiagnosticsBundle:
+    '''Collects data which should be appended to files on the file server into a tar.gz archive.
+    It can be passed to LogShipper instead of a FileServer.'''
+
+    def __init__(self) -> None:
+        self.members = {} # Remote filename -> data to append
+
+    def append_file_from_bytes(self, filename: str, file_data) -> bool:
+        '''Add data which should be appended to a file on the file server'''
+        data = b''
+        while True:
+            chunk = file_data.read(8192)
+            if not chunk:
+                break
+            data += chunk
+
+        self.members[filename] = self.members.get(filename, b'') + data
+        return True
+
+    def is_empty(self) -> bool:
+        '''Check if there is any data in the bundle'''
+        return not any(self.members.values())
+
+    def to_bytes(self) -> BytesIO:
+        '''Create the compressed archive'''
+        archive = BytesIO()
+
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            for filename, data in self.members.items():
+                if not data:
+                    continue
+
+                info = tarfile.TarInfo(filename)
+                info.size = len(data)
+                tar.addfile(info, BytesIO(data))
+
+        archive.seek(0)
+        return archive
+
+MERGING_SUFFIX = ".merging" # Bundle which is being merged, only contains the members which were not appended yet
+
+def is_valid_member_name(name: str) -> bool:
+    '''Only plain filenames in the camera directory are allowed as bundle members'''
+    return name not in ("", ".", "..") and "/" not in name and "\\" not in name and ".." not in name
+
+def unpack_bundle(file_data) -> dict:
+    '''Get the data to append for every file in a bundle'''
+    members = {}
+
+    with tarfile.open(fileobj=file_data, mode="r:gz") as tar:
+        for member in tar.getmembers():
+            if not member.isfile() or not is_valid_member_name(member.name):
+                logging.warning("Skipping invalid bundle member %s", member.name)
+                continue
+
+            members[member.name] = tar.extractfile(member).read()
+
+    return members
+
+def pack_members(members: dict) -> BytesIO:
+    '''Create a bundle from the data to append for every file'''
+    bundle = DiagnosticsBundle()
+    bundle.members = dict(members)
+    return bundle.to_bytes()
+
+def list_bundles(filenames: list) -> list:
+    '''Get the bundles (including ones whose merge was interrupted) in the order they were created'''
+    return sorted(filename for filename in filenames if filename.startswith(BUNDLE_PREFIX)
+                  and (filename.endswith(BUNDLE_SUFFIX) or filename.endswith(BUNDLE_SUFFIX + MERGING_SUFFIX)))
+
+def merge_bundles_in_directory(directory: str) -> int:
+    '''Append the content of all bundles in a local directory (e.g. on the FTP server host) to the per-camera files
+    and delete the bundles. A bundle is renamed to .merging first and rewritten with the remaining members after
+    every appended member, so an interrupted merge is continued without appending anything twice.
+    Returns the number of merged bundles.'''
+    merged = 0
+
+    for bundle in list_bundles(listdir(directory)):
+        merging_path = path.join(directory, bundle if bundle.endswith(MERGING_SUFFIX) else bundle + MERGING_SUFFIX)
+
+        try:
+            if not bundle.endswith(MERGING_SUFFIX):
+                replace(path.join(directory, bundle), merging_path)
+
+            with open(merging_path, 'rb') as bundle_file:
+                members = unpack_bundle(bundle_file)
+        except Exception as e:
+            logging.error("Could not unpack bundle %s: %s", bundle, str(e))
+            continue
+
+        for filename in list(members):
+            with open(path.join(directory, filename), 'ab') as target_file:
+                target_file.write(members.pop(filename))
+
+            temporary_path = merging_path + ".tmp"
+            with open(temporary_path, 'wb') as bundle_file:
+                bundle_file.write(pack_members(members).read())
+            replace(temporary_path, merging_path)
+
+        remove(merging_path)
+        merged += 1
+        logging.info("Merged bundle %s", bundle)
+
+    return merged
+
+def merge_bundles_on_server(fileserver) -> int:
+    '''Append the content of all bundles in the current directory of a FileServer to the per-camera files
+    and delete the bundles (e.g. from the dashboard). Interrupted merges are continued as in
+    merge_bundles_in_directory. Returns the number of merged bundles.'''
+    merged = 0
+
+    for bundle in list_bundles(fileserver.list_files(refresh=True)):
+        merging_bundle = bundle if bundle.endswith(MERGING_SUFFIX) else bundle + MERGING_SUFFIX
+
+        try:
+            if not bundle.endswith(MERGING_SUFFIX) and not fileserver.rename_file(bundle, merging_bundle):
+                continue
+            members = unpack_bundle(fileserver.get_file_as_bytes(merging_bundle))
+        except Exception as e:
+            logging.error("Could not unpack bundle %s: %s", bundle, str(e))
+            continue
+
+        for filename in list(members):
+            if not fileserver.append_file_from_bytes(filename, BytesIO(members[filename])):
+                break
+
+            members.pop(filename)
+            if members and not fileserver.upload_file_from_bytes(merging_bundle, pack_members(members)):
+                break
+
+        if not members:
+            fileserver.delete_file(merging_bundle)
+            merged += 1
+
+    return merged
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Merge the bundles in the given camera directories, e.g. from a cron job on the FTP server
+    for camera_directory in sys.argv[1:]:
+        merge_bundles_in_directory(camera_directory)
@@ -1,26 +1,64 @@
 """ The fileserver module is used to connect to a file server and perform operations such as downloading and uploading files. """
-from ftplib import FTP
+from ftplib import FTP, error_perm
 from io import BytesIO
 from datetime import datetime
-from time import sleep
+from os import path, replace
+from time import sleep, monotonic
+from random import uniform
+import posixpath
 import logging
 
 class FileServer:
     """A class to connect to a file server and perform operations such as downloading and uploading files."""
     MAX_RETRIES = 5
-    RETRY_INTERVAL = 5  # Seconds
+    RETRY_INTERVAL = 5  # Seconds, maximum wait between attempts
+    BACKOFF_BASE = 0.5 # Seconds, wait after the first failed attempt (doubled after each attempt)
+    TIMEOUT = 5 # Seconds, applies to every blocking socket operation
+    LISTING_CACHE_TTL = 60 # Seconds
+    IDLE_ATTEMPTS = 2 # Attempts a modem which does not search the network yet is waited for
 
-    def __init__(self, host: str, username: str, password: str) -> None:
-        """Initialize and connect to the file server."""
+    def __init__(self, host: str, username: str, password: str, block_size: int = 8192, modem = None) -> None:
+        """Initialize and connect to the file server. If a modem (SIM7600X) is given, its network state is checked before connecting."""
         self.ftp = None
-        self.connected_to_server = self.connect_to_server(host, username, password)
+        self.block_size = block_size # Bytes per block of uploaded files
+        self.uploaded_bytes = 0 # Progress of the last resumable upload
+        self.connect_attempts = 0
+        self.network_state = "unknown"
+        self.current_directory = "." # Relative to the login directory
+        self.known_directories = set() # Directories which exist on the server, can be saved between sessions
+        self.listing_cache = {} # Directory -> (time, entries)
+        self.mlsd_supported = True
+        self.connected_to_server = self.connect_to_server(host, username, password, modem)
 
-    def connect_to_server(self, host: str, username: str, password: str) -> bool:
-        """Connect to the file server with retries."""
+    def backoff(self, attempt: int) -> float:
+        """Get the exponential backoff with jitter after a failed attempt"""
+        return min(self.RETRY_INTERVAL, self.BACKOFF_BASE * 2**attempt) * uniform(0.5, 1.0)
+
+    def connect_to_server(self, host: str, username: str, password: str, modem = None) -> bool:
+        """Connect to the file server with retries. Fails fast if the modem has no network at all or still does not
+        search the network after IDLE_ATTEMPTS attempts."""
 
         for attempt in range(self.MAX_RETRIES):
+            self.connect_attempts = attempt + 1
+
+            if modem is not None:
+                self.network_state = modem.get_network_state()
+
+                if self.network_state == modem.NETWORK_NONE or (self.network_state == modem.NETWORK_IDLE and attempt >= self.IDLE_ATTEMPTS):
+                    logging.error("No mobile network available, not connecting to the file server.")
+                    return False
+
+                if self.network_state in (modem.NETWORK_SEARCHING, modem.NETWORK_IDLE):
+                    logging.info("Searching mobile network, attempt %s/%s.", attempt+1, self.MAX_RETRIES)
+                    sleep(self.backoff(attempt))
+                    continue
+
+                if self.network_state == modem.NETWORK_MARGINAL:
+                    logging.info("Weak signal or no data connection yet, waiting before connecting.")
+                    sleep(self.backoff(attempt))
+
             try:
-                self.ftp = FTP(host, username, password, timeout=5)
+                self.ftp = FTP(host, username, password, timeout=self.TIMEOUT)
                 logging.info("Connected to file server.")
                 return True
             except Exception as e:
@@ -28,7 +66,9 @@ class FileServer:
                     logging.warning("Could not connect to fileserver: %s, attempt %s/%s failed.", str(e), attempt+1, self.MAX_RETRIES)
                 else:
                     logging.info("Could not connect to fileserver: %s, attempt %s/%s failed.", str(e), attempt+1, self.MAX_RETRIES)
-                sleep(self.RETRY_INTERVAL) # Wait and try again
+
+                if attempt < self.MAX_RETRIES - 1:
+                    sleep(self.backoff(attempt)) # Wait and try again
 
         logging.error("Failed to connect to the file server after maximum retries.")
         return False
@@ -37,15 +77,45 @@ class FileServer:
         """Check if the file server is connected"""
         return self.connected_to_server
 
+    def _resolve_directory(self, directory: str) -> str:
+        """Get the path of a directory relative to the login directory"""
+        return posixpath.normpath(posixpath.join(self.current_directory, directory))
+
     def change_directory(self, directory: str, create: bool = False) -> None:
-        """Change the current directory on the file server"""
+        """Change the current directory on the file server. Known directories are changed to in a single round trip,
+        new directories are created if necessary (without listing the current directory)."""
+        target_directory = self._resolve_directory(directory)
+
         try:
-            directory_list = self.list_files()
+            if not create or target_directory in self.known_directories:
+                try:
+                    self.ftp.cwd(directory)
+                    self.current_directory = target_directory
+                    return
+                except error_perm:
+                    if not create:
+                        raise
+                    self.known_directories.discard(target_directory)
+                    logging.warning("Directory %s does not exist anymore.", target_directory)
+
+            if directory.startswith("/"):
+                self.ftp.cwd("/")
+                self.current_directory = "/"
 
-            if create and directory not in directory_list:
-                self.ftp.mkd(directory)
+            # Change to one directory after the other and create missing ones
+            for part in directory.split("/"):
+                if part == "":
+                    continue
 
-            self.ftp.cwd(directory)
+                try:
+                    self.ftp.cwd(part)
+                except error_perm:
+                    self.ftp.mkd(part)
+                    self.invalidate_cache(self.current_directory)
+                    self.ftp.cwd(part)
+
+                self.current_directory = self._resolve_directory(part)
+                self.known_directories.add(self.current_directory)
 
         except Exception as e:
             logging.warning("Could not change directory on file server: %s", str(e))
@@ -60,15 +130,146 @@ class FileServer:
         except Exception as e:
             logging.error("Failed to download file: %s", str(e))
 
-    def upload_file(self, filename: str, local_file_path: str = "") -> None:
-        """Upload a file to the file server."""
+    def upload_file(self, filename: str, local_file_path: str = "") -> bool:
+        """Upload a file to the file server. Returns True if the server confirmed the size of the uploaded file."""
         local_path = f"{local_file_path}{filename}"
         try:
             with open(local_path, 'rb') as local_file:
                 self.ftp.storbinary(f"STOR {filename}", local_file)
-            logging.info("Successfully uploaded %s", local_file)
+                local_size = local_file.tell()
+            self.invalidate_cache(self.current_directory)
+
+            remote_size = self.get_file_size(filename)
+            if remote_size != local_size:
+                logging.error("Failed to upload file: %s has %s bytes on server instead of %s", filename, remote_size, local_size)
+                return False
+
+            logging.info("Successfully uploaded %s", filename)
+            return True
+        except Exception as e:
+            logging.error("Failed to upload file: %s", str(e))
+            return False
+
+    def upload_file_resumable(self, filename: str, local_file_path: str = "", offset_hint: int = None) -> bool:
+        """Upload a file to a temporary file on the file server and continue where a previous upload was interrupted.
+        The file is renamed once it is complete, so only complete files appear under their name on the server.
+        If offset_hint is 0 there is no partial upload on the server and it is not queried."""
+        self.uploaded_bytes = 0
+
+        try:
+            with open(f"{local_file_path}{filename}", 'rb') as local_file:
+                return self._upload_resumable(filename, local_file, offset_hint)
+        except Exception as e:
+            logging.error("Failed to upload file %s: %s (%s bytes uploaded)", filename, str(e), self.uploaded_bytes)
+            return False
+
+    def upload_bytes_resumable(self, filename: str, file_data: BytesIO, offset_hint: int = 0) -> bool:
+        """Upload data from a BytesIO object like upload_file_resumable, e.g. an image which was never saved locally.
+        After a failed upload, uploaded_bytes can be used to resume it from a file with the same content."""
+        self.uploaded_bytes = 0
+
+        try:
+            return self._upload_resumable(filename, file_data, offset_hint)
+        except Exception as e:
+            logging.error("Failed to upload file %s: %s (%s bytes uploaded)", filename, str(e), self.uploaded_bytes)
+            return False
+
+    def _upload_resumable(self, filename: str, local_file, offset_hint: int = None) -> bool:
+        """Upload an open file to filename.part from the offset of a previous upload and rename it once the size matches"""
+        temporary_filename = f"{filename}.part"
+        local_size = local_file.seek(0, 2)
+        offset = 0
+
+        if offset_hint != 0:
+            try:
+                self.ftp.voidcmd("TYPE I") # SIZE is not allowed in ASCII mode by some servers
+                offset = self.ftp.size(temporary_filename)
+            except error_perm:
+                offset = 0 # No partial upload on the server
+
+        if offset > local_size:
+            logging.warning("Partial upload of %s is larger than the local file, starting over.", filename)
+            self.ftp.delete(temporary_filename)
+            offset = 0
+
+        self.uploaded_bytes = offset
+
+        if offset < local_size:
+            if offset > 0:
+                logging.info("Resuming upload of %s at %s/%s bytes.", filename, offset, local_size)
+
+            local_file.seek(offset)
+            self._store_from_offset(temporary_filename, local_file, offset)
+
+        remote_size = self.get_file_size(temporary_filename)
+        if remote_size != local_size:
+            logging.error("Failed to upload file: %s has %s bytes on server instead of %s", filename, remote_size, local_size)
+            return False
+
+        self.invalidate_cache(self.current_directory)
+        try:
+            self.ftp.rename(temporary_filename, filename)
+        except error_perm:
+            # Some servers do not overwrite existing files when renaming
+            self.ftp.delete(filename)
+            self.ftp.rename(temporary_filename, filename)
+
+        logging.info("Successfully uploaded %s", filename)
+        return True
+
+    def _store_from_offset(self, filename: str, local_file, offset: int) -> None:
+        """Store a file on the file server starting at offset, with REST or APPE if the server does not support REST."""
+        def count_block(block: bytes) -> None:
+            self.uploaded_bytes += len(block)
+
+        if offset == 0:
+            self.ftp.storbinary(f"STOR {filename}", local_file, self.block_size, count_block)
+            return
+
+        try:
+            self.ftp.storbinary(f"STOR {filename}", local_file, self.block_size, count_block, rest=offset)
+        except error_perm as e:
+            logging.info("REST not supported (%s), appending instead.", str(e))
+            local_file.seek(offset)
+            self.ftp.storbinary(f"APPE {filename}", local_file, self.block_size, count_block)
+
+    def upload_file_from_bytes(self, filename: str, file_data: BytesIO) -> bool:
+        """Upload data from a BytesIO object to the file server. Returns True if the server confirmed the size."""
+        try:
+            file_data.seek(0)
+            self.ftp.storbinary(f"STOR {filename}", file_data, self.block_size)
+            self.invalidate_cache(self.current_directory)
+
+            remote_size = self.get_file_size(filename)
+            if remote_size != file_data.tell():
+                logging.error("Failed to upload file: %s has %s bytes on server instead of %s", filename, remote_size, file_data.tell())
+                return False
+
+            logging.info("Successfully uploaded %s", filename)
+            return True
         except Exception as e:
             logging.error("Failed to upload file: %s", str(e))
+            return False
+
+    def delete_file(self, filename: str) -> bool:
+        """Delete a file on the file server."""
+        try:
+            self.ftp.delete(filename)
+            self.invalidate_cache(self.current_directory)
+            return True
+        except Exception as e:
+            logging.error("Failed to delete file: %s", str(e))
+            return False
+
+    def rename_file(self, source: str, destination: str) -> bool:
+        """Rename a file on the file server."""
+        try:
+            self.ftp.rename(source, destination)
+            self.invalidate_cache(self.current_directory)
+            return True
+        except Exception as e:
+            logging.error("Failed to rename file: %s", str(e))
+            return False
 
     def append_file(self, filename: str, local_file_path: str = "") -> None:
         """Append a file to the file server."""
@@ -79,31 +280,129 @@ class FileServer:
         except Exception as e:
             logging.error("Failed to append file: %s", str(e))
 
-    def append_file_from_bytes(self, filename: str, file_data: BytesIO) -> None:
-        """Append a file to the file server."""
+    def append_file_from_bytes(self, filename: str, file_data: BytesIO) -> bool:
+        """Append data from a file-like object to a file on the file server."""
         try:
             self.ftp.storbinary(f"APPE {filename}", file_data)
+            self.invalidate_cache(self.current_directory)
             logging.info("Successfully appended data to %s", filename)
+            return True
         except Exception as e:
             logging.error("Failed to append data: %s", str(e))
+            return False
 
     def get_file_as_bytes(self, filename: str) -> BytesIO:
         """Retrieve a file from the file server as a BytesIO object."""
         file_data = BytesIO()
         try:
             self.ftp.retrbinary(f"RETR {filename}", file_data.write)
+            file_data.seek(0)
             return file_data
         except Exception as e:
             logging.error("Failed to retrieve file: %s", str(e))
             return BytesIO()
 
-    def list_files(self) -> list:
-        """List files in the current or specified directory"""
+    def invalidate_cache(self, directory: str = None) -> None:
+        """Remove a directory (or all directories) from the listing cache"""
+        if directory is None:
+            self.listing_cache.clear()
+        else:
+            self.listing_cache.pop(directory, None)
+
+    def list_entries(self, refresh: bool = False) -> dict:
+        """List the files in the current directory with their facts (type, size, modify) if the server supports MLSD.
+        The listing is cached for LISTING_CACHE_TTL seconds."""
+        cached = self.listing_cache.get(self.current_directory)
+        if cached is not None and not refresh and monotonic() - cached[0] < self.LISTING_CACHE_TTL:
+            return cached[1]
+
         try:
-            return self.ftp.nlst()
+            entries = None
+
+            if self.mlsd_supported:
+                try:
+                    entries = {name: facts for name, facts in self.ftp.mlsd(facts=["type", "size", "modify"])
+                               if facts.get("type") not in ("cdir", "pdir")}
+                except error_perm as e:
+                    logging.info("MLSD not supported (%s), using NLST.", str(e))
+                    self.mlsd_supported = False
+
+            if entries is None:
+                entries = {name: {} for name in self.ftp.nlst()}
+
+            self.listing_cache[self.current_directory] = (monotonic(), entries)
+            return entries
         except Exception as e:
             logging.error("Failed to list files: %s", str(e))
-            return []
+            return {}
+
+    def list_files(self, refresh: bool = False) -> list:
+        """List files in the current directory"""
+        return list(self.list_entries(refresh))
+
+    def get_file_size(self, filename: str) -> int:
+        """Get the size of a file on the file server in bytes (-1 if unknown)."""
+        try:
+            self.ftp.voidcmd("TYPE I") # SIZE is not allowed in ASCII mode by some servers
+            return self.ftp.size(filename)
+        except Exception as e:
+            logging.error("Failed to get file size: %s", str(e))
+            return -1
+
+    def get_file_signature(self, filename: str) -> str:
+        """Get a signature (size and modification time) of a file on the file server in one round trip if the server
+        supports MLST. Returns None if the file does not exist."""
+        try:
+            if self.mlsd_supported:
+                try:
+                    response = self.ftp.sendcmd(f"MLST {filename}")
+                    for line in response.splitlines():
+                        if line.startswith(" "): # Facts line, e.g. " type=file;size=123;modify=20240101120000; settings.yaml"
+                            facts = dict(fact.split("=", 1) for fact in line.strip().split(";") if "=" in fact)
+                            return f"{facts.get('size', '')}:{facts.get('modify', '')}"
+                except error_perm as e:
+                    if str(e).startswith("550"):
+                        return None
+                    self.mlsd_supported = False
+
+            self.ftp.voidcmd("TYPE I") # SIZE is not allowed in ASCII mode by some servers
+            size = self.ftp.size(filename)
+            modified = self.ftp.sendcmd(f"MDTM {filename}")[4:]
+            return f"{size}:{modified}"
+        except error_perm as e:
+            if str(e).startswith("550"):
+                return None
+            raise
+
+    def download_file_if_changed(self, filename: str, local_file_path: str, state) -> str:
+        """Download a small control file only if its size or modification time changed since the last download.
+        The signatures are kept in state (a PersistentState). Returns "changed", "unchanged", "missing" or "error"."""
+        local_path = f"{local_file_path}{filename}"
+        state_key = f"signature_{self._resolve_directory(filename)}"
+
+        try:
+            signature = self.get_file_signature(filename)
+
+            if signature is None:
+                logging.info("%s does not exist on the file server.", filename)
+                return "missing"
+
+            if signature == state.get(state_key) and path.exists(local_path):
+                logging.info("%s did not change on the file server.", filename)
+                return "unchanged"
+
+            # Replace the local file only once the download is complete
+            temporary_path = f"{local_path}.download"
+            with open(temporary_path, 'wb') as local_file:
+                self.ftp.retrbinary(f"RETR {filename}", local_file.write)
+            replace(temporary_path, local_path)
+
+            state.set(state_key, signature)
+            logging.info("Successfully downloaded changed %s to %s", filename, local_path)
+            return "changed"
+        except Exception as e:
+            logging.error("Failed to download file: %s", str(e))
+            return "error"
 
     def get_file_last_modified_date(self, filename: str) -> datetime:
         """Get the last modification date of a file on the file server."""
@@ -114,6 +413,15 @@ class FileServer:
             logging.error("Failed to get file last modified date: %s", str(e))
             return datetime.now()
 
+    def close(self) -> None:
+        """Close the file server connection without waiting for the server (e.g. if a transfer hangs)."""
+        self.connected_to_server = False
+        try:
+            self.ftp.close()
+            logging.warning("File server connection closed forcefully.")
+        except Exception as e:
+            logging.error("Failed to close file server connection: %s", str(e))
+
     def quit(self) -> None:
         """Close the file server connection."""
         try:
@@ -0,0 +1,114 @@
+'''Last known GPS fix, kept between wake cycles so the GNSS receiver is only powered when needed'''
+from time import time
+import logging
+from persistent_state import PersistentState
+
+class GpsFixCache:
+    '''The cameras are fixed to rock, so the last good fix is reused until it is too old, too many wake cycles passed,
+    it was too imprecise or the serving cell changed (a hint that the camera was moved). A stationary camera
+    reselects between neighbouring cells, so all cells seen at the position are kept and an unknown cell only counts
+    as a change once it was seen on cell_change_wakes consecutive wake cycles.'''
+
+    REASON_NO_FIX = "no_fix"
+    REASON_WAKES = "wakes"
+    REASON_AGE = "age"
+    REASON_HDOP = "hdop"
+    REASON_CELL_CHANGED = "cell_changed"
+    MAX_KNOWN_CELLS = 4
+    SAME_POSITION_DEGREES = 0.001 # About 100 m, fixes closer than this keep the known cells
+
+    def __init__(self, state: PersistentState, reacquire_wakes: int = 48, reacquire_hours: float = 168, max_hdop: float = 5.0,
+                 cell_change_wakes: int = 3) -> None:
+        self.state = state
+        self.reacquire_wakes = reacquire_wakes
+        self.reacquire_hours = reacquire_hours
+        self.max_hdop = max_hdop
+        self.cell_change_wakes = cell_change_wakes
+
+    def position(self) -> tuple:
+        '''Get the cached position as (latitude, longitude, height) or None'''
+        position = self.state.get("gps_position")
+        return tuple(position) if position else None
+
+    def known_cells(self) -> list:
+        '''Get the cells which were seen at the cached position'''
+        cells = self.state.get("gps_cells")
+        if cells is None:
+            cell_id = self.state.get("gps_cell_id") # Saved by older firmware
+            cells = [cell_id] if cell_id is not None else []
+        return cells
+
+    def is_same_position(self, position: tuple) -> bool:
+        '''Check if a fix is at the cached position'''
+        try:
+            cached_position = self.position()
+            return (abs(float(position[0]) - float(cached_position[0])) < self.SAME_POSITION_DEGREES and
+                    abs(float(position[1]) - float(cached_position[1])) < self.SAME_POSITION_DEGREES)
+        except (TypeError, ValueError):
+            return False
+
+    def age_hours(self, now: float = None) -> float:
+        '''Get the age of the cached fix in hours (None if there is none)'''
+        timestamp = self.state.get("gps_timestamp")
+        if timestamp is None:
+            return None
+
+        return round(((now or time()) - timestamp) / 3600, 2)
+
+    def reacquire_reason(self, cell_id: str = None, now: float = None) -> str:
+        '''Check if a new fix is needed, returns the reason or None if the cached fix can be used'''
+        if self.position() is None:
+            return self.REASON_NO_FIX
+
+        if self.state.get("gps_wakes_since_fix", 0) + 1 >= self.reacquire_wakes:
+            return self.REASON_WAKES
+
+        if self.age_hours(now) >= self.reacquire_hours:
+            return self.REASON_AGE
+
+        hdop = self.state.get("gps_hdop")
+        if hdop is not None and hdop > self.max_hdop:
+            return self.REASON_HDOP
+
+        # Cells can only be compared if both are known
+        known_cells = self.known_cells()
+        if (cell_id is not None and known_cells and cell_id not in known_cells
+                and self.state.get("gps_unknown_cell_wakes", 0) + 1 >= self.cell_change_wakes):
+            return self.REASON_CELL_CHANGED
+
+        return None
+
+    def count_wake(self, cell_id: str = None) -> None:
+        '''Count a wake cycle which used the cached fix and the consecutive wake cycles in an unknown cell'''
+        if cell_id is not None:
+            unknown_cell_wakes = 0 if cell_id in self.known_cells() else self.state.get("gps_unknown_cell_wakes", 0) + 1
+            self.state.set("gps_unknown_cell_wakes", unknown_cell_wakes, save=False)
+
+        self.state.set("gps_wakes_since_fix", self.state.get("gps_wakes_since_fix", 0) + 1)
+
+    def update(self, position: tuple, hdop: float = None, cell_id: str = None, now: float = None) -> None:
+        '''Save a new fix. The cells seen at the previous fix are kept if the position did not change.'''
+        cells = self.known_cells() if self.is_same_position(position) else []
+        if cell_id is not None and cell_id not in cells:
+            cells = (cells + [cell_id])[-self.MAX_KNOWN_CELLS:]
+
+        self.state.set("gps_cells", cells, save=False)
+        self.state.set("gps_unknown_cell_wakes", 0, save=False)
+        self.state.set("gps_position", list(position), save=False)
+        self.state.set("gps_timestamp", now or time(), save=False)
+        self.state.set("gps_hdop", hdop, save=False)
+        self.state.set("gps_wakes_since_fix", 0, save=False)
+        self.state.save()
+        logging.info("Cached GPS fix %s (HDOP %s, cell %s).", position, hdop, cell_id)
+
+    def xtra_age_hours(self, now: float = None) -> float:
+        '''Get the age of the XTRA assistance data in hours (None if it was never downloaded)'''
+        timestamp = self.state.get("xtra_timestamp")
+        if timestamp is None:
+            return None
+
+        return round(((now or time()) - timestamp) / 3600, 2)
+
+    def set_xtra_updated(self, now: float = None) -> None:
+        '''Save the time of a successful XTRA download'''
+        self.state.set("xtra_timestamp", now or time())
@@ -0,0 +1,145 @@
+'''Ship only the new part of growing log files to the file server'''
+from os import stat, path
+import zlib
+import logging
+from fileserver import FileServer
+from persistent_state import PersistentState
+
+class LimitedReader:
+    '''File-like object which reads at most length bytes from a file'''
+
+    def __init__(self, file, length: int) -> None:
+        self.file = file
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        '''Read up to size bytes without passing the limit'''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        chunk = self.file.read(size)
+        self.remaining -= len(chunk)
+        return chunk
+
+class GzipReader:
+    '''File-like object which gzip compresses another file-like object while it is read.
+    Each shipped part is a complete gzip member, concatenated members are a valid gzip file.'''
+
+    def __init__(self, file) -> None:
+        self.file = file
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED, 31) # wbits 31 = gzip container
+        self.buffer = b''
+        self.finished = False
+
+    def read(self, size: int = -1) -> bytes:
+        '''Read up to size compressed bytes'''
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            chunk = self.file.read(8192)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.finished = True
+
+        if size < 0:
+            size = len(self.buffer)
+
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+class LogShipper:
+    '''Append only the new tail of log files to the file server, using byte offsets saved between wake cycles'''
+
+    def __init__(self, fileserver: FileServer, state: PersistentState, compress: bool = False, autocommit: bool = True) -> None:
+        '''Logs are shipped to fileserver, which can also be a DiagnosticsBundle. Without autocommit the offsets
+        are only saved once commit() is called (e.g. after the bundle was uploaded).'''
+        self.fileserver = fileserver
+        self.state = state
+        self.compress = compress
+        self.autocommit = autocommit
+        self.checkpoints = {}
+
+    def _checkpoint(self, local_path: str, inode: int, offset: int) -> None:
+        '''Remember how far a log file was shipped'''
+        self.checkpoints[local_path] = {"inode": inode, "offset": offset}
+
+        if self.autocommit:
+            self.commit()
+
+    def _get_checkpoint(self, local_path: str) -> dict:
+        '''Get the last checkpoint of a log file, including checkpoints which are not committed yet'''
+        if local_path in self.checkpoints:
+            return self.checkpoints[local_path]
+
+        return self.state.get(local_path, {})
+
+    def commit(self) -> None:
+        '''Save the offsets of the shipped log files'''
+        for local_path, checkpoint in self.checkpoints.items():
+            self.state.set(local_path, checkpoint, save=False)
+
+        self.state.save()
+        self.checkpoints = {}
+
+    def _ship_range(self, local_path: str, remote_filename: str, offset: int, length: int) -> bool:
+        '''Append length bytes starting at offset of a local file to a file on the server'''
+        if length <= 0:
+            return True
+
+        with open(local_path, 'rb') as local_file:
+            local_file.seek(offset)
+            stream = LimitedReader(local_file, length)
+
+            if self.compress:
+                stream = GzipReader(stream)
+
+            return self.fileserver.append_file_from_bytes(remote_filename, stream)
+
+    def ship(self, filename: str, local_file_path: str = "", remote_filename: str = None) -> int:
+        '''Ship the new part of a log file. Returns the number of shipped (uncompressed) bytes.'''
+        local_path = f"{local_file_path}{filename}"
+
+        if remote_filename is None:
+            remote_filename = filename
+
+        if self.compress:
+            remote_filename = f"{remote_filename}.gz"
+
+        try:
+            file_stat = stat(local_path)
+        except FileNotFoundError:
+            logging.info("Log file %s does not exist.", local_path)
+            return 0
+
+        checkpoint = self._get_checkpoint(local_path)
+        offset = checkpoint.get("offset", 0)
+        shipped = 0
+
+        if checkpoint and checkpoint.get("inode") != file_stat.st_ino:
+            # The file was rotated, ship the rest of the rotated file first (e.g. log.txt.1)
+            rotated_path = f"{local_path}.1"
+            if path.exists(rotated_path) and stat(rotated_path).st_ino == checkpoint.get("inode"):
+                rotated_size = stat(rotated_path).st_size
+                if self._ship_range(rotated_path, remote_filename, offset, rotated_size - offset):
+                    shipped += max(0, rotated_size - offset)
+                else:
+                    return shipped
+            else:
+                logging.warning("Rotated log file of %s not found, some log entries were not shipped.", local_path)
+
+            offset = 0
+        elif file_stat.st_size < offset:
+            logging.warning("Log file %s was truncated, shipping it from the beginning.", local_path)
+            offset = 0
+
+        # Ship up to the current size, anything written during the upload is shipped next time
+        size = file_stat.st_size
+        if self._ship_range(local_path, remote_filename, offset, size - offset):
+            shipped += size - offset
+            self._checkpoint(local_path, file_stat.st_ino, size)
+            logging.info("Shipped %s bytes of %s.", shipped, local_path)
+        else:
+            # Do not ship the rotated file again
+            self._checkpoint(local_path, file_stat.st_ino, offset)
+
+        return shipped
@@ -1,18 +1,29 @@
 '''GlacierCam firmware - see https://github.com/Eagleshot/GlacierCam for more information'''
 
 from io import BytesIO
-from os import system, remove, listdir, path
+from os import system, remove, path
 from datetime import datetime
+from dataclasses import asdict
+from time import monotonic, sleep
+from threading import Lock
 import logging
 from logging.handlers import RotatingFileHandler
 from picamera2 import Picamera2
 from libcamera import controls
 from yaml import safe_load, safe_dump
-import suntime
+from schedule_compiler import CaptureWindow, compile_schedule
 from sim7600x import SIM7600X
 from witty_pi_4 import WittyPi4
 from fileserver import FileServer
 from settings import Settings
+from spool import UploadSpool, write_file
+from log_shipper import LogShipper
+from persistent_state import PersistentState
+from gps_cache import GpsFixCache
+from parallel_uploader import ParallelUploader
+from resident_mode import ResidentMode
+from diagnostics_bundle import DiagnosticsBundle, BUNDLE_PREFIX, BUNDLE_SUFFIX
+from pipeline import Pipeline, PRIORITY_HIGH, PRIORITY_LOW
 
 ###########################
 # Configuration and filenames
@@ -52,317 +63,740 @@ try:
 except Exception as e:
     logging.critical("Could not open config.yaml: %s", str(e))
 
+START_TIME = monotonic() # Start of the wake cycle for the total duration
 CAMERA_NAME = get_cpu_serial() # Unique hardware serial number
 TIMESTAMP_CSV = datetime.today().strftime('%Y-%m-%d %H:%MZ') # UTC-Time
 TIMESTAMP_FILENAME = datetime.today().strftime('%Y%m%d_%H%MZ') # UTC-Time
 
 data = {'timestamp': TIMESTAMP_CSV}
 
-###########################
-# Connect to fileserver
-###########################
+# Shared state of the wake cycle, set by the stages below
+fileserver = None
+CONNECTED_TO_SERVER = False
+settings = None
+sim7600 = None
+camera = None
+cameraConfig = None
+image_filename = None
+image_buffer = None # JPEG of this wake cycle until it is uploaded or saved to the spool
+image_buffer_lock = Lock()
+wittyPi = None
+spool = UploadSpool.open(FILE_PATH) # None if the manifest can not be used, images are then only saved for scan()
+fileserver_state = PersistentState(f"{FILE_PATH}fileserver_state.yaml")
+gps_cache = None
+GPS_ACQUIRING = False # Set if the GPS session was started in this wake cycle
+SCHEDULE_CHANGED = True # Set by generate_schedule
+XTRA_REFRESH_HOURS = 72 # XTRA data is valid for up to 7 days
+SETTINGS_SNAPSHOT_PATH = f"{FILE_PATH}settings_validated.yaml" # Settings saved after validation
+DIAGNOSTICS_FILENAME = "diagnostics.yaml"
+DIAGNOSTICS_FILEPATH = f"{FILE_PATH}{DIAGNOSTICS_FILENAME}"
 
-fileserver = FileServer(config["ftpServerAddress"], config["username"], config["password"])
-CONNECTED_TO_SERVER = fileserver.connected()
-
-# Go to custom directory on fileserver if specified
 try:
-    # Custom directory
-    if config["ftpDirectory"] != "" and CONNECTED_TO_SERVER:
-        fileserver.change_directory(config["ftpDirectory"], True)
-
-    # Custom camera directory
-    if config["multipleCamerasOnServer"] and CONNECTED_TO_SERVER:
-        fileserver.change_directory(CAMERA_NAME, True)
+    wittyPi = WittyPi4(state=PersistentState(f"{FILE_PATH}wittypi_state.yaml")) # Thresholds and schedule are verified every 24 wake cycles
 except Exception as e:
-    logging.warning("Could not change directory on fileserver: %s", str(e))
+    logging.critical("Could not initialize Witty Pi 4: %s", str(e))
 
 ###########################
-# Settings
+# Load local settings
 ###########################
+def load_settings(timer):
+    '''Load the settings downloaded during the last wake cycle so capture and GPS do not have to wait for the file server'''
+    global settings
 
-# Try to download settings from server
-try:
+    try:
+        if path.exists(SETTINGS_SNAPSHOT_PATH):
+            settings = Settings(SETTINGS_SNAPSHOT_PATH, validate=False)
+        else:
+            settings = Settings(f"{FILE_PATH}settings.yaml")
+    except Exception as e:
+        logging.critical("Could not open settings.yaml: %s", str(e))
+
+###########################
+# Connect to fileserver
+###########################
+def connect_fileserver(timer):
+    '''Connect to the file server and change to the camera directory'''
+    global fileserver, CONNECTED_TO_SERVER
+
+    server = FileServer(config["ftpServerAddress"], config["username"], config["password"], modem=sim7600)
+    data["network_state"] = server.network_state
+
+    # The wake cycle already continued without the file server
+    if timer.cancelled:
+        server.close()
+        return
+
+    fileserver = server
+    CONNECTED_TO_SERVER = fileserver.connected()
+    timer.retries = fileserver.connect_attempts - 1
+    timer.succeeded = CONNECTED_TO_SERVER
+
+    # Go to custom directory on fileserver if specified
     if CONNECTED_TO_SERVER:
+        change_to_camera_directory(fileserver, save_known_directories=True)
 
-        file_list = fileserver.list_files()
+def change_to_camera_directory(server: FileServer, save_known_directories: bool = False) -> None:
+    '''Change to the custom and camera directory on the file server'''
+    try:
+        directories = []
 
-        # Check if settings file exists
-        if "settings.yaml" in file_list:
-            fileserver.download_file("settings.yaml", FILE_PATH)
-        else:
-            logging.warning("No settings file on server. Creating new file with default settings.")
-            fileserver.upload_file("settings.yaml", FILE_PATH)
-except Exception as e:
-    logging.critical("Could not download settings file from FTP server: %s", str(e))
+        # Custom directory
+        if config["ftpDirectory"] != "":
+            directories.append(config["ftpDirectory"])
 
-# Read settings file
-try:
-    settings = Settings(f"{FILE_PATH}settings.yaml")
-except Exception as e:
-    logging.critical("Could not open settings.yaml: %s", str(e))
+        # Custom camera directory
+        if config["multipleCamerasOnServer"]:
+            directories.append(CAMERA_NAME)
 
-###########################
-# Time synchronization
-###########################
+        if directories:
+            # Directories created during earlier wake cycles are changed to in a single round trip
+            server.known_directories = set(fileserver_state.get("known_directories", []))
+            server.change_directory("/".join(directories), True)
 
-try:
-    wittyPi = WittyPi4()
+            if save_known_directories and server.known_directories != set(fileserver_state.get("known_directories", [])):
+                fileserver_state.set("known_directories", sorted(server.known_directories))
+    except Exception as e:
+        logging.warning("Could not change directory on fileserver: %s", str(e))
 
-    if settings.get("timeSync") and CONNECTED_TO_SERVER:
-        wittyPi.sync_time_with_network()
-except Exception as e:
-    logging.warning("Could not synchronize time with network: %s", str(e))
+def connect_upload_session() -> FileServer:
+    '''Open an additional file server session for parallel uploads'''
+    server = FileServer(config["ftpServerAddress"], config["username"], config["password"], modem=sim7600)
+
+    if server.connected():
+        change_to_camera_directory(server)
+
+    return server
 
 ###########################
-# Schedule script
+# Settings
 ###########################
+def download_settings(timer):
+    '''Download the settings from the file server and reload them'''
+    global settings
 
-# Get sunrise and sunset times
-try:
-    if settings.get("enableSunriseSunset") and settings.get("latitude") != 0 and settings.get("longitude") != 0:
-        sun = suntime.Sun(settings.get("latitude"), settings.get("longitude"))
-
-        # Sunrise
-        sunrise = sun.get_sunrise_time()
-        logging.info("Next sunrise: %s:%s", sunrise.hour, sunrise.minute)
-        sunrise = WittyPi4.round_time_to_nearest_interval(sunrise, settings.get("intervalMinutes"))
-        settings.set("startTimeHour", sunrise.hour)
-        settings.set("startTimeMinute", sunrise.minute)
-
-        # Sunset
-        sunset = sun.get_sunset_time()
-        logging.info("Next sunset: %s:%s", sunset.hour, sunset.minute)
-        repetitions_per_day = WittyPi4.calculate_num_repetitions_per_day(sunrise, sunset, settings.get("intervalMinutes"))
-        settings.set("repetitionsPerday", repetitions_per_day)
+    download_status = "unchanged"
 
-except Exception as e:
-    logging.warning("Could not get sunrise and sunset times: %s", str(e))
+    # Try to download settings from server if they changed
+    try:
+        if CONNECTED_TO_SERVER:
+            download_status = fileserver.download_file_if_changed("settings.yaml", FILE_PATH, fileserver_state)
+
+            # Check if settings file exists
+            if download_status == "missing":
+                logging.warning("No settings file on server. Creating new file with default settings.")
+                fileserver.upload_file("settings.yaml", FILE_PATH)
+            elif download_status == "error":
+                timer.succeeded = False
+    except Exception as e:
+        timer.succeeded = False
+        logging.critical("Could not download settings file from FTP server: %s", str(e))
+
+    # Read settings file, only validate it again if it changed
+    try:
+        if download_status == "unchanged" and path.exists(SETTINGS_SNAPSHOT_PATH):
+            settings = Settings(SETTINGS_SNAPSHOT_PATH, validate=False)
+        else:
+            settings = Settings(f"{FILE_PATH}settings.yaml")
+            settings.save_to_file(SETTINGS_SNAPSHOT_PATH)
+    except Exception as e:
+        logging.critical("Could not open settings.yaml: %s", str(e))
 
-try:
-    battery_voltage = wittyPi.get_battery_voltage()
-    data["battery_voltage"] = battery_voltage
+###########################
+# Time synchronization
+###########################
+def synchronize_clock() -> bool:
+    '''Set the Witty Pi clock to the time of the 4G module (cross-checked with GPS if there is a fix).
+    Falls back to the time of the internet connection. The drift of the clock is recorded as time_drift.
+    Returns True if the clock was set or did not drift.'''
+    utc_time = sim7600.get_utc_time(use_gps=GPS_ACQUIRING) if sim7600 is not None else None
 
-    battery_voltage_half = settings.get("battery_voltage_half")
-    battery_voltage_quarter = (battery_voltage_half-settings.get("low_voltage_threshold"))*0.5
+    if utc_time is None:
+        logging.warning("Could not get time from 4G module.")
+        return CONNECTED_TO_SERVER and wittyPi.sync_time_with_network()
 
-    if battery_voltage_quarter < battery_voltage < battery_voltage_half: # Battery voltage between 50% and 25%
-        settings.set("intervalMinutes", int(settings.get("intervalMinutes")*2))
-        settings.set("repetitionsPerday", int(settings.get("repetitionsPerday")/2))
-        logging.warning("Battery voltage <50%.")
-    elif battery_voltage < battery_voltage_quarter: # Battery voltage <25%
-        settings.set("repetitionsPerday", 1)
-        logging.warning("Battery voltage <25%.")
+    data["time_drift"] = wittyPi.sync_time(utc_time, settings.get("timeSyncMaxDriftSeconds"))
+    return data["time_drift"] is not None
 
-except Exception as e:
-    logging.warning("Could not get battery voltage: %s", str(e))
+def sync_time(timer):
+    '''Synchronize the Witty Pi clock with the network'''
+    try:
+        if settings.get("timeSync"):
+            timer.succeeded = synchronize_clock()
+    except Exception as e:
+        timer.succeeded = False
+        logging.warning("Could not synchronize time with network: %s", str(e))
 
 ###########################
 # Generate schedule
 ###########################
-try:
-    start_time_hour = settings.get("startTimeHour")
-    start_time_minute = settings.get("startTimeMinute")
-    interval_minutes = settings.get("intervalMinutes")
-    repetitions_per_day = settings.get("repetitionsPerday")
-    wittyPi.generate_schedule(start_time_hour, start_time_minute, interval_minutes, repetitions_per_day)
-except Exception as e:
-    wittyPi.generate_schedule(8, 0, 30, 8)
-    logging.warning("Failed to generate schedule: %s", str(e))
+def generate_schedule(timer):
+    '''Adjust the schedule to sunrise, sunset and battery level and generate the schedule file'''
+    global SCHEDULE_CHANGED
+
+    low_battery = False
+    interval_factor = 1
+    try:
+        battery_voltage = wittyPi.get_battery_voltage()
+        data["battery_voltage"] = battery_voltage
+
+        battery_voltage_half = settings.get("battery_voltage_half")
+        battery_voltage_quarter = (battery_voltage_half-settings.get("low_voltage_threshold"))*0.5
+
+        if battery_voltage_quarter < battery_voltage < battery_voltage_half: # Battery voltage between 50% and 25%
+            settings.set("intervalMinutes", int(settings.get("intervalMinutes")*2))
+            settings.set("repetitionsPerday", int(settings.get("repetitionsPerday")/2))
+            interval_factor = 2
+            logging.warning("Battery voltage <50%.")
+        elif battery_voltage < battery_voltage_quarter: # Battery voltage <25%
+            settings.set("repetitionsPerday", 1)
+            low_battery = True
+            logging.warning("Battery voltage <25%.")
+
+    except Exception as e:
+        logging.warning("Could not get battery voltage: %s", str(e))
+
+    # Capture windows (e.g. seasonal or burst windows) compiled into one schedule for a block of days
+    try:
+        if settings.get("scheduleWindows"):
+            windows = [CaptureWindow.from_dict(window) for window in settings.get("scheduleWindows")]
+            for window in windows:
+                window.interval_minutes *= interval_factor
+
+            schedule = compile_schedule(windows, datetime.today().date(), settings.get("scheduleDays"), WittyPi4.MAX_DURATION_MINUTES,
+                                        max_per_day=1 if low_battery else None)
+            SCHEDULE_CHANGED = wittyPi.write_schedule(schedule)
+            return
+
+    except Exception as e:
+        logging.warning("Could not compile schedule windows: %s", str(e))
+
+    # Schedule between sunrise and sunset for several days, so the Witty Pi only has to be reprogrammed once per block
+    try:
+        if settings.get("enableSunriseSunset") and settings.get("latitude") != 0 and settings.get("longitude") != 0:
+            import solar # Loads NumPy, which takes a while on a Pi Zero
+            solar_table = solar.load_table(settings.get("latitude"), settings.get("longitude"), FILE_PATH)
+            schedule = solar.generate_solar_schedule(solar_table, datetime.today().date(), settings.get("scheduleDays"),
+                                                     settings.get("intervalMinutes"), WittyPi4.MAX_DURATION_MINUTES,
+                                                     civil_twilight=settings.get("civilTwilight"), max_repetitions=1 if low_battery else None)
+            SCHEDULE_CHANGED = wittyPi.write_schedule(schedule)
+            return
+
+    except Exception as e:
+        logging.warning("Could not generate sunrise and sunset schedule: %s", str(e))
+
+    try:
+        start_time_hour = settings.get("startTimeHour")
+        start_time_minute = settings.get("startTimeMinute")
+        interval_minutes = settings.get("intervalMinutes")
+        repetitions_per_day = settings.get("repetitionsPerday")
+        SCHEDULE_CHANGED = wittyPi.generate_schedule(start_time_hour, start_time_minute, interval_minutes, repetitions_per_day)
+    except Exception as e:
+        SCHEDULE_CHANGED = wittyPi.generate_schedule(8, 0, 30, 8)
+        logging.warning("Failed to generate schedule: %s", str(e))
 
 ###########################
 # Apply schedule
 ###########################
-try:
-    next_startup_time = wittyPi.apply_schedule()
-    data['next_startup_time'] = f"{next_startup_time}Z"
-except Exception as e:
-    logging.critical("Could not apply schedule: %s", str(e))
+def apply_schedule(timer):
+    '''Apply the generated schedule to the Witty Pi'''
+    try:
+        next_startup_time = wittyPi.apply_schedule(sync_time=synchronize_clock, schedule_changed=SCHEDULE_CHANGED)
+        data['next_startup_time'] = f"{next_startup_time}Z"
+        data['schedule_applied'] = wittyPi.apply_schedule_attempts > 0 # runScript.sh is skipped if the alarms are still valid
+        timer.retries = max(0, wittyPi.apply_schedule_attempts - 1)
+        timer.succeeded = next_startup_time != "-"
+    except Exception as e:
+        timer.succeeded = False
+        logging.critical("Could not apply schedule: %s", str(e))
 
 ##########################
 # SIM7600G-H 4G module
 ###########################
+def setup_modem(timer):
+    '''Open the serial connection with the 4G module'''
+    global sim7600
 
-# See Waveshare documentation
-try:
-    sim7600 = SIM7600X()
-except Exception as e:
-    logging.warning("Could not open serial connection with 4G module: %s", str(e))
+    # See Waveshare documentation
+    try:
+        sim7600 = SIM7600X()
+        sim7600.start_service() # Queue AT commands of concurrent stages and poll GPS in the background
+    except Exception as e:
+        logging.warning("Could not open serial connection with 4G module: %s", str(e))
 
-# Enable GPS
-try:
-    # Enable GPS to later read out position
-    if settings.get("enableGPS"):
-        sim7600.start_gps_session()
-except Exception as e:
-    logging.warning("Could not start GPS: %s", str(e))
+def start_gps(timer):
+    '''Start the GPS session early so the receiver can get a fix while the camera is busy.
+    The session is only started if the cached fix can not be used.'''
+    global gps_cache, GPS_ACQUIRING
+
+    try:
+        # Enable GPS to later read out position
+        if settings.get("enableGPS"):
+            gps_cache = GpsFixCache(PersistentState(f"{FILE_PATH}gps_state.yaml"), settings.get("gpsReacquireWakes"),
+                                    settings.get("gpsReacquireHours"), settings.get("gpsMaxHdop"))
+            cell_id = sim7600.get_cell_id()
+            reason = gps_cache.reacquire_reason(cell_id)
+            data["xtra_age_hours"] = gps_cache.xtra_age_hours() # A refresh in this wake cycle is reported in the next one
+
+            if reason is None:
+                data["latitude"], data["longitude"], data["height"] = gps_cache.position()
+                data["gps_cached"] = True
+                data["gps_fix_age_hours"] = gps_cache.age_hours()
+                gps_cache.count_wake(cell_id)
+                logging.info("Using cached GPS position (%s h old).", data["gps_fix_age_hours"])
+                return
+
+            data["gps_reacquire_reason"] = reason
+            if settings.get("gpsAssistance"):
+                sim7600.enable_gnss_assistance()
+            sim7600.start_gps_session(hot_start=settings.get("gpsAssistance"))
+            sim7600.service.start_gps_polling()
+            GPS_ACQUIRING = True
+    except Exception as e:
+        logging.warning("Could not start GPS: %s", str(e))
 
 ###########################
 # Setup camera
 ###########################
-try:
-    camera = Picamera2()
-    cameraConfig = camera.create_still_configuration() # Selects highest resolution by default
+def setup_camera(timer):
+    '''Initialize and configure the camera'''
+    global camera, cameraConfig
+
+    try:
+        camera = Picamera2()
+        cameraConfig = camera.create_still_configuration() # Selects highest resolution by default
 
-    # https://datasheets.raspberrypi.com/camera/picamera2-manual.pdf
-    # Table 6. Stream- specific configuration parameters
-    MIN_RESOLUTION = 64
-    MAX_RESOLUTION = (4608, 2592)
-    resolution = settings.get("resolution")
+        # https://datasheets.raspberrypi.com/camera/picamera2-manual.pdf
+        # Table 6. Stream- specific configuration parameters
+        MIN_RESOLUTION = 64
+        MAX_RESOLUTION = (4608, 2592)
+        resolution = settings.get("resolution")
 
-    if MIN_RESOLUTION < resolution[0] < MAX_RESOLUTION[0] and MIN_RESOLUTION < resolution[1] < MAX_RESOLUTION[1]:
-        size = (resolution[0], resolution[1])
-        cameraConfig = camera.create_still_configuration({"size": size})
+        if MIN_RESOLUTION < resolution[0] < MAX_RESOLUTION[0] and MIN_RESOLUTION < resolution[1] < MAX_RESOLUTION[1]:
+            size = (resolution[0], resolution[1])
+            cameraConfig = camera.create_still_configuration({"size": size})
 
-except Exception as e:
-    logging.critical("Could not setup camera: %s", str(e))
+    except Exception as e:
+        logging.critical("Could not setup camera: %s", str(e))
 
-# Focus settings
-try:
-    if settings.get("lensPosition") > -1:
-        camera.set_controls({"AfMode": controls.AfModeEnum.Manual, "LensPosition": settings.get("lensPosition")})
-    else:
-        camera.set_controls({"AfMode": controls.AfModeEnum.Auto})
-except Exception as e:
-    logging.warning("Could not set lens position: %s", str(e))
+    # Focus settings
+    try:
+        if settings.get("lensPosition") > -1:
+            camera.set_controls({"AfMode": controls.AfModeEnum.Manual, "LensPosition": settings.get("lensPosition")})
+        else:
+            camera.set_controls({"AfMode": controls.AfModeEnum.Auto})
+    except Exception as e:
+        logging.warning("Could not set lens position: %s", str(e))
 
 ###########################
 # Capture image
 ###########################
-try:
-    image_filename = f'{TIMESTAMP_FILENAME}.jpg'
-    if settings.get("cameraName") != "":
-        image_filename = f'{TIMESTAMP_FILENAME}_{settings.get("cameraName")}.jpg'
-except Exception as e:
-    logging.warning("Could not set custom camera name: %s", str(e))
+def capture_image(timer):
+    '''Capture an image to memory and stop the camera'''
+    global image_filename, image_buffer
 
-try:
-    camera.start_and_capture_file(FILE_PATH + image_filename, capture_mode=cameraConfig, delay=2, show_preview=False)
-except Exception as e:
-    logging.critical("Could not start camera and capture image: %s", str(e))
+    try:
+        image_filename = f'{TIMESTAMP_FILENAME}.jpg'
+        if settings.get("cameraName") != "":
+            image_filename = f'{TIMESTAMP_FILENAME}_{settings.get("cameraName")}.jpg'
+    except Exception as e:
+        image_filename = f'{TIMESTAMP_FILENAME}.jpg'
+        logging.warning("Could not set custom camera name: %s", str(e))
+
+    # Encode to memory, the image is only written to the SD card if it cannot be uploaded
+    try:
+        camera.configure(cameraConfig)
+        camera.start()
+        sleep(2)
+        buffer = BytesIO()
+        camera.capture_file(buffer, format="jpeg")
+        with image_buffer_lock:
+            image_buffer = buffer
+        data["image_bytes"] = buffer.getbuffer().nbytes
+    except Exception as e:
+        timer.succeeded = False
+        logging.critical("Could not start camera and capture image: %s", str(e))
+
+    # Stop camera
+    try:
+        camera.stop()
+    except Exception as e:
+        logging.warning("Could not stop camera: %s", str(e))
 
-###########################
-# Stop camera
-###########################
-try:
-    camera.stop()
-except Exception as e:
-    logging.warning("Could not stop camera: %s", str(e))
+def abort_fileserver():
+    '''Close a hung file server connection so the remaining stages fall back to local storage'''
+    global CONNECTED_TO_SERVER
+
+    CONNECTED_TO_SERVER = False
+    if fileserver is not None:
+        fileserver.close()
 
 ###########################
 # Upload image(s) to file server
 ###########################
+def upload_spooled_file(session: FileServer, filename: str) -> bool:
+    '''Upload a file from the spool, interrupted uploads are resumed and files are only deleted once the server confirmed the upload'''
+    uploaded = spool.get_uploaded(filename)
+    spool.mark_in_flight(filename)
+    session.block_size = settings.get("uploadBlockSizeKilobytes")*1024
 
-try:
-    if CONNECTED_TO_SERVER:
-        # Upload all images
-        for file in listdir(FILE_PATH):
-            if file.endswith(".jpg"):
-                fileserver.upload_file(file, FILE_PATH)
+    if session.upload_file_resumable(filename, FILE_PATH, offset_hint=uploaded):
+        spool.mark_done(filename)
+        return True
 
-                # Delete uploaded image from Raspberry Pi
-                remove(FILE_PATH + file)
-except Exception as e:
-    logging.critical("Could not upload image to fileserver: %s", str(e))
+    spool.mark_failed(filename, session.uploaded_bytes)
+    return False
+
+def spool_image_buffer(uploaded: int = 0) -> None:
+    '''Save the image of this wake cycle to the spool if it was not uploaded. uploaded is the number of bytes
+    already on the server, so the backlog resumes the upload instead of starting over.'''
+    global image_buffer
+
+    with image_buffer_lock:
+        if image_buffer is None:
+            return
+
+        try:
+            if spool is None:
+                write_file(FILE_PATH + image_filename, image_buffer.getvalue()) # Found by scan() of a later wake cycle
+                image_buffer = None
+                return
+
+            spool.add_bytes(image_filename, image_buffer.getvalue())
+            if uploaded:
+                spool.mark_failed(image_filename, uploaded)
+            image_buffer = None
+        except Exception as e:
+            logging.critical("Could not save image to spool: %s", str(e))
+
+def abort_image_upload():
+    '''Close the hung connection and keep the image for the next wake cycle'''
+    abort_fileserver()
+    spool_image_buffer(fileserver.uploaded_bytes if fileserver is not None else 0)
+
+def upload_images(timer):
+    '''Upload the image of this wake cycle straight from memory, it is only saved to the spool if this fails'''
+    global image_buffer
+
+    try:
+        with image_buffer_lock:
+            buffer = image_buffer
+
+        if CONNECTED_TO_SERVER and buffer is not None:
+            fileserver.block_size = settings.get("uploadBlockSizeKilobytes")*1024
+            timer.succeeded = fileserver.upload_bytes_resumable(image_filename, buffer)
+
+            if timer.succeeded:
+                with image_buffer_lock:
+                    if image_buffer is buffer:
+                        image_buffer = None
+            else:
+                spool_image_buffer(fileserver.uploaded_bytes)
+
+        spool_image_buffer()
+        if spool is not None:
+            data["spool_files"], data["spool_bytes"] = spool.pending()
+    except Exception as e:
+        timer.succeeded = False
+        logging.critical("Could not upload image to fileserver: %s", str(e))
+
+def upload_backlog(timer):
+    '''Upload the images of previous wake cycles newest first, as long as the byte budget and time allow'''
+    try:
+        if spool is None:
+            return
+
+        spool.scan()
+
+        if CONNECTED_TO_SERVER:
+            byte_budget = int(settings.get("uploadBudgetMegabytes")*1024*1024)
+
+            # Additional sessions are only opened if there is a backlog
+            uploader = ParallelUploader(fileserver, connect_upload_session, settings.get("uploadSessions"))
+            uploader.upload(spool.next_batch(byte_budget), upload_spooled_file, timer.remaining)
+
+            spool.prune()
+    except Exception as e:
+        timer.succeeded = False
+        logging.warning("Could not upload backlog of images to fileserver: %s", str(e))
 
 ###########################
 # Set voltage thresholds
 ###########################
-try:
-    # If settings low voltage threshold exists
-    if settings.get("low_voltage_threshold"):
-        wittyPi.set_low_voltage_threshold(settings.get("low_voltage_threshold"))
+def set_voltage_thresholds(timer):
+    '''Set the low and recovery voltage thresholds of the Witty Pi'''
+    try:
+        # If settings low voltage threshold exists
+        if settings.get("low_voltage_threshold"):
+            wittyPi.set_low_voltage_threshold(settings.get("low_voltage_threshold"))
 
-    # If settings recovery voltage threshold exists
-    if settings.get("recovery_voltage_threshold"):
-        # Recovery voltage threshold must be equal or greater than low voltage threshold
-        if settings.get("recovery_voltage_threshold") < settings.get("low_voltage_threshold"):
-            settings.set("recovery_voltage_threshold", settings.get("low_voltage_threshold"))
+        # If settings recovery voltage threshold exists
+        if settings.get("recovery_voltage_threshold"):
+            # Recovery voltage threshold must be equal or greater than low voltage threshold
+            if settings.get("recovery_voltage_threshold") < settings.get("low_voltage_threshold"):
+                settings.set("recovery_voltage_threshold", settings.get("low_voltage_threshold"))
 
-        wittyPi.set_recovery_voltage_threshold(settings.get("recovery_voltage_threshold"))
+            wittyPi.set_recovery_voltage_threshold(settings.get("recovery_voltage_threshold"))
 
-except Exception as e:
-    logging.warning("Could not set voltage thresholds: %s", str(e))
+    except Exception as e:
+        logging.warning("Could not set voltage thresholds: %s", str(e))
 
 ###########################
 # Get readings
 ###########################
-try:
-    data["temperature"] = wittyPi.get_temperature()
-    data["internal_voltage"] = wittyPi.get_internal_voltage()
-    # data["internal_current"] = wittyPi.get_internal_current()
-    data["signal_quality"] = sim7600.get_signal_quality()
-except Exception as e:
-    logging.warning("Could not get readings: %s", str(e))
+def get_readings(timer):
+    '''Read the Witty Pi sensors and the state of the 4G link which was used to connect to the file server'''
+    try:
+        witty_pi_snapshot = wittyPi.get_snapshot(fields=("temperature", "output_voltage"))
+        data["temperature"] = witty_pi_snapshot.temperature
+        data["internal_voltage"] = witty_pi_snapshot.output_voltage
+        # data["internal_current"] = witty_pi_snapshot.output_current
+        modem_status = sim7600.get_modem_status()
+        data["signal_quality"] = str(modem_status.csq) if modem_status.csq != 99 else "" # 99 = unknown or no answer
+        data.update({f"modem_{key}": value for key, value in asdict(modem_status).items() if key != "csq"})
+    except Exception as e:
+        logging.warning("Could not get readings: %s", str(e))
 
 ###########################
 # Get GPS position
 ###########################
-try:
-    if settings.get("enableGPS"):
-        data["latitude"], data["longitude"], data["height"] = sim7600.get_gps_position()
-        sim7600.stop_gps_session()
+def get_gps_position(timer):
+    '''Read out the GPS position and stop the GPS session'''
+    try:
+        if GPS_ACQUIRING:
+            # Position is polled in the background since the GPS session was started, keep time to stop the session
+            position = sim7600.wait_for_gps_fix(timeout=max(1, timer.remaining() - 5))
+            timer.retries = max(0, sim7600.service.gps_polls - 1)
+            timer.succeeded = position[0] != "-"
+
+            if timer.succeeded:
+                gps_cache.update(position, sim7600.get_gps_hdop(), sim7600.get_cell_id())
+                data["gps_fix_age_hours"] = 0.0
+                data["gps_ttff"] = sim7600.get_gps_ttff()
+            elif gps_cache.position() is not None:
+                # Better an old position than none
+                position = gps_cache.position()
+                data["gps_cached"] = True
+                data["gps_fix_age_hours"] = gps_cache.age_hours()
+
+            data["latitude"], data["longitude"], data["height"] = position
+            sim7600.stop_gps_session()
+
+    except Exception as e:
+        timer.succeeded = False
+        logging.warning("Could not get GPS coordinates: %s", str(e))
+
+def refresh_gps_assistance(timer):
+    '''Download new XTRA assistance data while there is a data connection anyway, so the next fix is faster'''
+    try:
+        if gps_cache is None or not settings.get("gpsAssistance") or not CONNECTED_TO_SERVER:
+            return
 
-except Exception as e:
-    logging.warning("Could not get GPS coordinates: %s", str(e))
+        xtra_age_hours = gps_cache.xtra_age_hours()
+        if xtra_age_hours is not None and xtra_age_hours < XTRA_REFRESH_HOURS:
+            return
+
+        timer.succeeded = sim7600.download_xtra(timeout=max(1, timer.remaining()))
+        if timer.succeeded:
+            gps_cache.set_xtra_updated()
+    except Exception as e:
+        timer.succeeded = False
+        logging.warning("Could not refresh GPS assistance data: %s", str(e))
 
 ###########################
 # Uploading sensor data to server
 ###########################
+def upload_measurements(timer):
+    '''Append new measurements to log or create new log file if none exists'''
+    try:
+        data["t_total"] = round(monotonic() - START_TIME, 2) # Until the measurements are written
+        measurements = [data.copy()] # Stages which timed out might still write to data
 
-# Append new measurements to log or create new log file if none exists
-try:
-    DIAGNOSTICS_FILENAME = "diagnostics.yaml"
-    diagnostics_filepath = f"{FILE_PATH}{DIAGNOSTICS_FILENAME}"
+        # Check if is connected to file server, bundled measurements are uploaded with the logs
+        if CONNECTED_TO_SERVER and not settings.get("bundleDiagnostics"):
+            try:
+                # Check if local diagnostics file exists
+                if path.exists(DIAGNOSTICS_FILEPATH):
+                    with open(DIAGNOSTICS_FILEPATH, 'r', encoding='utf-8') as yaml_file:
+                        read_data = safe_load(yaml_file)
 
-    # Check if is connected to file server
-    if CONNECTED_TO_SERVER:
-        try:
-            # Check if local diagnostics file exists
-            if path.exists(diagnostics_filepath):
-                with open(diagnostics_filepath, 'r', encoding='utf-8') as yaml_file:
-                    read_data = safe_load(yaml_file)
+                    measurements = read_data + measurements
 
-                data = read_data + [data]
+                    remove(DIAGNOSTICS_FILEPATH)
+            except Exception as e:
+                logging.warning("Could not open diagnostics file: %s", str(e))
 
-                remove(diagnostics_filepath)
-        except Exception as e:
-            logging.warning("Could not open diagnostics file: %s", str(e))
+            # Upload diagnostics to server
+            byte_stream = BytesIO()
+            safe_dump(measurements, stream=byte_stream, default_flow_style=False, encoding='utf-8')
+            byte_stream.seek(0)  # Set the position to the beginning of the BytesIO object
 
+            if fileserver.append_file_from_bytes(DIAGNOSTICS_FILENAME, byte_stream):
+                return
 
-        # Upload diagnostics to server
-        byte_stream = BytesIO()
-        safe_dump([data], stream=byte_stream, default_flow_style=False, encoding='utf-8')
-        byte_stream.seek(0)  # Set the position to the beginning of the BytesIO object
-        fileserver.append_file_from_bytes(DIAGNOSTICS_FILENAME, byte_stream)
-    else:
         # Append new measurement to local YAML file
-        with open(diagnostics_filepath, 'a', encoding='utf-8') as yaml_file:
-            safe_dump([data], yaml_file, default_flow_style=False)
-except Exception as e:
-    logging.warning("Could not append new measurements to log: %s", str(e))
+        with open(DIAGNOSTICS_FILEPATH, 'a', encoding='utf-8') as yaml_file:
+            safe_dump(measurements, yaml_file, default_flow_style=False)
+    except Exception as e:
+        logging.warning("Could not append new measurements to log: %s", str(e))
 
 ###########################
 # Upload diagnostics data
 ###########################
-try:
-    fileserver.append_file("log.txt", FILE_PATH)
+def upload_diagnostics(timer):
+    '''Upload the new part of the log files (and the measurements if bundled) to the file server'''
+    try:
+        if CONNECTED_TO_SERVER:
+            log_offsets = PersistentState(f"{FILE_PATH}log_offsets.yaml")
 
-    # Upload WittyPi diagnostics
-    if settings.get("uploadWittyPiDiagnostics") and CONNECTED_TO_SERVER:
-        fileserver.append_file("wittyPi.log", f"{FILE_PATH}wittypi/")
-        fileserver.append_file("schedule.log", f"{FILE_PATH}wittypi/")
-except Exception as e:
-    logging.warning("Could not upload diagnostics data: %s", str(e))
+            if settings.get("bundleDiagnostics"):
+                # Everything is sent in a single transfer, offsets are only saved once the bundle was uploaded
+                bundle = DiagnosticsBundle()
+                log_shipper = LogShipper(bundle, log_offsets, autocommit=False)
+
+                if path.exists(DIAGNOSTICS_FILEPATH):
+                    with open(DIAGNOSTICS_FILEPATH, 'rb') as yaml_file:
+                        bundle.append_file_from_bytes(DIAGNOSTICS_FILENAME, yaml_file)
+            else:
+                log_shipper = LogShipper(fileserver, log_offsets, settings.get("compressLogs"))
+
+            log_shipper.ship("log.txt", FILE_PATH)
+
+            # Upload WittyPi diagnostics
+            if settings.get("uploadWittyPiDiagnostics"):
+                log_shipper.ship("wittyPi.log", f"{FILE_PATH}wittypi/")
+                log_shipper.ship("schedule.log", f"{FILE_PATH}wittypi/")
+
+            if settings.get("bundleDiagnostics") and not bundle.is_empty():
+                if fileserver.upload_file_from_bytes(f"{BUNDLE_PREFIX}{TIMESTAMP_FILENAME}{BUNDLE_SUFFIX}", bundle.to_bytes()):
+                    log_shipper.commit()
+
+                    if path.exists(DIAGNOSTICS_FILEPATH):
+                        remove(DIAGNOSTICS_FILEPATH)
+                else:
+                    timer.succeeded = False
+    except Exception as e:
+        logging.warning("Could not upload diagnostics data: %s", str(e))
 
 ###########################
 # Quit file server session
 ###########################
+def quit_fileserver(timer):
+    '''Close the file server session'''
+    try:
+        if CONNECTED_TO_SERVER:
+            fileserver.quit()
+    except Exception as e:
+        logging.warning("Could not close file server session: %s", str(e))
+
+###########################
+# Resident mode
+###########################
+def resident_mode_allowed() -> bool:
+    '''Check if resident mode is enabled and the battery allows to stay on'''
+    return bool(settings.get("residentMode")) and wittyPi.get_battery_voltage() >= settings.get("residentMinBatteryVoltage")
+
+def run_resident_mode():
+    '''Stay on with the camera started and capture at short intervals, e.g. during glacier lake outburst season.
+    Returns to the shutdown when the battery voltage drops or after residentMaxMinutes.'''
+    upload_session = None # Only used by the upload thread of resident mode, which also closes it
+    last_connect = None
+    RECONNECT_INTERVAL = 300 # Seconds
+
+    def next_filename() -> str:
+        timestamp = datetime.today().strftime('%Y%m%d_%H%M%SZ') # UTC-Time, seconds for sub-minute intervals
+        return f'{timestamp}_{settings.get("cameraName")}.jpg' if settings.get("cameraName") != "" else f'{timestamp}.jpg'
+
+    def upload(filename: str, buffer: BytesIO) -> bool:
+        nonlocal upload_session, last_connect
+
+        if upload_session is None or not upload_session.connected():
+            if last_connect is not None and monotonic() - last_connect < RECONNECT_INTERVAL:
+                return False
+            last_connect = monotonic()
+            upload_session = connect_upload_session()
+
+        upload_session.block_size = settings.get("uploadBlockSizeKilobytes")*1024
+        return upload_session.connected() and upload_session.upload_bytes_resumable(filename, buffer)
+
+    def save(filename: str, buffer: BytesIO) -> None:
+        if spool is not None:
+            spool.add_bytes(filename, buffer.getvalue())
+        else:
+            write_file(FILE_PATH + filename, buffer.getvalue())
+
+    def close() -> None:
+        if upload_session is not None:
+            upload_session.quit()
+
+    try:
+        if settings is None or camera is None or wittyPi is None or not resident_mode_allowed():
+            return
+
+        # Otherwise the Witty Pi cuts the power at the end of the scheduled on time
+        if not wittyPi.clear_shutdown_time():
+            logging.warning("Could not clear shutdown alarm, not entering resident mode.")
+            return
+
+        resident_mode = ResidentMode(camera, cameraConfig, next_filename, upload, save, resident_mode_allowed,
+                                     settings.get("residentIntervalSeconds"), settings.get("residentMaxMinutes")*60, close)
+        resident_mode.run()
+    except Exception as e:
+        logging.error("Resident mode failed: %s", str(e))
+
+    # Set the next startup and shutdown again
+    try:
+        next_startup_time = wittyPi.apply_schedule(sync_time=synchronize_clock)
+        logging.info("Left resident mode, next startup at %s.", next_startup_time)
+    except Exception as e:
+        logging.critical("Could not apply schedule after resident mode: %s", str(e))
+
+###########################
+# Wake cycle
+###########################
+
+# Stages only wait for the stages they really depend on. All stages using the file server
+# are chained because they share a single FTP control connection.
+# Capture, schedule, voltage thresholds and measurements must always run. Everything else
+# is shed or cut short when the Witty Pi is about to cut the power.
+SHUTDOWN_MARGIN = 20 # Seconds reserved to shut down the Raspberry Pi
+WAKE_CYCLE_DEADLINE = START_TIME + WittyPi4.MAX_DURATION_MINUTES*60 - SHUTDOWN_MARGIN
+
+wake_cycle = Pipeline(data, WAKE_CYCLE_DEADLINE)
+wake_cycle.add_stage("load_settings", load_settings, timeout=10)
+wake_cycle.add_stage("modem", setup_modem, priority=PRIORITY_HIGH, timeout=10)
+wake_cycle.add_stage("gps_start", start_gps, depends_on=("modem", "load_settings"), priority=PRIORITY_LOW, timeout=10)
+wake_cycle.add_stage("ftp_connect", connect_fileserver, depends_on=("modem", "gps_start"), priority=PRIORITY_HIGH, timeout=60) # GNSS starts first
+wake_cycle.add_stage("camera_setup", setup_camera, depends_on=("load_settings",), timeout=20)
+wake_cycle.add_stage("capture", capture_image, depends_on=("camera_setup",), timeout=30)
+wake_cycle.add_stage("download_settings", download_settings, depends_on=("ftp_connect",), priority=PRIORITY_HIGH, timeout=30, on_timeout=abort_fileserver)
+wake_cycle.add_stage("time_sync", sync_time, depends_on=("download_settings",), priority=PRIORITY_LOW, timeout=10)
+wake_cycle.add_stage("generate_schedule", generate_schedule, depends_on=("download_settings",), timeout=20)
+wake_cycle.add_stage("apply_schedule", apply_schedule, depends_on=("generate_schedule", "time_sync"), timeout=90)
+wake_cycle.add_stage("upload", upload_images, depends_on=("download_settings", "capture"), priority=PRIORITY_HIGH, timeout=120, on_timeout=abort_image_upload)
+wake_cycle.add_stage("voltage_thresholds", set_voltage_thresholds, depends_on=("download_settings",), timeout=20)
+wake_cycle.add_stage("readings", get_readings, depends_on=("ftp_connect",), priority=PRIORITY_HIGH, timeout=20)
+wake_cycle.add_stage("gps_fix", get_gps_position, depends_on=("gps_start",), priority=PRIORITY_LOW, timeout=40)
+wake_cycle.add_stage("measurements", upload_measurements, depends_on=("upload", "apply_schedule", "voltage_thresholds", "readings", "gps_fix"), timeout=30, on_timeout=abort_fileserver)
+wake_cycle.add_stage("backlog", upload_backlog, depends_on=("measurements",), priority=PRIORITY_LOW, timeout=120, on_timeout=abort_fileserver)
+wake_cycle.add_stage("gps_assist", refresh_gps_assistance, depends_on=("gps_fix", "backlog"), priority=PRIORITY_LOW, timeout=40) # Holds the modem, after the diagnostics are written
+wake_cycle.add_stage("diagnostics", upload_diagnostics, depends_on=("backlog",), priority=PRIORITY_LOW, timeout=30, on_timeout=abort_fileserver)
+wake_cycle.add_stage("ftp_quit", quit_fileserver, depends_on=("diagnostics",), priority=PRIORITY_LOW, timeout=5)
+wake_cycle.run()
+spool_image_buffer() # If the upload stage was skipped
+
+# GNSS is still on if the GPS stage was skipped or timed out
+if sim7600 is not None and sim7600.service is not None and sim7600.service.gps_polling.is_set():
+    sim7600.stop_gps_session()
+
+run_resident_mode()
+
 try:
-    if CONNECTED_TO_SERVER:
-        fileserver.quit()
+    sim7600.stop_service()
 except Exception as e:
-    logging.warning("Could not close file server session: %s", str(e))
+    logging.warning("Could not stop modem service: %s", str(e))
+
+if wittyPi is not None:
+    wittyPi.close()
 
 ###########################
 # Shutdown Raspberry Pi if enabled
@@ -0,0 +1,94 @@
+'''Upload a queue of files over several file server sessions at once'''
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import monotonic
+import logging
+
+class ParallelUploader:
+    '''Distribute queued files over N FTP sessions. Sessions which keep failing are closed so the uploader
+    backs off to fewer sessions on a bad connection.'''
+
+    MAX_FAILURES_PER_SESSION = 2
+
+    def __init__(self, primary_session, connect_session = None, sessions: int = 1) -> None:
+        '''primary_session is an already connected FileServer, connect_session() has to return a new connected
+        FileServer in the same directory for each additional session.'''
+        self.primary_session = primary_session
+        self.connect_session = connect_session
+        self.sessions = max(1, sessions) if connect_session is not None else 1
+        self.lock = Lock()
+        self.active_sessions = 0
+        self.uploaded_bytes = 0
+        self.failed_files = 0
+        self.throughput = 0.0 # Bytes per second
+
+    def _worker(self, session, files: Queue, upload_function, remaining) -> None:
+        '''Upload files from the queue until it is empty, the time is up or the session failed too often'''
+        failures = 0
+
+        try:
+            if session is None:
+                session = self.connect_session()
+
+            if not session.connected():
+                return
+
+            with self.lock:
+                self.active_sessions += 1
+
+            while remaining is None or remaining() > session.TIMEOUT:
+                try:
+                    filename, size = files.get_nowait()
+                except Empty:
+                    break
+
+                if upload_function(session, filename):
+                    with self.lock:
+                        self.uploaded_bytes += size
+                    continue
+
+                failures += 1
+                with self.lock:
+                    self.failed_files += 1
+
+                    # Back off to fewer sessions, the last session keeps going
+                    if failures >= self.MAX_FAILURES_PER_SESSION and self.active_sessions > 1:
+                        logging.warning("Upload session failed %s times, closing it.", failures)
+                        self.active_sessions -= 1
+                        return
+
+            with self.lock:
+                self.active_sessions -= 1
+        except Exception as e:
+            logging.error("Upload session failed: %s", str(e))
+        finally:
+            if session is not None and session is not self.primary_session and session.connected():
+                session.quit()
+
+    def upload(self, files: list, upload_function, remaining = None) -> int:
+        '''Upload the (filename, size) tuples with upload_function(session, filename) -> bool.
+        remaining() returns the seconds left to upload. Returns the number of uploaded bytes.'''
+        queue = Queue()
+        for file in files:
+            queue.put(file)
+
+        start_time = monotonic()
+        sessions = min(self.sessions, len(files))
+        workers = []
+
+        for i in range(sessions):
+            # The primary session is used by the first worker, the others connect in parallel
+            session = self.primary_session if i == 0 else None
+            worker = Thread(target=self._worker, args=(session, queue, upload_function, remaining), daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+
+        duration = monotonic() - start_time
+        self.throughput = self.uploaded_bytes / duration if duration > 0 else 0.0
+        logging.info("Uploaded %s bytes over %s session(s) in %.1f s (%.1f kB/s, %s failed).",
+                     self.uploaded_bytes, sessions, duration, self.throughput / 1024, self.failed_files)
+
+        return self.uploaded_bytes
@@ -0,0 +1,45 @@
+'''Small key-value store which keeps state between wake cycles'''
+from os import replace
+from threading import Lock
+import logging
+from yaml import safe_load, safe_dump
+
+class PersistentState:
+    '''Key-value store saved as YAML file. The file is replaced atomically so a power cut can not corrupt it.'''
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.lock = Lock()
+
+        try:
+            with open(filename, 'r', encoding='utf-8') as file:
+                self.state = safe_load(file) or {}
+        except FileNotFoundError:
+            self.state = {}
+        except Exception as e:
+            logging.warning("Could not load state file %s: %s", filename, str(e))
+            self.state = {}
+
+    def get(self, key: str, default=None):
+        '''Get a value from the state'''
+        with self.lock:
+            return self.state.get(key, default)
+
+    def set(self, key: str, value, save: bool = True) -> None:
+        '''Set a value and save the state to the file'''
+        with self.lock:
+            self.state[key] = value
+
+        if save:
+            self.save()
+
+    def save(self) -> None:
+        '''Save the state to the file'''
+        with self.lock:
+            try:
+                temporary_filename = f"{self.filename}.tmp"
+                with open(temporary_filename, 'w', encoding='utf-8') as file:
+                    safe_dump(self.state, file, default_flow_style=False)
+                replace(temporary_filename, self.filename)
+            except Exception as e:
+                logging.error("Could not save state file %s: %s", self.filename, str(e))
@@ -0,0 +1,176 @@
+'''A small dependency-graph runner for the stages of a GlacierCam wake cycle'''
+from threading import Thread, Event
+from time import monotonic
+import logging
+
+# Stage priorities, lower priority stages are shed first when the deadline approaches
+PRIORITY_MUST_RUN = 0
+PRIORITY_HIGH = 1
+PRIORITY_LOW = 2
+
+class StageTimer:
+    '''Context manager which records the duration, success and retries of a stage into a data dict'''
+
+    def __init__(self, data: dict, name: str, deadline: float = None) -> None:
+        self.data = data
+        self.name = name
+        self.deadline = deadline # Monotonic time by which the stage has to be finished
+        self.succeeded = True # Stages can mark themselves as failed without raising
+        self.cancelled = False # Set if the pipeline stopped waiting for the stage
+        self.retries = 0
+        self.start_time = monotonic()
+        self.duration = 0.0
+
+    def __enter__(self):
+        self.start_time = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.duration = monotonic() - self.start_time
+
+        if exc_type is not None:
+            self.succeeded = False
+
+        # The pipeline already recorded a stage it stopped waiting for
+        if self.cancelled:
+            return False
+
+        self.data[f"t_{self.name}"] = round(self.duration, 2)
+
+        if self.retries > 0:
+            self.data[f"retries_{self.name}"] = self.retries
+
+        if not self.succeeded:
+            self.data.setdefault("failed_stages", []).append(self.name)
+
+        logging.info("Stage %s took %.2f s (succeeded: %s, retries: %s)", self.name, self.duration, self.succeeded, self.retries)
+        return False
+
+    def remaining(self) -> float:
+        '''Seconds left until the deadline of the stage, long running stages should check this between steps'''
+        if self.deadline is None:
+            return float("inf")
+
+        return max(0.0, self.deadline - monotonic())
+
+class Stage:
+    '''A single stage of the wake cycle'''
+
+    def __init__(self, name: str, function, depends_on: tuple = (), priority: int = PRIORITY_MUST_RUN, timeout: float = None, on_timeout = None) -> None:
+        self.name = name
+        self.function = function
+        self.depends_on = tuple(depends_on)
+        self.priority = priority
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.finished = Event()
+        self.succeeded = False
+        self.result = None
+
+class Pipeline:
+    '''Run the stages of a wake cycle concurrently, each stage waits only for the stages it depends on'''
+
+    # Seconds of the budget which are reserved for higher priority stages
+    RESERVE_SECONDS = {PRIORITY_MUST_RUN: 0, PRIORITY_HIGH: 30, PRIORITY_LOW: 60}
+
+    def __init__(self, data: dict = None, deadline: float = None) -> None:
+        self.stages = {}
+        self.data = data if data is not None else {}
+        self.deadline = deadline # Monotonic time by which the wake cycle has to be finished
+
+    def add_stage(self, name: str, function, depends_on: tuple = (), priority: int = PRIORITY_MUST_RUN, timeout: float = None, on_timeout = None) -> None:
+        '''Add a stage which runs function(timer) once all stages in depends_on have finished.
+        If the stage does not finish within timeout seconds (or before its share of the deadline), on_timeout() is called
+        and the dependent stages continue without it.'''
+        if name in self.stages:
+            raise ValueError(f"Stage {name} already exists.")
+
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}.")
+
+        self.stages[name] = Stage(name, function, depends_on, priority, timeout, on_timeout)
+
+    def must_run_reserve(self, stage: Stage) -> float:
+        '''Get the seconds needed by the must run stages which wait (directly or indirectly) for a stage,
+        along the longest chain of their timeouts'''
+        reserve = 0.0
+
+        for dependent in self.stages.values():
+            if stage.name in dependent.depends_on:
+                timeout = (dependent.timeout or 0.0) if dependent.priority == PRIORITY_MUST_RUN else 0.0
+                reserve = max(reserve, timeout + self.must_run_reserve(dependent))
+
+        return reserve
+
+    def stage_deadline(self, stage: Stage) -> float:
+        '''Get the monotonic time by which a stage starting now has to be finished. Every stage leaves the reserve of
+        its priority and enough time for the must run stages after it (e.g. writing the diagnostics).'''
+        deadline = None
+
+        if stage.timeout is not None:
+            deadline = monotonic() + stage.timeout
+
+        if self.deadline is not None:
+            reserve = max(self.RESERVE_SECONDS[stage.priority], self.must_run_reserve(stage))
+            budget_deadline = self.deadline - reserve
+            deadline = budget_deadline if deadline is None else min(deadline, budget_deadline)
+
+        return deadline
+
+    def _run_function(self, stage: Stage, timer: StageTimer) -> None:
+        '''Run the function of a stage'''
+        try:
+            with timer:
+                stage.result = stage.function(timer)
+            stage.succeeded = timer.succeeded
+        except Exception as e:
+            logging.error("Stage %s failed: %s", stage.name, str(e))
+
+    def _run_stage(self, stage: Stage) -> None:
+        '''Wait for the dependencies of a stage and run it within its deadline'''
+        try:
+            for dependency in stage.depends_on:
+                self.stages[dependency].finished.wait()
+
+            deadline = self.stage_deadline(stage)
+            if deadline is not None and deadline <= monotonic():
+                logging.warning("Skipping stage %s, not enough time left.", stage.name)
+                self.data.setdefault("skipped_stages", []).append(stage.name)
+                return
+
+            timer = StageTimer(self.data, stage.name, deadline)
+            worker = Thread(target=self._run_function, args=(stage, timer), name=f"{stage.name}_worker", daemon=True)
+            worker.start()
+            worker.join(None if deadline is None else deadline - monotonic())
+
+            if worker.is_alive():
+                timer.cancelled = True
+                logging.warning("Stage %s did not finish in time.", stage.name)
+                self.data[f"t_{stage.name}"] = round(monotonic() - timer.start_time, 2)
+                self.data.setdefault("timed_out_stages", []).append(stage.name)
+
+                if stage.on_timeout is not None:
+                    stage.on_timeout()
+        except Exception as e:
+            logging.error("Stage %s failed: %s", stage.name, str(e))
+        finally:
+            stage.finished.set()
+
+    def run(self) -> dict:
+        '''Run all stages and wait until they have finished or timed out. Returns the results of the stages.'''
+        threads = []
+        for stage in self.stages.values():
+            # Daemon threads so a hung stage can never keep the Raspberry Pi from shutting down
+            thread = Thread(target=self._run_stage, args=(stage,), name=stage.name, daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return {name: stage.result for name, stage in self.stages.items()}
+
+    def succeeded(self, name: str) -> bool:
+        '''Check if a stage has finished successfully'''
+        return self.stages[name].succeeded
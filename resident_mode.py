@@ -0,0 +1,144 @@
+'''Warm standby mode in which the camera stays configured and captures at short intervals'''
+from io import BytesIO
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+from time import monotonic, sleep
+import logging
+
+class ResidentMode:
+    '''Keep the camera started and capture every interval_seconds while should_continue() is true.
+    Each picture is captured to memory and handed to upload_function(filename, buffer) in a background thread, so slow
+    uploads never delay the next capture. Pictures which are not uploaded are passed to save_function(filename, buffer),
+    e.g. to keep them in the spool for the next wake cycle. close_function() is called by the upload thread once it
+    is done, so the upload session is never used by two threads.'''
+
+    CONDITION_CHECK_INTERVAL = 60 # Seconds between checks of should_continue (e.g. battery voltage)
+    MAX_QUEUED = 4 # Pictures waiting for the upload, further pictures are saved directly
+
+    def __init__(self, camera, capture_config, filename_function, upload_function, save_function, should_continue,
+                 interval_seconds: float = 30, max_duration_seconds: float = 3600, close_function = None) -> None:
+        self.camera = camera
+        self.capture_config = capture_config
+        self.filename_function = filename_function # Returns the filename of the next picture
+        self.upload_function = upload_function # Returns True if the picture was uploaded
+        self.save_function = save_function
+        self.close_function = close_function
+        self.should_continue = should_continue
+        self.interval_seconds = interval_seconds
+        self.max_duration_seconds = max_duration_seconds
+        self.uploads = Queue(maxsize=self.MAX_QUEUED)
+        self.stopped = Event()
+        self.in_flight = None # (filename, buffer) which is being uploaded
+        self.captures = 0
+        self.uploaded = 0
+        self.saved = 0
+        self.failed_captures = 0
+
+    def save(self, filename: str, buffer: BytesIO) -> None:
+        '''Keep a picture which was not uploaded'''
+        try:
+            self.save_function(filename, buffer)
+            self.saved += 1
+        except Exception as e:
+            logging.error("Could not save %s: %s", filename, str(e))
+
+    def _save_queued(self) -> None:
+        '''Save the pictures which are still waiting for the upload'''
+        while True:
+            try:
+                self.save(*self.uploads.get_nowait())
+            except Empty:
+                return
+
+    def _upload_worker(self) -> None:
+        '''Upload captured pictures until the capture loop stopped, then save the remaining ones and close the session'''
+        try:
+            while not self.stopped.is_set():
+                try:
+                    filename, buffer = self.uploads.get(timeout=0.1)
+                except Empty:
+                    continue
+
+                self.in_flight = (filename, buffer)
+                try:
+                    if self.upload_function(filename, buffer):
+                        self.uploaded += 1
+                    else:
+                        self.save(filename, buffer)
+                except Exception as e:
+                    logging.warning("Could not upload %s: %s", filename, str(e))
+                    self.save(filename, buffer)
+                finally:
+                    self.in_flight = None
+
+            self._save_queued()
+        finally:
+            if self.close_function is not None:
+                try:
+                    self.close_function()
+                except Exception as e:
+                    logging.warning("Could not close upload session: %s", str(e))
+
+    def capture(self) -> tuple:
+        '''Capture a picture to memory with the running camera, returns (filename, buffer) or None'''
+        filename = self.filename_function()
+        try:
+            buffer = BytesIO()
+            self.camera.capture_file(buffer, format="jpeg")
+            self.captures += 1
+            return filename, buffer
+        except Exception as e:
+            self.failed_captures += 1
+            logging.error("Could not capture image in resident mode: %s", str(e))
+            return None
+
+    def run(self, upload_timeout: float = 60) -> int:
+        '''Capture until should_continue() is false or the maximum duration passed. Returns the number of captures.'''
+        start_time = monotonic()
+        last_check = start_time
+        uploader = Thread(target=self._upload_worker, name="resident_uploader", daemon=True)
+        uploader.start()
+
+        try:
+            self.camera.configure(self.capture_config)
+            self.camera.start()
+            logging.info("Resident mode started, capturing every %s s.", self.interval_seconds)
+
+            next_capture = monotonic()
+            while monotonic() - start_time < self.max_duration_seconds:
+                if monotonic() - last_check >= self.CONDITION_CHECK_INTERVAL:
+                    last_check = monotonic()
+                    if not self.should_continue():
+                        logging.info("Conditions for resident mode no longer met.")
+                        break
+
+                picture = self.capture()
+                if picture is not None:
+                    try:
+                        self.uploads.put_nowait(picture)
+                    except Full:
+                        logging.info("Upload queue full, saving %s.", picture[0])
+                        self.save(*picture)
+
+                # Fixed rate, a slow capture shortens the next wait
+                next_capture += self.interval_seconds
+                sleep(max(0.0, next_capture - monotonic()))
+        finally:
+            self.stopped.set()
+            try:
+                self.camera.stop()
+            except Exception as e:
+                logging.warning("Could not stop camera: %s", str(e))
+
+            uploader.join(upload_timeout)
+            if uploader.is_alive():
+                # The upload thread keeps its session, the pictures it did not finish are saved here
+                logging.warning("Upload in resident mode did not finish in time.")
+                in_flight = self.in_flight
+                if in_flight is not None:
+                    self.save(*in_flight)
+                self._save_queued()
+
+            logging.info("Resident mode stopped after %s captures (%s uploaded, %s saved).", self.captures, self.uploaded, self.saved)
+
+        return self.captures
@@ -0,0 +1,205 @@
+'''Compile capture windows into a compact Witty Pi schedule and simulate schedules to check them'''
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+import re
+
+KEEPALIVE_MINUTE = 12 * 60 # Days without any window still get a wake at noon so settings can be downloaded
+DURATION_UNITS = {"D": 86400, "H": 3600, "M": 60, "S": 1}
+
+@dataclass
+class CaptureWindow:
+    '''Take a picture every interval_minutes between start_minute and end_minute (minutes after midnight, end included).
+    Windows with end_minute < start_minute continue after midnight. Dates are "MM-DD" (every year) or "YYYY-MM-DD",
+    weekdays are 0 (Monday) to 6 (Sunday).'''
+    start_minute: int
+    end_minute: int
+    interval_minutes: int
+    start_date: str = None
+    end_date: str = None
+    weekdays: list = field(default_factory=lambda: list(range(7)))
+
+    @staticmethod
+    def parse_time(value: str) -> int:
+        '''Parse "HH:MM" into minutes after midnight'''
+        # YAML reads unquoted 10:00 as sexagesimal number (600), which are the minutes after midnight
+        if isinstance(value, int):
+            value = f"{value // 60}:{value % 60}"
+
+        hour, minute = (int(part) for part in str(value).split(":"))
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(f"Invalid time {value}")
+        return hour * 60 + minute
+
+    @classmethod
+    def from_dict(cls, window: dict):
+        '''Create a window from the settings, e.g. {start: "10:00", end: "14:00", interval: 10, dates: ["06-01", "08-31"], weekdays: [0, 2, 4]}'''
+        interval_minutes = int(window["interval"])
+        if interval_minutes < 1:
+            raise ValueError(f"Invalid interval {interval_minutes}")
+
+        dates = window.get("dates") or [None, None]
+        weekdays = [int(weekday) for weekday in window.get("weekdays", range(7))]
+        if len(dates) != 2 or any(not 0 <= weekday <= 6 for weekday in weekdays):
+            raise ValueError(f"Invalid window {window}")
+
+        capture_window = cls(cls.parse_time(window["start"]), cls.parse_time(window["end"]), interval_minutes, dates[0], dates[1], weekdays)
+        capture_window.is_active(date(2020, 1, 1)) # Validates the dates
+        return capture_window
+
+    @staticmethod
+    def _date_key(value: str, day: date) -> tuple:
+        '''Compare recurring dates by month and day, full dates by year, month and day'''
+        parts = [int(part) for part in value.split("-")]
+        if len(parts) == 2:
+            date(2020, *parts) # Validate, 2020 is a leap year
+            return tuple(parts), (day.month, day.day)
+
+        return tuple(date(*parts).timetuple()[:3]), day.timetuple()[:3]
+
+    def is_active(self, day: date) -> bool:
+        '''Check if the window starts on a day'''
+        if day.weekday() not in self.weekdays:
+            return False
+
+        after_start = self.start_date is None
+        before_end = self.end_date is None
+
+        if self.start_date is not None:
+            start_key, day_key = self._date_key(self.start_date, day)
+            after_start = day_key >= start_key
+
+        if self.end_date is not None:
+            end_key, day_key = self._date_key(self.end_date, day)
+            before_end = day_key <= end_key
+
+        # Recurring seasons can wrap around new year (e.g. 11-01 to 02-28)
+        if self.start_date is not None and self.end_date is not None and self._date_key(self.start_date, day)[0] > self._date_key(self.end_date, day)[0]:
+            return after_start or before_end
+
+        return after_start and before_end
+
+    def wake_minutes(self) -> range:
+        '''Minutes after midnight of the day the window starts on at which a picture is taken'''
+        end_minute = self.end_minute if self.end_minute >= self.start_minute else self.end_minute + 1440
+        return range(self.start_minute, end_minute + 1, self.interval_minutes)
+
+def format_duration(minutes: int) -> str:
+    '''Format a duration for a Witty Pi schedule, e.g. 1505 -> "D1 H1 M5"'''
+    days, minutes = divmod(minutes, 1440)
+    hours, minutes = divmod(minutes, 60)
+    parts = [f"D{days}"] if days else []
+    if hours:
+        parts.append(f"H{hours}")
+    if minutes or not parts:
+        parts.append(f"M{minutes}")
+    return " ".join(parts)
+
+def schedule_from_wake_times(times: list, period: timedelta, on_minutes: int) -> str:
+    '''Generate a Witty Pi schedule which wakes at the given times for on_minutes. The schedule repeats after period,
+    so it keeps waking the camera (with slowly drifting times) if it is not rewritten.'''
+    # 2037 is the maximum year for WittyPi
+    schedule = f"BEGIN\t{times[0]:%Y-%m-%d %H:%M}:00\nEND\t2037-12-31 23:59:59\n"
+
+    for i, wake_time in enumerate(times):
+        next_wake_time = times[i + 1] if i + 1 < len(times) else times[0] + period
+        off_minutes = int((next_wake_time - wake_time).total_seconds() // 60) - on_minutes
+        schedule += f"ON\tM{on_minutes}\nOFF\t{format_duration(max(1, off_minutes))}"
+        if i + 1 < len(times):
+            schedule += "\n"
+
+    return schedule
+
+def parse_duration(value: str) -> timedelta:
+    '''Parse a Witty Pi duration, e.g. "D1 H1 M5"'''
+    seconds = sum(int(amount) * DURATION_UNITS[unit] for unit, amount in re.findall(r"([DHMS])(\d+)", value))
+    return timedelta(seconds=seconds)
+
+def simulate(schedule: str, start: datetime, end: datetime) -> list:
+    '''Expand a Witty Pi schedule into the times between start and end at which it turns the Raspberry Pi on'''
+    begin = None
+    schedule_end = datetime(2037, 12, 31, 23, 59, 59)
+    states = []
+
+    for line in schedule.splitlines():
+        parts = line.split(None, 1)
+        if not parts:
+            continue
+
+        if parts[0] == "BEGIN":
+            begin = datetime.strptime(parts[1].strip(), "%Y-%m-%d %H:%M:%S")
+        elif parts[0] == "END":
+            schedule_end = datetime.strptime(parts[1].strip(), "%Y-%m-%d %H:%M:%S")
+        elif parts[0] in ("ON", "OFF"):
+            states.append((parts[0], parse_duration(parts[1])))
+
+    if begin is None or not states or sum((duration for _, duration in states), timedelta()) <= timedelta():
+        raise ValueError("Invalid schedule")
+
+    times = []
+    current = begin
+    end = min(end, schedule_end)
+
+    while current < end:
+        for state, duration in states:
+            if state == "ON" and start <= current < end:
+                times.append(current)
+            current += duration
+
+    return times
+
+def wake_times(windows: list, first_day: date, days: int, min_gap_minutes: int, max_per_day: int = None) -> list:
+    '''Get the merged wake times of all windows. Wakes closer than min_gap_minutes to the previous one are dropped.'''
+    times = set()
+
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        midnight = datetime(day.year, day.month, day.day)
+        day_times = sorted({midnight + timedelta(minutes=minute) for window in windows if window.is_active(day) for minute in window.wake_minutes()})
+
+        if not day_times:
+            day_times = [midnight + timedelta(minutes=KEEPALIVE_MINUTE)]
+
+        times.update(day_times[:max_per_day] if max_per_day is not None else day_times)
+
+    merged_times = []
+    for wake_time in sorted(times):
+        if not merged_times or wake_time - merged_times[-1] >= timedelta(minutes=min_gap_minutes):
+            merged_times.append(wake_time)
+
+    return merged_times
+
+def find_period(times: list, first_day: date, days: int) -> int:
+    '''Get the shortest period in days (1, 7 or days) after which the wake times repeat'''
+    start = datetime(first_day.year, first_day.month, first_day.day)
+    offsets = [wake_time - start for wake_time in times]
+
+    for period in (1, 7):
+        if period >= days or days % period:
+            continue
+
+        first_period = [offset for offset in offsets if offset < timedelta(days=period)]
+        expected = [offset + timedelta(days=repetition*period) for repetition in range(days // period) for offset in first_period]
+        if expected == offsets:
+            return period
+
+    return days
+
+def compile_schedule(windows: list, today: date, days: int = 7, on_minutes: int = 4, max_per_day: int = None) -> str:
+    '''Compile the windows into the shortest schedule which produces their wake times for a block of days.
+    The block starts on a fixed day, so the schedule only changes once per block. The result is checked with simulate.'''
+    first_day = date.fromordinal(today.toordinal() // days * days)
+    block_start = datetime(first_day.year, first_day.month, first_day.day)
+    block_end = block_start + timedelta(days=days)
+
+    # Include windows of the day before which continue after midnight
+    times = wake_times(windows, first_day - timedelta(days=1), days + 1, on_minutes + 1, max_per_day)
+    times = [wake_time for wake_time in times if block_start <= wake_time < block_end]
+    period = find_period(times, first_day, days)
+
+    first_period_end = block_start + timedelta(days=period)
+    schedule = schedule_from_wake_times([wake_time for wake_time in times if wake_time < first_period_end], timedelta(days=period), on_minutes)
+
+    if simulate(schedule, block_start, block_start + timedelta(days=days)) != times:
+        raise ValueError("Compiled schedule does not match the windows")
+
+    return schedule
@@ -27,7 +27,7 @@ sudo apt-get install -y $PACKAGES
 sudo apt-get autoremove -y
 
 # Install required Python packages
-sudo pip3 install pyserial pyyaml suntime
+sudo pip3 install pyserial pyyaml suntime smbus2 numpy
 
 echo ''
 echo '================================================================================'
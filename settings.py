@@ -16,20 +16,38 @@ class Settings:
         'intervalMinutes': {'type': int, 'min': 1, 'max': 59, 'default': 30},
         'repetitionsPerday': {'type': int, 'min': 1, 'max': 96, 'default': 1},
         'timeSync': {'type': bool, 'default': False},
+        'timeSyncMaxDriftSeconds': {'type': float, 'min': 0.0, 'max': 3600.0, 'default': 2.0},
         'enableGPS': {'type': bool, 'default': False},
+        'gpsReacquireWakes': {'type': int, 'min': 1, 'max': 10000, 'default': 48},
+        'gpsReacquireHours': {'type': float, 'min': 0.0, 'max': 8760.0, 'default': 168.0},
+        'gpsMaxHdop': {'type': float, 'min': 0.0, 'max': 100.0, 'default': 5.0},
+        'gpsAssistance': {'type': bool, 'default': True},
         'location_overwrite': {'type': bool, 'default': False},
         'latitude': {'type': float, 'min': -90, 'max': 90, 'default': 0.0},
         'longitude': {'type': float, 'min': -180, 'max': 180, 'default': 0.0},
         'enableSunriseSunset': {'type': bool, 'default': False},
+        'civilTwilight': {'type': bool, 'default': False},
+        'scheduleDays': {'type': int, 'min': 1, 'max': 28, 'default': 7},
+        'scheduleWindows': {'type': list, 'default': []},
         'logLevel': {'type': str, 'valid_values': ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], 'default': 'INFO'},
         'uploadWittyPiDiagnostics': {'type': bool, 'default': False},
+        'compressLogs': {'type': bool, 'default': False},
+        'bundleDiagnostics': {'type': bool, 'default': False},
+        'uploadBudgetMegabytes': {'type': float, 'min': 0.0, 'max': 1000.0, 'default': 20.0},
+        'uploadBlockSizeKilobytes': {'type': int, 'min': 1, 'max': 1024, 'default': 8},
+        'uploadSessions': {'type': int, 'min': 1, 'max': 8, 'default': 1},
         'low_voltage_threshold': {'type': float, 'min': 0.0, 'max': 30.0, 'default': 0.0},
         'recovery_voltage_threshold': {'type': float, 'min': 0.0, 'max': 30.0, 'default': 0.0},
         'battery_voltage_half' : {'type': float, 'min': 0, 'max': 30, 'default': 12.0},
+        'residentMode': {'type': bool, 'default': False},
+        'residentIntervalSeconds': {'type': int, 'min': 5, 'max': 3600, 'default': 30},
+        'residentMinBatteryVoltage': {'type': float, 'min': 0.0, 'max': 30.0, 'default': 12.6},
+        'residentMaxMinutes': {'type': int, 'min': 1, 'max': 1440, 'default': 60},
         'shutdown': {'type': bool, 'default': True},
     }
 
-    def __init__(self, settings_filename: str = "settings.yaml") -> None:
+    def __init__(self, settings_filename: str = "settings.yaml", validate: bool = True) -> None:
+        '''Load the settings. Settings saved after validation (see save_to_file) can be loaded with validate=False.'''
 
         self.valid_settings = True
 
@@ -41,7 +59,9 @@ class Settings:
             self.settings = {}
             self.valid_settings = False
 
-        self.validate()
+        # Validate anyway if settings were added since the file was saved
+        if validate or not isinstance(self.settings, dict) or not set(self.settings_to_check) <= set(self.settings):
+            self.validate()
 
     def validate(self) -> bool:
         '''Load the settings and validate them'''
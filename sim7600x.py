@@ -1,32 +1,125 @@
 '''Class for the SIM7600X 4G module'''
-from time import sleep
+from time import sleep, monotonic
+from threading import Lock, Thread, Event, current_thread
+from queue import Queue, Empty
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 import logging
 import serial
 
+@dataclass
+class ModemStatus:
+    '''Link quality and state of the SIM7600X, read in a single exchange (see SIM7600X.get_modem_status)'''
+    csq: int = 99 # 0...31, 99 = unknown
+    rssi: int = None # dBm, from CSQ
+    registration_status: int = -1 # See parse_registration_status
+    access_technology: str = None # E.g. LTE, WCDMA or GSM
+    operator: str = None
+    cell_id: str = None # <MCC-MNC>:<LAC/TAC>:<cell ID>
+    rsrp: float = None # dBm (LTE only)
+    rsrq: float = None # dB (LTE only)
+    sinr: float = None # dB (LTE only)
+    clock: str = None # Modem clock in UTC (ISO 8601)
+
 class SIM7600X:
     '''Class for the SIM7600X 4G module'''
+
+    # Network states, used to decide if and how fast to connect to the file server
+    NETWORK_UNKNOWN = "unknown" # Module did not answer
+    NETWORK_NONE = "none" # No network (e.g. no SIM card or registration denied)
+    NETWORK_IDLE = "idle" # Not registered and not searching (yet), e.g. right after the module was powered on
+    NETWORK_SEARCHING = "searching"
+    NETWORK_MARGINAL = "marginal" # Registered but weak signal or no data connection yet
+    NETWORK_READY = "ready"
+    MARGINAL_SIGNAL_QUALITY = 10 # CSQ below approx. -93 dBm
+    POLL_INTERVAL = 0.005 # Seconds between checks for new data on the serial port
+    NTP_SERVER = "pool.ntp.org"
+    MIN_VALID_YEAR = 2024 # The modem clock starts in 1980 until it was set
+    MAX_TIME_DIFFERENCE = 10 # Seconds between network and GPS time before GPS time is preferred
+
     def __init__(self, port: str = '/dev/ttyUSB2', baudrate: int = 115200, timeout: int = 5):
         '''Initialize SIM7600X'''
+        self.lock = Lock() # Serial port is shared between the stages of the wake cycle
+        self.gps_attempts = 0
+        self.service = None
+        self.gps_start_time = None # Monotonic times to measure the time to first fix
+        self.gps_fix_time = None
+        self.ser = None
         try:
-            self.ser = serial.Serial(port, baudrate, timeout=timeout) # USB connection
+            self.ser = serial.Serial(port, baudrate, timeout=timeout, write_timeout=timeout) # USB connection
             self.ser.flushInput()
         except Exception as e:
             logging.error("Could not initialize SIM7600X: %s", str(e))
 
-    # Send AT command to SIM7600X
-    def send_at_command(self, command: str, back: str = 'OK', timeout: int = 1) -> str:
-        '''Send an AT command to SIM7600X'''
-        rec_buff = ''
+    @staticmethod
+    def is_final_response(response: str) -> bool:
+        '''Check if a response contains a final result code (OK, ERROR, +CME ERROR or +CMS ERROR)'''
+        for line in response.splitlines():
+            line = line.strip()
+            if line in ("OK", "ERROR") or line.startswith("+CME ERROR") or line.startswith("+CMS ERROR"):
+                return True
+        return False
+
+    @staticmethod
+    def is_error_response(response: str) -> bool:
+        '''Check if a response contains an error result code'''
+        for line in response.splitlines():
+            line = line.strip()
+            if line == "ERROR" or line.startswith("+CME ERROR") or line.startswith("+CMS ERROR"):
+                return True
+        return False
+
+    def exchange(self, command: str, back: str = 'OK', timeout: float = 1) -> str:
+        '''Write an AT command and read the raw response until the final result code and the expected
+        text (back) were received, an error was returned or the timeout (seconds) passed'''
+        response = ""
         self.ser.write((command+'\r\n').encode())
-        sleep(timeout)
-        if self.ser.inWaiting():
-            sleep(0.01)
-            rec_buff = self.ser.read(self.ser.inWaiting())
-        if back not in rec_buff.decode():
-            logging.error("Error: AT command %s returned %s", command, rec_buff.decode())
-            return ""
+        deadline = monotonic() + timeout
+
+        while monotonic() < deadline:
+            waiting = self.ser.inWaiting()
+            if not waiting:
+                sleep(self.POLL_INTERVAL)
+                continue
+
+            response += self.ser.read(waiting).decode(errors='ignore')
+
+            # Some results arrive after OK (e.g. +CNTP: 0), keep reading until they arrived
+            if self.is_error_response(response) or (self.is_final_response(response) and back in response):
+                break
+
+        return response
+
+    # Send AT command to SIM7600X
+    def send_at_command(self, command: str, back: str = 'OK', timeout: float = 1, partial: bool = False) -> str:
+        '''Send an AT command to SIM7600X, through the background service if it is running. With partial, the response
+        is returned even if it contains an error, e.g. for commands concatenated with ";" which the module aborts at
+        the first failing command, so the results which arrived before can still be parsed.'''
+        if self.service is not None and self.service.running.is_set() and current_thread() is not self.service.thread:
+            try:
+                response = self.service.submit(command, back, timeout).result(timeout=timeout + ModemService.QUEUE_TIMEOUT)
+            except FutureTimeoutError:
+                logging.error("Error: AT command %s was not sent within %s s", command, timeout + ModemService.QUEUE_TIMEOUT)
+                return ""
+        else:
+            with self.lock:
+                response = self.exchange(command, back, timeout)
+
+        if back not in response:
+            logging.error("Error: AT command %s returned %s", command, response)
+            return response if partial else ""
 
-        return rec_buff.decode()
+        return response
+
+    @staticmethod
+    def is_sim_missing(response: str) -> bool:
+        '''Check if a response contains the error for a missing SIM card (+CME ERROR: 10)'''
+        for line in response.splitlines():
+            line = line.strip()
+            if line in ("+CME ERROR: 10", "+CME ERROR: SIM not inserted"):
+                return True
+        return False
 
     # Get current signal quality
     # https://www.manualslib.com/download/1593302/Simcom-Sim7000-Series.html
@@ -38,77 +131,542 @@ class SIM7600X:
     def get_signal_quality(self):
         '''Gets the current signal quality from the SIM7600G-H 4G module'''
         try:
-            signal_quality = self.send_at_command('AT+CSQ')
-            signal_quality = signal_quality[8:10]
-            signal_quality = signal_quality.replace("\n", "")
-            signal_quality = ''.join(ch for ch in signal_quality if ch.isdigit()) # Remove non-numeric characters
+            signal_quality = str(self.parse_signal_quality(self.send_at_command('AT+CSQ')))
             logging.info("Current signal quality: %s", signal_quality)
             return signal_quality
         except Exception as e:
             logging.error("Could not get current signal quality: %s", str(e))
             return ""
 
+    @staticmethod
+    def parse_signal_quality(response: str) -> int:
+        '''Parse the RSSI from a +CSQ: <rssi>,<ber> response (99 if unknown)'''
+        for line in response.splitlines():
+            if line.startswith("+CSQ:"):
+                try:
+                    return int(line[5:].split(",")[0])
+                except ValueError:
+                    break
+        return 99
+
+    @staticmethod
+    def parse_registration_status(response: str) -> int:
+        '''Parse the best registration status of +CREG: <n>,<stat> and +CEREG: <n>,<stat> responses (-1 if unknown).
+        0 = not searching, 1 = registered (home), 2 = searching, 3 = denied, 4 = unknown, 5 = registered (roaming)'''
+        statuses = []
+        for line in response.splitlines():
+            if line.startswith("+CREG:") or line.startswith("+CEREG:"):
+                try:
+                    statuses.append(int(line.split(":")[1].split(",")[1]))
+                except (IndexError, ValueError):
+                    continue
+
+        for status in (1, 5, 2, 4, 0, 3): # Best first
+            if status in statuses:
+                return status
+        return -1
+
+    @staticmethod
+    def parse_pdp_context_active(response: str) -> bool:
+        '''Check if any PDP context is active in a +CGACT: <cid>,<state> response'''
+        for line in response.splitlines():
+            if line.startswith("+CGACT:") and line.replace(" ", "").endswith(",1"):
+                return True
+        return False
+
+    @staticmethod
+    def parse_cell_id(response: str) -> str:
+        '''Parse the serving cell as "<MCC-MNC>:<LAC/TAC>:<cell ID>" from a +CPSI: response (None if there is no service)
+        Format: +CPSI: <system mode>,<operation mode>,<MCC-MNC>,<LAC/TAC>,<cell ID>,...'''
+        for line in response.splitlines():
+            if line.startswith("+CPSI:"):
+                fields = [field.strip() for field in line[6:].split(",")]
+                if len(fields) < 5 or fields[0] == "NO SERVICE":
+                    return None
+                return f"{fields[2]}:{fields[3]}:{fields[4]}"
+        return None
+
+    def get_cell_id(self) -> str:
+        '''Get the serving cell, a cheap hint whether the camera was moved (None if unknown)'''
+        try:
+            return self.parse_cell_id(self.send_at_command('AT+CPSI?', back='+CPSI:'))
+        except Exception as e:
+            logging.error("Could not get serving cell: %s", str(e))
+            return None
+
+    @staticmethod
+    def parse_operator(response: str) -> str:
+        '''Parse the operator name from a +COPS: <mode>,<format>,"<operator>",<AcT> response (None if not registered)'''
+        for line in response.splitlines():
+            if line.startswith("+COPS:"):
+                fields = line[6:].strip().split(",")
+                if len(fields) >= 3:
+                    return fields[2].strip('"')
+        return None
+
+    @staticmethod
+    def parse_clock(response: str) -> datetime:
+        '''Parse the modem clock from a +CCLK: "yy/MM/dd,hh:mm:ss±zz" response as UTC (zz is in quarter hours, None if invalid)'''
+        for line in response.splitlines():
+            if line.startswith("+CCLK:"):
+                value = line[6:].strip().strip('"')
+                try:
+                    local_time = datetime.strptime(value[:17], "%y/%m/%d,%H:%M:%S")
+                    offset = timedelta(minutes=15*int(value[17:] or 0))
+                except ValueError:
+                    return None
+                return (local_time - offset).replace(tzinfo=timezone.utc)
+        return None
+
+    @staticmethod
+    def parse_modem_status(response: str) -> ModemStatus:
+        '''Parse the responses of AT+CSQ;+CREG?;+CEREG?;+COPS?;+CPSI?;+CCLK? into a ModemStatus'''
+        status = ModemStatus()
+        status.csq = SIM7600X.parse_signal_quality(response)
+        if status.csq <= 31:
+            status.rssi = -113 + 2*status.csq
+
+        status.registration_status = SIM7600X.parse_registration_status(response)
+        status.operator = SIM7600X.parse_operator(response)
+        status.cell_id = SIM7600X.parse_cell_id(response)
+
+        clock = SIM7600X.parse_clock(response)
+        status.clock = clock.isoformat() if clock is not None else None
+
+        # +CPSI: LTE,Online,<MCC-MNC>,<TAC>,<cell ID>,<PCI>,<band>,<EARFCN>,<DL bw>,<UL bw>,<RSRQ>,<RSRP>,<RSSI>,<RSSNR>
+        # RSRQ, RSRP and RSSI are in 1/10 dB(m)
+        for line in response.splitlines():
+            if line.startswith("+CPSI:"):
+                fields = [field.strip() for field in line[6:].split(",")]
+                if fields[0] != "NO SERVICE":
+                    status.access_technology = fields[0]
+                if fields[0] == "LTE" and len(fields) >= 14:
+                    try:
+                        status.rsrq = int(fields[10]) / 10
+                        status.rsrp = int(fields[11]) / 10
+                        status.sinr = float(fields[13])
+                    except ValueError:
+                        pass
+
+        return status
+
+    @staticmethod
+    def parse_gps_time(response: str) -> datetime:
+        '''Parse the UTC time of the last fix from a +CGPSINFO response (None if there is no fix)'''
+        for line in response.splitlines():
+            if line.startswith("+CGPSINFO:"):
+                fields = line[10:].strip().split(",")
+                try:
+                    return datetime.strptime(fields[4] + fields[5][:6], "%d%m%y%H%M%S").replace(tzinfo=timezone.utc)
+                except (ValueError, IndexError):
+                    return None
+        return None
+
+    def get_network_time(self, use_ntp: bool = True) -> datetime:
+        '''Get the UTC time of the modem clock, which is set by the network (NITZ). If the network did not send
+        the time, the clock is synchronized with NTP (AT+CNTP) first. None if the time is unknown.'''
+        try:
+            network_time = self.parse_clock(self.send_at_command('AT+CCLK?', back='+CCLK:'))
+
+            if (network_time is None or network_time.year < self.MIN_VALID_YEAR) and use_ntp:
+                logging.info("Modem clock not set by network, synchronizing with NTP.")
+                self.send_at_command(f'AT+CNTP="{self.NTP_SERVER}",0')
+                if "+CNTP: 0" in self.send_at_command('AT+CNTP', back='+CNTP:', timeout=10):
+                    network_time = self.parse_clock(self.send_at_command('AT+CCLK?', back='+CCLK:'))
+
+            if network_time is None or network_time.year < self.MIN_VALID_YEAR:
+                return None
+
+            return network_time
+        except Exception as e:
+            logging.error("Could not get network time: %s", str(e))
+            return None
+
+    def get_utc_time(self, use_gps: bool = False) -> datetime:
+        '''Get the current UTC time from the network. With use_gps, the time is cross-checked against the time of the
+        current GPS fix, which is used if they disagree by more than MAX_TIME_DIFFERENCE or there is no network time.
+        None if the time is unknown.'''
+        network_time = self.get_network_time()
+
+        if not use_gps:
+            return network_time
+
+        gps_time = self.parse_gps_time(self.send_at_command('AT+CGPSINFO', back='+CGPSINFO:'))
+        if gps_time is None:
+            return network_time
+
+        if network_time is None:
+            return gps_time
+
+        if abs((network_time - gps_time).total_seconds()) > self.MAX_TIME_DIFFERENCE:
+            logging.warning("Network time %s differs from GPS time %s, using GPS time.", network_time, gps_time)
+            return gps_time
+
+        return network_time
+
+    def get_modem_status(self) -> ModemStatus:
+        '''Get signal quality, registration, operator, serving cell and clock in a single exchange.
+        Fields after a command which failed (e.g. +COPS? without SIM card) keep their defaults.'''
+        try:
+            response = self.send_at_command('AT+CSQ;+CREG?;+CEREG?;+COPS?;+CPSI?;+CCLK?', partial=True)
+            status = self.parse_modem_status(response)
+            logging.info("Modem status: %s", status)
+            return status
+        except Exception as e:
+            logging.error("Could not get modem status: %s", str(e))
+            return ModemStatus()
+
+    def get_network_state(self) -> str:
+        '''Get the network state from signal quality, network registration and PDP context in a single exchange'''
+        try:
+            response = self.send_at_command('AT+CSQ;+CREG?;+CEREG?;+CGACT?', partial=True)
+            if response == "":
+                return self.NETWORK_UNKNOWN
+
+            if self.is_sim_missing(response):
+                logging.error("No SIM card inserted.")
+                return self.NETWORK_NONE
+
+            signal_quality = self.parse_signal_quality(response)
+            registration_status = self.parse_registration_status(response)
+            logging.info("Signal quality: %s, registration status: %s", signal_quality, registration_status)
+
+            if registration_status == 3:
+                return self.NETWORK_NONE
+
+            if registration_status == 0:
+                return self.NETWORK_IDLE
+
+            if registration_status == 2:
+                return self.NETWORK_SEARCHING
+
+            if registration_status not in (1, 5):
+                return self.NETWORK_UNKNOWN
+
+            if signal_quality == 99 or signal_quality < self.MARGINAL_SIGNAL_QUALITY or not self.parse_pdp_context_active(response):
+                return self.NETWORK_MARGINAL
+
+            return self.NETWORK_READY
+        except Exception as e:
+            logging.error("Could not get network state: %s", str(e))
+            return self.NETWORK_UNKNOWN
+
+    @staticmethod
+    def parse_gps_position(response: str) -> tuple:
+        '''Parse latitude, longitude and height from a +CGPSINFO response (None if there is no fix yet).
+        Format: +CGPSINFO: <lat>,<N/S>,<lon>,<E/W>,<date>,<UTC time>,<alt>,<speed>,<course>'''
+        for line in response.splitlines():
+            if not line.startswith("+CGPSINFO:"):
+                continue
+
+            fields = line[10:].strip().split(",")
+            if len(fields) < 7 or fields[0] == "":
+                return None
+
+            # Latitude ddmm.mmmmmm and longitude dddmm.mmmmmm
+            # See: https://core-electronics.com.au/guides/raspberry-pi/raspberry-pi-4g-gps-hat/
+            lat = float(fields[0][:2]) + float(fields[0][2:])/60
+            lon = float(fields[2][:3]) + float(fields[2][3:])/60
+
+            if fields[1] == 'S':
+                lat = -lat
+            if fields[3] == 'W':
+                lon = -lon
+
+            return str(round(lat, 5)), str(round(lon, 5)), fields[6]
+
+        return None
+
+    @staticmethod
+    def parse_hdop(response: str) -> float:
+        '''Parse the HDOP from a +CGNSSINFO response (None if there is no fix yet)
+        Format: +CGNSSINFO: <mode>,<satellites>,...,<speed>,<course>,<PDOP>,<HDOP>,<VDOP>'''
+        for line in response.splitlines():
+            if line.startswith("+CGNSSINFO:"):
+                try:
+                    # Number of satellite fields depends on the firmware, count from the end
+                    return float(line[11:].strip().split(",")[-2])
+                except (ValueError, IndexError):
+                    return None
+        return None
+
+    def get_gps_hdop(self) -> float:
+        '''Get the horizontal dilution of precision of the current fix (None if unknown)'''
+        try:
+            return self.parse_hdop(self.send_at_command('AT+CGNSSINFO', back='+CGNSSINFO:'))
+        except Exception as e:
+            logging.error("Could not get HDOP: %s", str(e))
+            return None
+
     # Get GPS Position
     def get_gps_position(self, max_attempts=7, delay=5):
         '''Gets the current GPS position from the SIM7600G-H 4G module'''
 
+        # Position was already acquired in the background
+        if self.service is not None and self.service.gps_fix.done():
+            return self.service.gps_fix.result()
+
         current_attempt = 0
 
         while current_attempt < max_attempts:
 
             current_attempt += 1
+            self.gps_attempts = current_attempt
             gps_data_raw = self.send_at_command('AT+CGPSINFO', back='+CGPSINFO:')
+            position = self.parse_gps_position(gps_data_raw) if gps_data_raw != "" else None
 
-            if gps_data_raw == "":
-                sleep(delay)
-            elif ',,,,,,' in gps_data_raw:
+            if position is None:
                 logging.info("GPS not yet ready.")
-                sleep(delay)
+                if current_attempt < max_attempts:
+                    sleep(delay)
             else:
-                # Additions to Demo Code Written by Tim! -> Core Electronics
-                # https://core-electronics.com.au/guides/raspberry-pi/raspberry-pi-4g-gps-hat/
-                gps_data_cleaned = str(gps_data_raw)[13:]
+                self.gps_fix_time = monotonic()
+                logging.info("GPS position: LAT %s, LON %s, HEIGHT %s", *position)
+                return position
+        return "-", "-", "-"
 
-                lat = float(gps_data_cleaned[:2]) + (float(gps_data_cleaned[2:11])/60)
-                lon = float(gps_data_cleaned[14:17]) + (float(gps_data_cleaned[17:26])/60)
+    def wait_for_gps_fix(self, timeout: float) -> tuple:
+        '''Wait until the background service got a GPS fix (see start_service), returns ("-", "-", "-") on timeout'''
+        if self.service is None:
+            return self.get_gps_position(max_attempts=max(1, int(timeout // 5)))
 
-                north_or_south = gps_data_cleaned[12]
-                east_or_west = gps_data_cleaned[27]
+        try:
+            return self.service.gps_fix.result(timeout=timeout)
+        except FutureTimeoutError:
+            logging.warning("No GPS fix after %s polls.", self.service.gps_polls)
+            return "-", "-", "-"
 
-                if north_or_south == 'S':
-                    lat = -lat
-                if east_or_west == 'W':
-                    lon = -lon
+    def start_gps_session(self, hot_start: bool = False):
+        '''Starts a GPS session on the SIM7600G-H 4G module. A hot start reuses the stored ephemeris and XTRA data.'''
+        try:
+            logging.info("Starting GPS session (hot start: %s).", hot_start)
+            self.gps_start_time = monotonic()
+            self.gps_fix_time = None
 
-                # TODO Sometimes heigth is not correctly extracted
-                Height = gps_data_cleaned[45:49]
+            if hot_start and self.send_at_command('AT+CGPSHOT') != "":
+                return
 
-                str_lat = str(round(lat, 5))
-                str_lon = str(round(lon, 5))
-                str_height = str(Height)
+            self.send_at_command('AT+CGPS=1,1')
+        except Exception as e:
+            logging.error("Could not start GPS session: %s", str(e))
 
-                # TODO Time
+    def get_gps_ttff(self) -> float:
+        '''Get the time to first fix of the current GPS session in seconds (None if there is no fix)'''
+        if self.gps_start_time is None or self.gps_fix_time is None:
+            return None
 
-                logging.info("GPS position: LAT %s, LON %s, HEIGHT %s", str_lat, str_lon, str_height)
-                return str_lat, str_lon, str_height
-        return "-", "-", "-"
+        return round(self.gps_fix_time - self.gps_start_time, 2)
 
-    def start_gps_session(self):
-        '''Starts a GPS session on the SIM7600G-H 4G module'''
+    def enable_gnss_assistance(self) -> bool:
+        '''Enable XTRA assistance data and its automatic download. The setting is saved in the module.'''
         try:
-            logging.info("Starting GPS session.")
-            self.send_at_command('AT+CGPS=1,1')
+            if "+CGPSXE: 1" in self.send_at_command('AT+CGPSXE?', back='+CGPSXE:'):
+                return True
+
+            logging.info("Enabling XTRA assistance.")
+            return self.send_at_command('AT+CGPSXE=1') != "" and self.send_at_command('AT+CGPSXDAUTO=1') != ""
         except Exception as e:
-            logging.error("Could not start GPS session: %s", str(e))
+            logging.error("Could not enable XTRA assistance: %s", str(e))
+            return False
+
+    def download_xtra(self, timeout: float = 30) -> bool:
+        '''Download the XTRA file over the data connection, the GPS session has to be stopped'''
+        try:
+            # The result (+CGPSXD: 0 on success) arrives after OK once the download has finished
+            response = self.send_at_command('AT+CGPSXD=0', back='+CGPSXD:', timeout=timeout)
+            success = "+CGPSXD: 0" in response
+            if not success:
+                logging.warning("Could not download XTRA file: %s", response.strip())
+            return success
+        except Exception as e:
+            logging.error("Could not download XTRA file: %s", str(e))
+            return False
 
     def stop_gps_session(self):
         '''Stops a GPS session on the SIM7600G-H 4G module'''
         try:
             logging.info("Stopping GPS session.")
+            if self.service is not None:
+                self.service.stop_gps_polling()
             self.send_at_command('AT+CGPS=0')
         except Exception as e:
             logging.error("Could not stop GPS session: %s", str(e))
 
+    def start_service(self) -> None:
+        '''Start the background service which owns the serial port (see ModemService)'''
+        if self.ser is None:
+            logging.warning("Serial port of SIM7600X not open, not starting modem service.")
+            return
+
+        if self.service is None:
+            self.service = ModemService(self)
+        self.service.start()
+
+    def stop_service(self) -> None:
+        '''Stop the background service'''
+        if self.service is not None:
+            self.service.stop()
+
+class ModemService:
+    '''Background worker which owns the serial port of a SIM7600X. AT commands of multiple callers are queued and
+    sent one after the other, unsolicited result codes (URCs) are passed to handlers and the GPS position can be
+    polled in the background while the camera is busy.'''
+
+    IDLE_INTERVAL = 0.05 # Seconds between checks for URCs while no command is queued
+    GPS_POLL_INTERVAL = 2 # Seconds
+    QUEUE_TIMEOUT = 60 # Seconds a command may wait behind others (e.g. an XTRA download)
+    ERROR_LOG_INTERVAL = 60 # Seconds between repeated errors while reading URCs
+
+    def __init__(self, modem: SIM7600X) -> None:
+        self.modem = modem
+        self.commands = Queue()
+        self.urc_handlers = {} # Prefix -> list of handlers
+        self.running = Event()
+        self.thread = None
+        self.gps_thread = None
+        self.gps_polls = 0
+        self.gps_polling = Event() # Cleared when the GPS session is stopped
+        self.gps_fix = Future() # Set to (lat, lon, height) with the first valid fix
+        self.partial_line = ""
+        self.queue_lock = Lock() # No command is queued after the worker stopped
+        self.last_error_time = None
+        self.suppressed_errors = 0
+
+    def start(self) -> None:
+        '''Start the worker thread'''
+        if self.running.is_set():
+            return
+
+        with self.queue_lock:
+            self.running.set()
+        self.thread = Thread(target=self._run, name="modem_service", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        '''Stop the worker thread, queued commands are still sent'''
+        with self.queue_lock:
+            self.running.clear()
+        self.gps_polling.clear()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def on_urc(self, prefix: str, handler) -> None:
+        '''Call handler(line) for every unsolicited result code starting with prefix'''
+        self.urc_handlers.setdefault(prefix, []).append(handler)
+
+    def submit(self, command: str, back: str = 'OK', timeout: float = 1) -> Future:
+        '''Queue an AT command, the future is set to the raw response (empty if the service is stopped)'''
+        future = Future()
+        with self.queue_lock:
+            if self.running.is_set():
+                self.commands.put((command, back, timeout, future))
+            else:
+                future.set_result("")
+        return future
+
+    def _dispatch_urcs(self, text: str, command: str = None) -> str:
+        '''Pass complete lines which are URCs to the registered handlers, returns the text without the dispatched URCs'''
+        remaining = []
+        for line in text.splitlines(keepends=True):
+            stripped = line.strip()
+            dispatched = False
+            for prefix, handlers in self.urc_handlers.items():
+                # Results of the command itself are no URCs (e.g. +CGPSINFO: of AT+CGPSINFO)
+                if stripped.startswith(prefix) and (command is None or not command[2:].startswith(prefix[:-1])):
+                    dispatched = True
+                    for handler in handlers:
+                        try:
+                            handler(stripped)
+                        except Exception as e:
+                            logging.error("URC handler for %s failed: %s", prefix, str(e))
+
+            if not dispatched:
+                remaining.append(line)
+
+        return "".join(remaining)
+
+    def _read_urcs(self) -> None:
+        '''Read and dispatch URCs which arrived while no command was running'''
+        text = self.partial_line
+        waiting = self.modem.ser.inWaiting()
+        if not waiting:
+            return
+
+        while waiting:
+            text += self.modem.ser.read(waiting).decode(errors='ignore')
+            waiting = self.modem.ser.inWaiting()
+
+        lines = text.split("\n")
+        self.partial_line = lines.pop() # Incomplete last line
+        self._dispatch_urcs("\n".join(lines))
+
+    def _log_error(self, message: str, *args) -> None:
+        '''Log an error at most once per ERROR_LOG_INTERVAL, a failing port would otherwise flood the log'''
+        if self.last_error_time is not None and monotonic() - self.last_error_time < self.ERROR_LOG_INTERVAL:
+            self.suppressed_errors += 1
+            return
+
+        if self.suppressed_errors:
+            message += f" ({self.suppressed_errors} similar errors suppressed)"
+        logging.error(message, *args)
+        self.last_error_time = monotonic()
+        self.suppressed_errors = 0
+
+    def _run(self) -> None:
+        '''Send queued commands and read URCs in between'''
+        while self.running.is_set() or not self.commands.empty():
+            try:
+                command, back, timeout, future = self.commands.get(timeout=self.IDLE_INTERVAL)
+            except Empty:
+                try:
+                    self._read_urcs()
+                except Exception as e:
+                    self._log_error("Could not read URCs: %s", str(e))
+                continue
+
+            try:
+                self._read_urcs()
+                response = self.modem.exchange(command, back, timeout)
+                # URCs in the response would otherwise be parsed as results of the command
+                future.set_result(self._dispatch_urcs(response, command))
+            except Exception as e:
+                future.set_exception(e)
+
+        # Fail commands which could not be sent anymore
+        while not self.commands.empty():
+            self.commands.get()[3].set_result("")
+
+    def start_gps_polling(self, interval: float = None) -> None:
+        '''Poll the GPS position in the background until the first valid fix, which is set on gps_fix'''
+        if self.gps_thread is not None and self.gps_thread.is_alive():
+            return
+
+        self.gps_polling.set()
+        self.gps_thread = Thread(target=self._poll_gps, args=(interval or self.GPS_POLL_INTERVAL,), name="gps_polling", daemon=True)
+        self.gps_thread.start()
+
+    def stop_gps_polling(self) -> None:
+        '''Stop polling the GPS position, e.g. because the GPS session was stopped'''
+        self.gps_polling.clear()
+
+    def _poll_gps(self, interval: float) -> None:
+        '''Poll CGPSINFO until there is a fix, polling is stopped or the service is stopped'''
+        while self.running.is_set() and self.gps_polling.is_set() and not self.gps_fix.done():
+            self.gps_polls += 1
+            try:
+                response = self.submit('AT+CGPSINFO', back='+CGPSINFO:').result(timeout=self.QUEUE_TIMEOUT)
+            except FutureTimeoutError:
+                continue
+            position = SIM7600X.parse_gps_position(response)
+
+            if position is not None:
+                self.modem.gps_fix_time = monotonic()
+                logging.info("GPS position: LAT %s, LON %s, HEIGHT %s (after %s polls)", *position, self.gps_polls)
+                self.gps_fix.set_result(position)
+                return
+
+            sleep(interval)
+
 if __name__ == "__main__":
     sim7600x = SIM7600X()
     sim7600x.get_signal_quality()
@@ -0,0 +1,116 @@
+'''Precomputed sunrise, sunset and civil twilight times and multi-day Witty Pi schedules based on them'''
+from datetime import date, datetime, timedelta
+from os import path
+import logging
+import numpy as np
+from schedule_compiler import schedule_from_wake_times
+
+# Zenith angles of the sun at sunrise/sunset (incl. refraction) and at the end of civil twilight
+ZENITH_SUNRISE = 90.833
+ZENITH_CIVIL_TWILIGHT = 96.0
+DAYS_PER_YEAR = 365
+
+def hour_angles(latitude: float, declination: np.ndarray, zenith: float) -> np.ndarray:
+    '''Hour angles in degrees at which the sun reaches the zenith angle. NaN on days where it never does.
+    Polar day is returned as 180, polar night as NaN.'''
+    latitude = np.radians(latitude)
+    cos_hour_angle = np.cos(np.radians(zenith)) / (np.cos(latitude) * np.cos(declination)) - np.tan(latitude) * np.tan(declination)
+
+    angles = np.degrees(np.arccos(np.clip(cos_hour_angle, -1, 1)))
+    angles[cos_hour_angle > 1] = np.nan # Sun stays below the zenith angle
+    return angles
+
+def compute_table(latitude: float, longitude: float) -> dict:
+    '''Compute sunrise, sunset, civil dawn and civil dusk for every day of the year in minutes after midnight UTC.
+    Uses the NOAA approximation (accurate to a few minutes). Index 0 is the 1st of January.'''
+    # Fractional year in radians
+    gamma = 2 * np.pi / DAYS_PER_YEAR * np.arange(DAYS_PER_YEAR)
+
+    equation_of_time = 229.18 * (0.000075 + 0.001868*np.cos(gamma) - 0.032077*np.sin(gamma)
+                                 - 0.014615*np.cos(2*gamma) - 0.040849*np.sin(2*gamma))
+    declination = (0.006918 - 0.399912*np.cos(gamma) + 0.070257*np.sin(gamma) - 0.006758*np.cos(2*gamma)
+                   + 0.000907*np.sin(2*gamma) - 0.002697*np.cos(3*gamma) + 0.00148*np.sin(3*gamma))
+
+    solar_noon = 720 - 4*longitude - equation_of_time
+    table = {"solar_noon": solar_noon}
+
+    for name, zenith in (("sun", ZENITH_SUNRISE), ("civil", ZENITH_CIVIL_TWILIGHT)):
+        angles = hour_angles(latitude, declination, zenith)
+        table[f"{name}_rise"] = solar_noon - 4*angles
+        table[f"{name}_set"] = solar_noon + 4*angles
+
+    return table
+
+def load_table(latitude: float, longitude: float, cache_directory: str) -> dict:
+    '''Load the table of a location from the cache or compute and cache it'''
+    cache_path = path.join(cache_directory, f"solar_{latitude:.3f}_{longitude:.3f}.npz")
+
+    try:
+        with np.load(cache_path) as cached:
+            return {name: cached[name] for name in cached.files}
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning("Could not load solar table %s: %s", cache_path, str(e))
+
+    table = compute_table(latitude, longitude)
+
+    try:
+        np.savez(cache_path, **table)
+    except Exception as e:
+        logging.warning("Could not save solar table %s: %s", cache_path, str(e))
+
+    return table
+
+def day_window(table: dict, day: date, civil_twilight: bool = False) -> tuple:
+    '''Get the daylight window of a day as (start, end) in minutes after midnight UTC (may be negative or over 1440
+    far from the prime meridian). None during polar night.'''
+    index = min(day.timetuple().tm_yday, DAYS_PER_YEAR) - 1
+    name = "civil" if civil_twilight else "sun"
+    start = table[f"{name}_rise"][index]
+    end = table[f"{name}_set"][index]
+
+    if np.isnan(start):
+        return None
+
+    return float(start), float(end)
+
+def wake_times(table: dict, first_day: date, days: int, interval_minutes: int, civil_twilight: bool = False, max_repetitions: int = None) -> list:
+    '''Get the wake times (UTC) between sunrise and sunset of the given days, aligned to the interval.
+    During polar night the camera wakes once at solar noon.'''
+    times = []
+
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        midnight = datetime(day.year, day.month, day.day)
+        window = day_window(table, day, civil_twilight)
+
+        if window is None:
+            index = min(day.timetuple().tm_yday, DAYS_PER_YEAR) - 1
+            times.append(midnight + timedelta(minutes=int(table["solar_noon"][index])))
+            continue
+
+        # Round the start down to the interval as in WittyPi4.round_time_to_nearest_interval
+        start = int(window[0] // interval_minutes * interval_minutes)
+        repetitions = max(1, int((window[1] - start) // interval_minutes) + 1)
+        if max_repetitions is not None:
+            repetitions = min(repetitions, max_repetitions)
+
+        times.extend(midnight + timedelta(minutes=start + i*interval_minutes) for i in range(repetitions))
+
+    # Windows of neighbouring days can overlap far from the prime meridian
+    unique_times = []
+    for wake_time in sorted(times):
+        if not unique_times or wake_time - unique_times[-1] >= timedelta(minutes=interval_minutes):
+            unique_times.append(wake_time)
+
+    return unique_times
+
+def generate_solar_schedule(table: dict, today: date, days: int, interval_minutes: int, on_minutes: int,
+                            civil_twilight: bool = False, max_repetitions: int = None) -> str:
+    '''Generate a schedule for blocks of days. The block starts on a fixed day, so the schedule only changes once per
+    block and the Witty Pi only has to be reprogrammed then.'''
+    interval_minutes = max(interval_minutes, on_minutes + 1)
+    first_day = date.fromordinal(today.toordinal() // days * days)
+    times = wake_times(table, first_day, days, interval_minutes, civil_twilight, max_repetitions)
+    return schedule_from_wake_times(times, timedelta(days=days), on_minutes)
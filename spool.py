@@ -0,0 +1,174 @@
+'''Persistent spool for files waiting to be uploaded to the file server'''
+from contextlib import closing
+from os import fsync, listdir, path, remove, replace
+from time import time
+import sqlite3
+import logging
+
+def write_file(local_path: str, file_data: bytes) -> None:
+    '''Write a file under a temporary name first, so a power cut never leaves a truncated file'''
+    temporary_path = local_path + ".part"
+
+    with open(temporary_path, "wb") as file:
+        file.write(file_data)
+        file.flush()
+        fsync(file.fileno())
+    replace(temporary_path, local_path)
+
+class UploadSpool:
+    '''A durable upload queue backed by a small SQLite manifest. Files are only deleted once the upload was confirmed.'''
+
+    PENDING = "pending"
+    IN_FLIGHT = "in_flight"
+    DONE = "done"
+
+    def __init__(self, directory: str, database_filename: str = "spool.db") -> None:
+        self.directory = directory
+        self.database_path = path.join(directory, database_filename)
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS spool (
+                filename TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                uploaded INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL)""")
+
+            # Manifests created before resumable uploads
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(spool)")]
+            if "uploaded" not in columns:
+                connection.execute("ALTER TABLE spool ADD COLUMN uploaded INTEGER NOT NULL DEFAULT 0")
+
+            # Uploads interrupted by a power cut are retried
+            connection.execute("UPDATE spool SET state = ? WHERE state = ?", (self.PENDING, self.IN_FLIGHT))
+
+    @classmethod
+    def open(cls, directory: str, database_filename: str = "spool.db"):
+        '''Open the spool. A manifest which can not be opened (e.g. corrupted by a power cut) is moved aside and
+        recreated, the files are added again by scan(). Returns None if the spool is not usable at all.'''
+        try:
+            return cls(directory, database_filename)
+        except Exception as e:
+            logging.critical("Could not open upload spool: %s", str(e))
+
+        try:
+            database_path = path.join(directory, database_filename)
+            if path.exists(database_path):
+                replace(database_path, database_path + ".corrupt")
+            return cls(directory, database_filename)
+        except Exception as e:
+            logging.critical("Could not recreate upload spool: %s", str(e))
+            return None
+
+    def _connect(self) -> sqlite3.Connection:
+        '''Open a new connection, the spool is used from multiple threads of the wake cycle'''
+        return sqlite3.connect(self.database_path, timeout=10)
+
+    def add(self, filename: str) -> None:
+        '''Add a file in the spool directory to the upload queue'''
+        local_path = path.join(self.directory, filename)
+        size = path.getsize(local_path)
+        created = path.getmtime(local_path)
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute("""INSERT INTO spool (filename, size, created, state, attempts, updated) VALUES (?, ?, ?, ?, 0, ?)
+                ON CONFLICT(filename) DO UPDATE SET size = excluded.size, state = excluded.state, uploaded = 0, updated = excluded.updated""",
+                (filename, size, created, self.PENDING, time()))
+
+        logging.info("Added %s (%s bytes) to upload spool.", filename, size)
+
+    def add_bytes(self, filename: str, file_data: bytes) -> None:
+        '''Write a file captured to memory into the spool directory and add it to the upload queue.
+        The file is written under a temporary name first, so a power cut never leaves a truncated image.'''
+        write_file(path.join(self.directory, filename), file_data)
+        self.add(filename)
+
+    def scan(self, extension: str = ".jpg") -> int:
+        '''Add files which are not yet in the manifest (e.g. saved by an older firmware). Returns the number of added files.'''
+        with closing(self._connect()) as connection:
+            known_files = {row[0] for row in connection.execute("SELECT filename FROM spool WHERE state != ?", (self.DONE,))}
+
+        added = 0
+        for filename in listdir(self.directory):
+            if filename.endswith(extension) and filename not in known_files:
+                self.add(filename)
+                added += 1
+
+        return added
+
+    def next_batch(self, byte_budget: int) -> list:
+        '''Get pending files newest first as (filename, size) tuples which fit into the byte budget.
+        The newest file is always included so a single big file can not block the spool.'''
+        batch = []
+        total_size = 0
+
+        with closing(self._connect()) as connection:
+            rows = connection.execute("SELECT filename, size FROM spool WHERE state = ? ORDER BY created DESC", (self.PENDING,)).fetchall()
+
+        for filename, size in rows:
+            if batch and total_size + size > byte_budget:
+                continue
+
+            batch.append((filename, size))
+            total_size += size
+
+        return batch
+
+    def _set_state(self, filename: str, state: str, attempt: bool = False) -> None:
+        '''Update the state of a file'''
+        with closing(self._connect()) as connection, connection:
+            connection.execute("UPDATE spool SET state = ?, attempts = attempts + ?, updated = ? WHERE filename = ?",
+                (state, 1 if attempt else 0, time(), filename))
+
+    def mark_in_flight(self, filename: str) -> None:
+        '''Mark a file as being uploaded, the uploaded bytes are unknown until the upload finished'''
+        self._set_state(filename, self.IN_FLIGHT, attempt=True)
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute("UPDATE spool SET uploaded = -1 WHERE filename = ?", (filename,))
+
+    def mark_failed(self, filename: str, uploaded: int = 0) -> None:
+        '''Put a file back into the queue after a failed upload, uploaded is the number of bytes already on the server'''
+        self._set_state(filename, self.PENDING)
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute("UPDATE spool SET uploaded = ? WHERE filename = ?", (uploaded, filename))
+
+        logging.warning("Upload of %s failed at %s bytes, file stays in spool.", filename, uploaded)
+
+    def get_uploaded(self, filename: str) -> int:
+        '''Get the number of bytes of a file which were uploaded before the last upload was interrupted (-1 if unknown, e.g. after a power cut)'''
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT uploaded FROM spool WHERE filename = ?", (filename,)).fetchone()
+
+        return row[0] if row else 0
+
+    def mark_done(self, filename: str) -> None:
+        '''Mark a file as uploaded and delete it locally'''
+        self._set_state(filename, self.DONE)
+
+        try:
+            remove(path.join(self.directory, filename))
+        except FileNotFoundError:
+            pass
+
+    def get_attempts(self, filename: str) -> int:
+        '''Get the number of upload attempts of a file'''
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT attempts FROM spool WHERE filename = ?", (filename,)).fetchone()
+
+        return row[0] if row else 0
+
+    def pending(self) -> tuple:
+        '''Get the number and total size of the files waiting for upload'''
+        with closing(self._connect()) as connection:
+            count, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM spool WHERE state != ?", (self.DONE,)).fetchone()
+
+        return count, size
+
+    def prune(self, max_age_days: float = 30) -> None:
+        '''Remove uploaded files from the manifest after some time to keep it small'''
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM spool WHERE state = ? AND updated < ?", (self.DONE, time() - max_age_days*86400))
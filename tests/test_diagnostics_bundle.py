@@ -0,0 +1,86 @@
+from io import BytesIO
+from os import path, listdir
+import tarfile
+import tempfile
+from diagnostics_bundle import DiagnosticsBundle, unpack_bundle, merge_bundles_in_directory, pack_members
+from log_shipper import LogShipper
+from persistent_state import PersistentState
+
+def test_bundle_round_trip():
+    """Test that the data of a bundle is unpacked again."""
+
+    bundle = DiagnosticsBundle()
+    assert bundle.is_empty()
+
+    bundle.append_file_from_bytes("diagnostics.yaml", BytesIO(b"- temperature: 20.0\n"))
+    bundle.append_file_from_bytes("log.txt", BytesIO(b"first\n"))
+    bundle.append_file_from_bytes("log.txt", BytesIO(b"second\n"))
+    bundle.append_file_from_bytes("schedule.log", BytesIO(b""))
+
+    assert unpack_bundle(bundle.to_bytes()) == {"diagnostics.yaml": b"- temperature: 20.0\n", "log.txt": b"first\nsecond\n"}
+
+def test_merge_bundles_in_directory():
+    """Test that bundles are appended to the per-camera files in order and deleted."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(path.join(directory, "log.txt"), "wb") as file:
+            file.write(b"old\n")
+
+        for timestamp, text in (("20240101_1200Z", b"first\n"), ("20240101_1230Z", b"second\n")):
+            bundle = DiagnosticsBundle()
+            bundle.append_file_from_bytes("log.txt", BytesIO(text))
+            with open(path.join(directory, f"diagnostics_{timestamp}.tar.gz"), "wb") as file:
+                file.write(bundle.to_bytes().read())
+
+        assert merge_bundles_in_directory(directory) == 2
+        assert listdir(directory) == ["log.txt"]
+
+        with open(path.join(directory, "log.txt"), "rb") as file:
+            assert file.read() == b"old\nfirst\nsecond\n"
+
+def test_invalid_member_names_are_skipped():
+    """Test that members outside of the camera directory are not unpacked."""
+
+    archive = BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for name in ("log.txt", "../log.txt", "sub/log.txt", "..log.txt"):
+            info = tarfile.TarInfo(name)
+            info.size = 4
+            tar.addfile(info, BytesIO(b"data"))
+    archive.seek(0)
+
+    assert unpack_bundle(archive) == {"log.txt": b"data"}
+
+def test_interrupted_merge_is_continued():
+    """Test that a bundle whose merge was interrupted only appends the remaining members."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        # log.txt was already appended before the interruption
+        with open(path.join(directory, "log.txt"), "wb") as file:
+            file.write(b"old\nfirst\n")
+        with open(path.join(directory, "diagnostics_20240101_1200Z.tar.gz.merging"), "wb") as file:
+            file.write(pack_members({"diagnostics.yaml": b"- temperature: 20.0\n"}).read())
+
+        assert merge_bundles_in_directory(directory) == 1
+        assert sorted(listdir(directory)) == ["diagnostics.yaml", "log.txt"]
+
+        with open(path.join(directory, "log.txt"), "rb") as file:
+            assert file.read() == b"old\nfirst\n"
+        with open(path.join(directory, "diagnostics.yaml"), "rb") as file:
+            assert file.read() == b"- temperature: 20.0\n"
+
+def test_log_offsets_are_saved_on_commit():
+    """Test that log offsets are only saved once the bundle was committed."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(path.join(directory, "log.txt"), "wb") as file:
+            file.write(b"first\n")
+
+        state = PersistentState(path.join(directory, "state.yaml"))
+        log_shipper = LogShipper(DiagnosticsBundle(), state, autocommit=False)
+        assert log_shipper.ship("log.txt", f"{directory}/") == 6
+        assert log_shipper.ship("log.txt", f"{directory}/") == 0
+        assert state.get(path.join(directory, "log.txt")) is None
+
+        log_shipper.commit()
+        assert state.get(path.join(directory, "log.txt"))["offset"] == 6
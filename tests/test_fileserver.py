@@ -0,0 +1,260 @@
+from ftplib import error_perm
+from io import BytesIO
+from os import path
+import tempfile
+import fileserver
+from fileserver import FileServer
+from persistent_state import PersistentState
+
+class FakeFTP:
+    """In-memory FTP server, optionally dropping the connection after a number of bytes."""
+
+    files = {}
+
+    def __init__(self, host: str, username: str, password: str, timeout: int = 5) -> None:
+        self.drop_after = None
+        self.commands = []
+
+    def voidcmd(self, command: str) -> str:
+        return "200 OK"
+
+    def size(self, filename: str) -> int:
+        self.commands.append(f"SIZE {filename}")
+        if filename not in self.files:
+            raise error_perm("550 No such file")
+        return len(self.files[filename])
+
+    def storbinary(self, command: str, file, blocksize: int = 8192, callback=None, rest=None) -> None:
+        self.commands.append(command)
+        verb, filename = command.split(" ", 1)
+        data = self.files.get(filename, b"")
+
+        if verb == "STOR":
+            data = data[:rest] if rest else b""
+
+        while True:
+            block = file.read(blocksize)
+            if not block:
+                break
+            if self.drop_after is not None and len(data) + len(block) > self.drop_after:
+                self.files[filename] = data + block[:self.drop_after - len(data)]
+                raise ConnectionResetError("Connection dropped")
+            data += block
+            if callback:
+                callback(block)
+
+        self.files[filename] = data
+
+    def rename(self, source: str, destination: str) -> None:
+        self.files[destination] = self.files.pop(source)
+
+    def delete(self, filename: str) -> None:
+        del self.files[filename]
+
+def create_file(size: int) -> str:
+    """Create a temporary file with the given size."""
+    directory = tempfile.mkdtemp()
+    with open(path.join(directory, "image.jpg"), "wb") as file:
+        file.write(bytes(range(256)) * (size // 256))
+    return f"{directory}/"
+
+def test_resumable_upload(monkeypatch):
+    """Test that an interrupted upload is continued and the complete file is renamed."""
+
+    monkeypatch.setattr(fileserver, "FTP", FakeFTP)
+    FakeFTP.files = {}
+    local_path = create_file(256 * 100)
+
+    server = FileServer("host", "user", "password", block_size=1024)
+    server.ftp.drop_after = 10000
+    assert not server.upload_file_resumable("image.jpg", local_path)
+    assert "image.jpg" not in FakeFTP.files
+    assert len(FakeFTP.files["image.jpg.part"]) == 10000
+
+    server.ftp.drop_after = None
+    assert server.upload_file_resumable("image.jpg", local_path, offset_hint=server.uploaded_bytes)
+    assert "image.jpg.part" not in FakeFTP.files
+    assert server.ftp.commands[-2] == "STOR image.jpg.part"
+
+    with open(f"{local_path}image.jpg", "rb") as file:
+        assert FakeFTP.files["image.jpg"] == file.read()
+
+def test_new_upload_skips_size_query(monkeypatch):
+    """Test that no partial upload is queried if the upload did not start yet."""
+
+    monkeypatch.setattr(fileserver, "FTP", FakeFTP)
+    FakeFTP.files = {}
+    local_path = create_file(256 * 10)
+
+    server = FileServer("host", "user", "password")
+    assert server.upload_file_resumable("image.jpg", local_path, offset_hint=0)
+    assert server.ftp.commands == ["STOR image.jpg.part", "SIZE image.jpg.part"]
+    assert len(FakeFTP.files["image.jpg"]) == 2560
+
+class FakeModem:
+    """Modem which reports a sequence of network states."""
+
+    NETWORK_NONE = "none"
+    NETWORK_IDLE = "idle"
+    NETWORK_SEARCHING = "searching"
+    NETWORK_MARGINAL = "marginal"
+
+    def __init__(self, states: list) -> None:
+        self.states = states
+
+    def get_network_state(self) -> str:
+        return self.states.pop(0)
+
+def test_connect_fails_fast_without_network(monkeypatch):
+    """Test that no connection is attempted if the modem has no network."""
+
+    monkeypatch.setattr(fileserver, "FTP", FakeFTP)
+    monkeypatch.setattr(fileserver, "sleep", lambda seconds: None)
+
+    server = FileServer("host", "user", "password", modem=FakeModem(["none"]))
+    assert not server.connected()
+    assert server.connect_attempts == 1
+
+def test_connect_once_registered(monkeypatch):
+    """Test that the connection is established as soon as the modem is registered."""
+
+    waits = []
+    monkeypatch.setattr(fileserver, "FTP", FakeFTP)
+    monkeypatch.setattr(fileserver, "sleep", waits.append)
+
+    server = FileServer("host", "user", "password", modem=FakeModem(["searching", "searching", "ready"]))
+    assert server.connected()
+    assert server.connect_attempts == 3
+    assert server.network_state == "ready"
+    assert waits[0] <= FileServer.BACKOFF_BASE <= waits[1] <= 2*FileServer.BACKOFF_BASE
+
+def test_idle_modem_is_waited_for(monkeypatch):
+    """Test that a modem which does not search the network yet is waited for, but not for the whole wake cycle."""
+
+    waits = []
+    monkeypatch.setattr(fileserver, "FTP", FakeFTP)
+    monkeypatch.setattr(fileserver, "sleep", waits.append)
+
+    # Marginal network is waited for with backoff before connecting
+    server = FileServer("host", "user", "password", modem=FakeModem(["idle", "idle", "marginal"]))
+    assert server.connected()
+    assert server.connect_attempts == 3
+    assert len(waits) == 3
+
+    server = FileServer("host", "user", "password", modem=FakeModem(["idle", "idle", "idle"]))
+    assert not server.connected()
+    assert server.connect_attempts == FileServer.IDLE_ATTEMPTS + 1
+
+class FakeDirectoryFTP(FakeFTP):
+    """FTP server with a directory tree, counting the control connection round trips."""
+
+    def __init__(self, host: str, username: str, password: str, timeout: int = 5) -> None:
+        super().__init__(host, username, password, timeout)
+        self.directories = {"."}
+        self.cwd_path = "."
+
+    def cwd(self, directory: str) -> None:
+        self.commands.append(f"CWD {directory}")
+        target = fileserver.posixpath.normpath(fileserver.posixpath.join(self.cwd_path, directory))
+        if target not in self.directories:
+            raise error_perm("550 No such directory")
+        self.cwd_path = target
+
+    def mkd(self, directory: str) -> None:
+        self.commands.append(f"MKD {directory}")
+        self.directories.add(fileserver.posixpath.normpath(fileserver.posixpath.join(self.cwd_path, directory)))
+
+    def mlsd(self, facts: list):
+        self.commands.append("MLSD")
+        yield ".", {"type": "cdir"}
+        for name, data in self.files.items():
+            yield name, {"type": "file", "size": str(len(data))}
+
+def test_change_directory_creates_and_remembers_directories(monkeypatch):
+    """Test that missing directories are created and known directories are changed to in one round trip."""
+
+    monkeypatch.setattr(fileserver, "FTP", FakeDirectoryFTP)
+
+    server = FileServer("host", "user", "password")
+    server.change_directory("glacier/camera1", True)
+    assert server.ftp.cwd_path == "glacier/camera1"
+    assert server.known_directories == {"glacier", "glacier/camera1"}
+    assert "NLST" not in server.ftp.commands
+
+    second_server = FileServer("host", "user", "password")
+    second_server.ftp.directories = server.ftp.directories
+    second_server.known_directories = server.known_directories
+    second_server.change_directory("glacier/camera1", True)
+    assert second_server.ftp.commands == ["CWD glacier/camera1"]
+
+def test_listing_cache(monkeypatch):
+    """Test that listings are cached with facts and invalidated after uploads."""
+
+    monkeypatch.setattr(fileserver, "FTP", FakeDirectoryFTP)
+    FakeFTP.files = {"settings.yaml": b"1234"}
+
+    server = FileServer("host", "user", "password")
+    assert server.list_entries() == {"settings.yaml": {"type": "file", "size": "4"}}
+    assert server.list_files() == ["settings.yaml"]
+    assert server.ftp.commands.count("MLSD") == 1
+
+    local_path = create_file(256)
+    server.upload_file_resumable("image.jpg", local_path, offset_hint=0)
+    assert sorted(server.list_files()) == ["image.jpg", "settings.yaml"]
+    assert server.ftp.commands.count("MLSD") == 2
+
+class FakeMlstFTP(FakeFTP):
+    """FTP server supporting MLST and RETR."""
+
+    modify = "20240101120000"
+
+    def sendcmd(self, command: str) -> str:
+        self.commands.append(command)
+        filename = command.split(" ", 1)[1]
+        if filename not in self.files:
+            raise error_perm("550 No such file")
+        return f"250-Listing {filename}\r\n type=file;size={len(self.files[filename])};modify={self.modify}; {filename}\r\n250 End"
+
+    def retrbinary(self, command: str, callback) -> None:
+        self.commands.append(command)
+        callback(self.files[command.split(" ", 1)[1]])
+
+def test_download_file_if_changed(monkeypatch):
+    """Test that a control file is only downloaded if its size or modification time changed."""
+
+    monkeypatch.setattr(fileserver, "FTP", FakeMlstFTP)
+    FakeFTP.files = {"settings.yaml": b"cameraName: Test\n"}
+    local_path = tempfile.mkdtemp() + "/"
+    state = PersistentState(f"{local_path}state.yaml")
+
+    server = FileServer("host", "user", "password")
+    assert server.download_file_if_changed("settings.yaml", local_path, state) == "changed"
+    assert server.download_file_if_changed("settings.yaml", local_path, state) == "unchanged"
+    assert server.ftp.commands.count("RETR settings.yaml") == 1
+
+    FakeMlstFTP.modify = "20240201120000"
+    assert server.download_file_if_changed("settings.yaml", local_path, state) == "changed"
+    assert server.download_file_if_changed("missing.yaml", local_path, state) == "missing"
+
+    with open(f"{local_path}settings.yaml", "rb") as file:
+        assert file.read() == b"cameraName: Test\n"
+
+def test_resumable_upload_from_bytes(monkeypatch):
+    """Test that data from memory is uploaded to a temporary file and an interrupted upload is resumed from a local copy."""
+
+    monkeypatch.setattr(fileserver, "FTP", FakeFTP)
+    FakeFTP.files = {}
+    local_path = create_file(256 * 100)
+    with open(f"{local_path}image.jpg", "rb") as file:
+        file_data = BytesIO(file.read())
+
+    server = FileServer("host", "user", "password", block_size=1024)
+    server.ftp.drop_after = 10000
+    assert not server.upload_bytes_resumable("image.jpg", file_data)
+    assert "image.jpg" not in FakeFTP.files
+    assert server.uploaded_bytes == 9216 # Complete blocks
+
+    server.ftp.drop_after = None
+    assert server.upload_file_resumable("image.jpg", local_path, offset_hint=server.uploaded_bytes)
+    assert "image.jpg.part" not in FakeFTP.files
+    assert FakeFTP.files["image.jpg"] == file_data.getvalue()
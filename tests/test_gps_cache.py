@@ -0,0 +1,67 @@
+from os import path
+import tempfile
+from persistent_state import PersistentState
+from gps_cache import GpsFixCache
+
+def test_reacquire_reason():
+    """Test when the cached fix is reused and when a new fix is needed."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = GpsFixCache(PersistentState(path.join(directory, "gps_state.yaml")), reacquire_wakes=3, reacquire_hours=24, max_hdop=5.0)
+        assert cache.reacquire_reason() == GpsFixCache.REASON_NO_FIX
+
+        cache.update(("46.5365", "7.82541", "2911.3"), hdop=1.2, cell_id="228-01:0x1A2B:123", now=1000.0)
+        assert cache.reacquire_reason("228-01:0x1A2B:123", now=1000.0) is None
+        assert cache.reacquire_reason(None, now=1000.0) is None # Unknown cell
+        assert cache.reacquire_reason("228-01:0x1A2B:456", now=1000.0) is None # Not yet seen on several wakes
+        assert cache.reacquire_reason(now=1000.0 + 25*3600) == GpsFixCache.REASON_AGE
+
+        cache.count_wake()
+        cache.count_wake()
+        assert cache.reacquire_reason(now=1000.0) == GpsFixCache.REASON_WAKES
+
+        # Survives a reboot
+        cache = GpsFixCache(PersistentState(path.join(directory, "gps_state.yaml")), reacquire_wakes=3, reacquire_hours=24, max_hdop=1.0)
+        assert cache.position() == ("46.5365", "7.82541", "2911.3")
+        assert cache.age_hours(now=1000.0 + 1800) == 0.5
+
+        cache.update(cache.position(), hdop=1.2, now=1000.0)
+        assert cache.reacquire_reason(now=1000.0) == GpsFixCache.REASON_HDOP
+
+def test_cell_change_must_persist():
+    """Test that reselecting a neighbouring cell does not force a new fix, but staying in an unknown cell does."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = GpsFixCache(PersistentState(path.join(directory, "gps_state.yaml")), reacquire_wakes=100, cell_change_wakes=3)
+        cache.update(("46.5365", "7.82541", "2911.3"), hdop=1.2, cell_id="A", now=1000.0)
+
+        # Neighbouring cell for a single wake cycle
+        assert cache.reacquire_reason("B", now=1000.0) is None
+        cache.count_wake("B")
+        cache.count_wake("A")
+        assert cache.reacquire_reason("B", now=1000.0) is None
+
+        # Unknown cell on three consecutive wake cycles
+        cache.count_wake("B")
+        cache.count_wake("B")
+        assert cache.reacquire_reason("B", now=1000.0) == GpsFixCache.REASON_CELL_CHANGED
+
+        # A new fix at the same position adds the cell
+        cache.update(("46.53651", "7.82542", "2911.0"), hdop=1.2, cell_id="B", now=1000.0)
+        assert cache.known_cells() == ["A", "B"]
+        cache.count_wake("A")
+        assert cache.reacquire_reason("A", now=1000.0) is None
+
+        # A fix somewhere else starts over
+        cache.update(("46.6", "7.9", "2000.0"), hdop=1.2, cell_id="C", now=1000.0)
+        assert cache.known_cells() == ["C"]
+
+def test_xtra_age():
+    """Test that the age of the XTRA data is kept."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = GpsFixCache(PersistentState(path.join(directory, "gps_state.yaml")))
+        assert cache.xtra_age_hours() is None
+
+        cache.set_xtra_updated(now=1000.0)
+        assert cache.xtra_age_hours(now=1000.0 + 7200) == 2.0
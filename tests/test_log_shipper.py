@@ -0,0 +1,88 @@
+from os import path, rename
+import gzip
+import tempfile
+from log_shipper import LogShipper
+from persistent_state import PersistentState
+
+class FakeFileServer:
+    """File server which keeps appended files in memory."""
+
+    def __init__(self) -> None:
+        self.files = {}
+        self.fail = False
+
+    def append_file_from_bytes(self, filename: str, file_data) -> bool:
+        if self.fail:
+            return False
+
+        data = b''
+        while True:
+            chunk = file_data.read(8192)
+            if not chunk:
+                break
+            data += chunk
+
+        self.files[filename] = self.files.get(filename, b'') + data
+        return True
+
+def append_to_log(filename: str, text: str) -> None:
+    """Append text to a log file."""
+    with open(filename, "a", encoding="utf-8") as file:
+        file.write(text)
+
+def test_only_new_data_is_shipped():
+    """Test that every byte of a log file is shipped exactly once."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        log_file = path.join(directory, "log.txt")
+        state = PersistentState(path.join(directory, "state.yaml"))
+        fileserver = FakeFileServer()
+
+        append_to_log(log_file, "first\n")
+        assert LogShipper(fileserver, state).ship("log.txt", f"{directory}/") == 6
+
+        append_to_log(log_file, "second\n")
+        fileserver.fail = True
+        assert LogShipper(fileserver, state).ship("log.txt", f"{directory}/") == 0
+
+        # Offsets survive a restart
+        fileserver.fail = False
+        state = PersistentState(path.join(directory, "state.yaml"))
+        assert LogShipper(fileserver, state).ship("log.txt", f"{directory}/") == 7
+        assert LogShipper(fileserver, state).ship("log.txt", f"{directory}/") == 0
+
+        assert fileserver.files["log.txt"] == b"first\nsecond\n"
+
+def test_rotated_log_file():
+    """Test that the rest of a rotated log file is shipped before the new log file."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        log_file = path.join(directory, "log.txt")
+        state = PersistentState(path.join(directory, "state.yaml"))
+        fileserver = FakeFileServer()
+
+        append_to_log(log_file, "first\n")
+        LogShipper(fileserver, state).ship("log.txt", f"{directory}/")
+
+        append_to_log(log_file, "second\n")
+        rename(log_file, f"{log_file}.1")
+        append_to_log(log_file, "third\n")
+        LogShipper(fileserver, state).ship("log.txt", f"{directory}/")
+
+        assert fileserver.files["log.txt"] == b"first\nsecond\nthird\n"
+
+def test_compressed_log_file():
+    """Test that compressed parts form a valid gzip file."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        log_file = path.join(directory, "log.txt")
+        state = PersistentState(path.join(directory, "state.yaml"))
+        fileserver = FakeFileServer()
+
+        append_to_log(log_file, "first\n" * 1000)
+        LogShipper(fileserver, state, compress=True).ship("log.txt", f"{directory}/")
+        append_to_log(log_file, "second\n")
+        LogShipper(fileserver, state, compress=True).ship("log.txt", f"{directory}/")
+
+        assert len(fileserver.files["log.txt.gz"]) < 1000
+        assert gzip.decompress(fileserver.files["log.txt.gz"]) == b"first\n" * 1000 + b"second\n"
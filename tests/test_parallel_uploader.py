@@ -0,0 +1,73 @@
+from threading import Lock
+from time import sleep, monotonic
+from parallel_uploader import ParallelUploader
+
+class FakeSession:
+    """File server session which records the uploaded files."""
+
+    TIMEOUT = 5
+
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.uploaded = []
+        self.closed = False
+
+    def connected(self) -> bool:
+        return True
+
+    def quit(self) -> None:
+        self.closed = True
+
+def upload(session: FakeSession, filename: str) -> bool:
+    """Upload function taking some time per file."""
+    sleep(0.05)
+    if session.fail:
+        return False
+    session.uploaded.append(filename)
+    return True
+
+def test_files_are_distributed_over_sessions():
+    """Test that all files are uploaded over several sessions in parallel."""
+
+    sessions = []
+    lock = Lock()
+
+    def connect_session():
+        with lock:
+            sessions.append(FakeSession())
+            return sessions[-1]
+
+    primary = FakeSession()
+    files = [(f"{i}.jpg", 100) for i in range(12)]
+    uploader = ParallelUploader(primary, connect_session, sessions=4)
+
+    start = monotonic()
+    assert uploader.upload(files, upload) == 1200
+    assert monotonic() - start < 0.4
+
+    uploaded = primary.uploaded + [filename for session in sessions for filename in session.uploaded]
+    assert sorted(uploaded) == sorted(filename for filename, _ in files)
+    assert len(sessions) == 3 and all(session.closed for session in sessions)
+    assert not primary.closed
+    assert uploader.throughput > 0
+
+def test_failing_sessions_are_closed():
+    """Test that the uploader backs off to fewer sessions when uploads fail."""
+
+    primary = FakeSession()
+    failing = FakeSession(fail=True)
+    files = [(f"{i}.jpg", 100) for i in range(10)]
+    uploader = ParallelUploader(primary, lambda: failing, sessions=2)
+    uploader.upload(files, upload)
+
+    assert uploader.failed_files == ParallelUploader.MAX_FAILURES_PER_SESSION
+    assert len(primary.uploaded) == 10 - ParallelUploader.MAX_FAILURES_PER_SESSION
+    assert failing.closed
+
+def test_upload_stops_when_time_is_up():
+    """Test that no new uploads are started without time left."""
+
+    primary = FakeSession()
+    uploader = ParallelUploader(primary)
+    assert uploader.upload([("1.jpg", 100)], upload, remaining=lambda: 1) == 0
+    assert primary.uploaded == []
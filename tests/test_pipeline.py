@@ -0,0 +1,138 @@
+from time import sleep, monotonic
+from pipeline import Pipeline, PRIORITY_MUST_RUN, PRIORITY_HIGH, PRIORITY_LOW
+
+def test_stages_run_concurrently():
+    """Test that independent stages do not wait for each other."""
+
+    pipeline = Pipeline()
+    pipeline.add_stage("a", lambda timer: sleep(0.2))
+    pipeline.add_stage("b", lambda timer: sleep(0.2))
+    pipeline.add_stage("c", lambda timer: sleep(0.2))
+
+    start = monotonic()
+    pipeline.run()
+    assert monotonic() - start < 0.5
+
+def test_dependencies_are_respected():
+    """Test that a stage only runs after the stages it depends on."""
+
+    order = []
+    pipeline = Pipeline()
+    pipeline.add_stage("download", lambda timer: (sleep(0.1), order.append("download")))
+    pipeline.add_stage("capture", lambda timer: order.append("capture"))
+    pipeline.add_stage("schedule", lambda timer: order.append("schedule"), depends_on=("download",))
+    pipeline.run()
+
+    assert order.index("download") < order.index("schedule")
+    assert order[0] == "capture"
+
+def test_failing_stage_does_not_block_dependents():
+    """Test that a failing stage is recorded and its dependents still run."""
+
+    def fail(timer):
+        raise RuntimeError("No connection")
+
+    pipeline = Pipeline()
+    pipeline.add_stage("connect", fail)
+    pipeline.add_stage("quit", lambda timer: "closed", depends_on=("connect",))
+    results = pipeline.run()
+
+    assert not pipeline.succeeded("connect")
+    assert pipeline.succeeded("quit")
+    assert results["quit"] == "closed"
+
+def test_unknown_dependency():
+    """Test that stages can only depend on already added stages."""
+
+    pipeline = Pipeline()
+
+    try:
+        pipeline.add_stage("schedule", lambda timer: None, depends_on=("download",))
+        assert False
+    except ValueError:
+        pass
+
+def test_stage_timings_are_recorded():
+    """Test that the duration, retries and failures of the stages are written to the data dict."""
+
+    def connect(timer):
+        sleep(0.1)
+        timer.retries = 2
+
+    def capture(timer):
+        timer.succeeded = False
+
+    data = {}
+    pipeline = Pipeline(data)
+    pipeline.add_stage("ftp_connect", connect)
+    pipeline.add_stage("capture", capture)
+    pipeline.run()
+
+    assert 0.1 <= data["t_ftp_connect"] < 0.3
+    assert data["retries_ftp_connect"] == 2
+    assert "t_capture" in data
+    assert "retries_capture" not in data
+    assert data["failed_stages"] == ["capture"]
+    assert not pipeline.succeeded("capture")
+
+def test_stage_timeout():
+    """Test that the pipeline stops waiting for a hung stage and its dependents continue."""
+
+    timed_out = []
+    data = {}
+    pipeline = Pipeline(data)
+    pipeline.add_stage("upload", lambda timer: sleep(1), timeout=0.1, on_timeout=lambda: timed_out.append(True))
+    pipeline.add_stage("measurements", lambda timer: "written", depends_on=("upload",))
+
+    start = monotonic()
+    results = pipeline.run()
+
+    assert monotonic() - start < 0.5
+    assert timed_out == [True]
+    assert data["timed_out_stages"] == ["upload"]
+    assert results["measurements"] == "written"
+
+def test_low_priority_stages_are_shed():
+    """Test that low priority stages are skipped near the deadline while must run stages still run."""
+
+    data = {}
+    pipeline = Pipeline(data, monotonic() + 10) # Less than the reserve for low priority stages
+    pipeline.add_stage("capture", lambda timer: "captured")
+    pipeline.add_stage("upload", lambda timer: timer.remaining(), priority=PRIORITY_HIGH)
+    pipeline.add_stage("gps_fix", lambda timer: "fix", priority=PRIORITY_LOW)
+    results = pipeline.run()
+
+    assert results["capture"] == "captured"
+    assert results["upload"] is None
+    assert results["gps_fix"] is None
+    assert sorted(data["skipped_stages"]) == ["gps_fix", "upload"]
+
+def test_stage_deadline_within_budget():
+    """Test that the deadline of a stage leaves the reserve for higher priority stages."""
+
+    pipeline = Pipeline({}, monotonic() + 100)
+    pipeline.add_stage("upload", lambda timer: timer.remaining(), priority=PRIORITY_HIGH, timeout=300)
+    pipeline.add_stage("backlog", lambda timer: timer.remaining(), priority=PRIORITY_LOW, timeout=10)
+    results = pipeline.run()
+
+    assert 60 < results["upload"] <= 100 - Pipeline.RESERVE_SECONDS[PRIORITY_HIGH]
+    assert 0 < results["backlog"] <= 10
+
+def test_must_run_stages_leave_time_for_later_must_run_stages():
+    """Test that a chain of must run stages finishes before the deadline, e.g. apply_schedule leaves time for measurements."""
+
+    start = monotonic()
+    data = {}
+    pipeline = Pipeline(data, start + 1.2)
+    pipeline.RESERVE_SECONDS = {PRIORITY_MUST_RUN: 0, PRIORITY_HIGH: 0, PRIORITY_LOW: 0}
+    pipeline.add_stage("download_settings", lambda timer: None, priority=PRIORITY_HIGH, timeout=0.3)
+    pipeline.add_stage("generate_schedule", lambda timer: None, depends_on=("download_settings",), timeout=0.2)
+    pipeline.add_stage("apply_schedule", lambda timer: sleep(2), depends_on=("generate_schedule",), timeout=1.2)
+    pipeline.add_stage("measurements", lambda timer: (sleep(0.2), monotonic())[1], depends_on=("apply_schedule",), timeout=0.3)
+
+    assert pipeline.must_run_reserve(pipeline.stages["download_settings"]) == 1.7
+    results = pipeline.run()
+
+    assert data["timed_out_stages"] == ["apply_schedule"]
+    assert data["t_apply_schedule"] < 1.0 # Capped by the time measurements needs
+    assert results["measurements"] <= start + 1.2
@@ -0,0 +1,93 @@
+from threading import Event
+from time import sleep
+from resident_mode import ResidentMode
+
+class FakeCamera:
+    """Picamera2 which encodes a small JPEG per capture."""
+
+    def __init__(self) -> None:
+        self.started = False
+        self.configured = None
+
+    def configure(self, config) -> None:
+        self.configured = config
+
+    def start(self) -> None:
+        self.started = True
+
+    def stop(self) -> None:
+        self.started = False
+
+    def capture_file(self, file_output, format: str = None) -> None:
+        assert self.started and format == "jpeg"
+        file_output.write(b"\xff\xd8\xff")
+
+def test_resident_mode_captures_and_uploads():
+    """Test that the camera is started once, captures at the interval and every capture is uploaded from memory."""
+
+    camera = FakeCamera()
+    filenames = (f"{i}.jpg" for i in range(1000))
+    uploaded = []
+    checks = []
+    closed = []
+
+    def should_continue() -> bool:
+        checks.append(True)
+        return len(checks) < 3
+
+    def upload(filename, buffer) -> bool:
+        assert buffer.getvalue() == b"\xff\xd8\xff"
+        uploaded.append(filename)
+        return True
+
+    resident_mode = ResidentMode(camera, "config", lambda: next(filenames), upload, lambda filename, buffer: None,
+                                 should_continue, interval_seconds=0.01, max_duration_seconds=5, close_function=lambda: closed.append(True))
+    resident_mode.CONDITION_CHECK_INTERVAL = 0.05
+
+    captures = resident_mode.run()
+
+    assert camera.configured == "config" and not camera.started
+    assert len(checks) == 3
+    assert captures >= 5
+    assert resident_mode.uploaded + resident_mode.saved == captures
+    assert resident_mode.uploaded > 0
+    assert sorted(uploaded, key=lambda filename: int(filename[:-4])) == uploaded
+    assert closed == [True]
+
+def test_failed_uploads_are_saved():
+    """Test that pictures are only saved if the upload failed and resident mode stops after the maximum duration."""
+
+    saved = []
+    resident_mode = ResidentMode(FakeCamera(), "config", lambda: "image.jpg", lambda filename, buffer: False,
+                                 lambda filename, buffer: saved.append(filename), lambda: True,
+                                 interval_seconds=0.01, max_duration_seconds=0.1)
+
+    captures = resident_mode.run()
+    assert captures > 0
+    assert resident_mode.uploaded == 0
+    assert len(saved) == captures
+
+def test_slow_upload_does_not_block_and_is_not_closed_early():
+    """Test that the queue is bounded, a hung upload is saved and the session is not closed while it is used."""
+
+    release = Event()
+    saved = []
+    closed = []
+
+    def upload(filename, buffer) -> bool:
+        release.wait()
+        return True
+
+    filenames = (f"{i}.jpg" for i in range(1000))
+    resident_mode = ResidentMode(FakeCamera(), "config", lambda: next(filenames), upload,
+                                 lambda filename, buffer: saved.append(filename), lambda: True,
+                                 interval_seconds=0.01, max_duration_seconds=0.2, close_function=lambda: closed.append(True))
+
+    captures = resident_mode.run(upload_timeout=0.1)
+    assert resident_mode.uploads.empty()
+    assert len(saved) == captures # Including the one which was being uploaded
+    assert closed == []
+
+    release.set()
+    sleep(0.2)
+    assert closed == [True]
@@ -0,0 +1,66 @@
+from datetime import date, datetime, timedelta
+from yaml import safe_load
+from schedule_compiler import CaptureWindow, compile_schedule, simulate, format_duration, wake_times
+
+def test_parse_windows():
+    """Test that windows are read from the settings, including unquoted YAML times."""
+
+    windows = safe_load('[{start: 10:00, end: "14:30", interval: 10, dates: ["06-01", "08-31"], weekdays: [0, 2]}]')
+    window = CaptureWindow.from_dict(windows[0])
+
+    assert (window.start_minute, window.end_minute, window.interval_minutes) == (600, 870, 10)
+    assert window.is_active(date(2026, 6, 1)) # Monday
+    assert not window.is_active(date(2026, 6, 2)) # Tuesday
+    assert not window.is_active(date(2026, 9, 7)) # Monday, out of season
+
+    # Season over new year and fixed dates
+    winter = CaptureWindow.from_dict({"start": "12:00", "end": "12:00", "interval": 60, "dates": ["11-01", "02-28"]})
+    assert winter.is_active(date(2026, 12, 24)) and winter.is_active(date(2027, 1, 10)) and not winter.is_active(date(2026, 7, 1))
+    burst = CaptureWindow.from_dict({"start": "00:00", "end": "23:55", "interval": 5, "dates": ["2026-07-01", "2026-07-03"]})
+    assert burst.is_active(date(2026, 7, 2)) and not burst.is_active(date(2027, 7, 2))
+
+def test_daily_schedule_is_compact():
+    """Test that a schedule which is the same every day only covers one day."""
+
+    windows = [CaptureWindow(8*60, 16*60, 30), CaptureWindow(11*60, 13*60, 10)]
+    schedule = compile_schedule(windows, date(2026, 8, 17), days=7, on_minutes=4)
+
+    # 08:00 - 16:00 every 30 minutes plus 11:10, 11:20, 11:40, ... in between
+    times = simulate(schedule, datetime(2026, 8, 17), datetime(2026, 8, 18))
+    assert len(schedule.splitlines()) == 2 + 2 * len(times)
+    assert times[0] == datetime(2026, 8, 17, 8, 0)
+    assert times[-1] == datetime(2026, 8, 17, 16, 0)
+    assert datetime(2026, 8, 17, 11, 10) in times and datetime(2026, 8, 17, 11, 20) in times
+    assert len(times) == 17 + 8
+
+def test_weekday_schedule_and_simulation():
+    """Test that the simulated schedule wakes exactly at the times of the windows."""
+
+    windows = [CaptureWindow(22*60, 2*60, 60, weekdays=[4]), CaptureWindow(12*60, 12*60, 60)] # Friday night
+    today = date(2026, 8, 17)
+    schedule = compile_schedule(windows, today, days=7, on_minutes=4)
+
+    first_day = date.fromordinal(today.toordinal() // 7 * 7)
+    start = datetime(first_day.year, first_day.month, first_day.day)
+    times = simulate(schedule, start, start + timedelta(days=14))
+
+    assert times == wake_times(windows, first_day, 14, 5)
+    assert sum(1 for wake_time in times if wake_time.hour in (22, 23, 0, 1, 2)) == 2 * 5
+
+def test_low_battery_and_gap():
+    """Test the limit per day and that wakes closer than the on time are merged."""
+
+    windows = [CaptureWindow(8*60, 9*60, 2)]
+    times = wake_times(windows, date(2026, 8, 17), 1, 5)
+    assert all(later - earlier >= timedelta(minutes=5) for earlier, later in zip(times, times[1:]))
+    assert wake_times(windows, date(2026, 8, 17), 2, 5, max_per_day=1) == [datetime(2026, 8, 17, 8, 0), datetime(2026, 8, 18, 8, 0)]
+
+    # Day without windows
+    assert wake_times([CaptureWindow(8*60, 9*60, 30, weekdays=[0])], date(2026, 8, 18), 1, 5) == [datetime(2026, 8, 18, 12, 0)]
+
+def test_format_duration():
+    """Test the formatting of durations in the Witty Pi schedule."""
+
+    assert format_duration(26) == "M26"
+    assert format_duration(60) == "H1"
+    assert format_duration(1505) == "D1 H1 M5"
@@ -101,3 +101,28 @@ def test_save_to_file():
     os.remove(temp_filename)
 
     assert saved_settings == settings.settings
+
+def test_load_validated_snapshot():
+    """Test loading settings saved after validation without validating them again"""
+    settings = Settings()
+    settings.set('cameraName', 'Snapshot')
+
+    temp_filename = tempfile.mktemp(".yaml")
+    settings.save_to_file(temp_filename)
+
+    snapshot = Settings(temp_filename, validate=False)
+    assert snapshot.get('cameraName') == 'Snapshot'
+    assert snapshot.is_valid()
+
+    # Snapshots missing settings (e.g. saved by an older firmware) are validated anyway
+    with open(temp_filename, 'r', encoding='utf-8') as file:
+        settings_dict = safe_load(file)
+    del settings_dict['shutdown']
+    with open(temp_filename, 'w', encoding='utf-8') as file:
+        dump(settings_dict, file)
+
+    snapshot = Settings(temp_filename, validate=False)
+    os.remove(temp_filename)
+
+    assert snapshot.get('shutdown') is True
+    assert not snapshot.is_valid()
@@ -0,0 +1,294 @@
+from datetime import datetime, timezone
+from time import monotonic
+import sim7600x
+from sim7600x import SIM7600X
+
+def test_parse_signal_quality():
+    """Test parsing the signal quality from a CSQ response."""
+
+    assert SIM7600X.parse_signal_quality("AT+CSQ\r\n+CSQ: 23,99\r\n\r\nOK\r\n") == 23
+    assert SIM7600X.parse_signal_quality("AT+CSQ\r\n+CSQ: 5,0\r\n\r\nOK\r\n") == 5
+    assert SIM7600X.parse_signal_quality("ERROR\r\n") == 99
+
+def test_parse_registration_status():
+    """Test parsing the best registration status of CREG and CEREG responses."""
+
+    assert SIM7600X.parse_registration_status("+CREG: 0,2\r\n+CEREG: 0,1\r\nOK\r\n") == 1
+    assert SIM7600X.parse_registration_status("+CREG: 0,0\r\n+CEREG: 0,5\r\nOK\r\n") == 5
+    assert SIM7600X.parse_registration_status("+CREG: 0,2\r\n+CEREG: 0,0\r\nOK\r\n") == 2
+    assert SIM7600X.parse_registration_status("+CREG: 0,3\r\nOK\r\n") == 3
+    assert SIM7600X.parse_registration_status("OK\r\n") == -1
+
+def test_parse_pdp_context_active():
+    """Test checking if a PDP context is active."""
+
+    assert SIM7600X.parse_pdp_context_active("+CGACT: 1,1\r\n+CGACT: 2,0\r\nOK\r\n")
+    assert not SIM7600X.parse_pdp_context_active("+CGACT: 1,0\r\nOK\r\n")
+
+class FakeSerial:
+    """Serial port of a modem which answers with a list of chunks, one chunk per poll."""
+
+    responses = {}
+
+    def __init__(self, port: str, baudrate: int, timeout: int = 5, write_timeout: int = 5) -> None:
+        self.chunks = []
+        self.written = []
+
+    def flushInput(self) -> None:
+        self.chunks = []
+
+    def write(self, data: bytes) -> None:
+        command = data.decode().strip()
+        self.written.append(command)
+        self.chunks = list(self.responses.get(command, []))
+
+    def inWaiting(self) -> int:
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size: int) -> bytes:
+        chunk = self.chunks.pop(0)
+        assert len(chunk) == size
+        return chunk
+
+def test_send_at_command_returns_on_final_result(monkeypatch):
+    """Test that a command returns as soon as the modem answered, even if the answer arrives in parts."""
+
+    monkeypatch.setattr(sim7600x.serial, "Serial", FakeSerial)
+    FakeSerial.responses = {
+        "AT+CSQ": [b"AT+CSQ\r\r\n+CSQ: ", b"23,99\r\n", b"\r\nOK\r\n"],
+        "AT+CGPS=1,1": [b"AT+CGPS=1,1\r\r\n+CME ERROR: 903\r\n"],
+        "AT+CNTP": [b"AT+CNTP\r\r\nOK\r\n", b"\r\n+CNTP: 0\r\n"],
+    }
+
+    modem = SIM7600X()
+
+    start = monotonic()
+    assert SIM7600X.parse_signal_quality(modem.send_at_command("AT+CSQ")) == 23
+    assert modem.send_at_command("AT+CGPS=1,1") == ""
+    assert "+CNTP: 0" in modem.send_at_command("AT+CNTP", back="+CNTP:")
+    assert monotonic() - start < 0.5
+
+    # No answer at all
+    start = monotonic()
+    assert modem.send_at_command("AT+UNKNOWN", timeout=0.2) == ""
+    assert monotonic() - start >= 0.2
+
+def test_parse_gps_position():
+    """Test parsing of the GPS position including the height."""
+
+    response = "\r\n+CGPSINFO: 4632.190187,N,00749.524780,E,170826,101512.0,2911.3,0.0,\r\n\r\nOK\r\n"
+    assert SIM7600X.parse_gps_position(response) == ("46.5365", "7.82541", "2911.3")
+    assert SIM7600X.parse_gps_position(response.replace(",N,", ",S,").replace(",E,", ",W,")) == ("-46.5365", "-7.82541", "2911.3")
+    assert SIM7600X.parse_gps_position("\r\n+CGPSINFO: ,,,,,,,,\r\n\r\nOK\r\n") is None
+    assert SIM7600X.parse_gps_position("") is None
+
+class FakeGpsSerial(FakeSerial):
+    """Modem which has a GPS fix after a few polls."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.polls = 0
+
+    def write(self, data: bytes) -> None:
+        super().write(data)
+        if data.decode().strip() == "AT+CGPSINFO":
+            self.polls += 1
+            position = "4632.190187,N,00749.524780,E,170826,101512.0,2911.3,0.0," if self.polls >= 3 else ",,,,,,,,"
+            self.chunks = [f"\r\n+CGPSINFO: {position}\r\n\r\nOK\r\n".encode()]
+
+def test_modem_service(monkeypatch):
+    """Test that the background service sends commands, dispatches URCs and polls the GPS position."""
+
+    monkeypatch.setattr(sim7600x.serial, "Serial", FakeGpsSerial)
+    FakeSerial.responses = {"AT+CSQ": [b"\r\n+CSQ: 23,99\r\n\r\nOK\r\n"]}
+
+    modem = SIM7600X()
+    modem.start_service()
+    urcs = []
+    modem.service.on_urc("+CPIN:", urcs.append)
+
+    try:
+        # URC which arrives while no command is running
+        modem.ser.chunks = [b"\r\n+CPIN: RE", b"ADY\r\n"]
+        assert SIM7600X.parse_signal_quality(modem.send_at_command("AT+CSQ")) == 23
+        assert urcs == ["+CPIN: READY"]
+
+        modem.service.start_gps_polling(interval=0.01)
+        assert modem.wait_for_gps_fix(timeout=2) == ("46.5365", "7.82541", "2911.3")
+        assert modem.service.gps_polls == 3
+        assert modem.get_gps_position() == ("46.5365", "7.82541", "2911.3")
+    finally:
+        modem.stop_service()
+
+    assert not modem.service.thread.is_alive()
+
+def test_urcs_are_removed_from_response(monkeypatch):
+    """Test that URCs which arrive during a command are dispatched and not returned as part of its response."""
+
+    monkeypatch.setattr(sim7600x.serial, "Serial", FakeSerial)
+    FakeSerial.responses = {"AT+CREG?": [b"\r\n+CPIN: READY\r\n+CREG: 0,1\r\n\r\nOK\r\n"]}
+
+    modem = SIM7600X()
+    modem.start_service()
+    urcs = []
+    modem.service.on_urc("+CPIN:", urcs.append)
+    modem.service.on_urc("+CREG:", urcs.append)
+
+    try:
+        response = modem.send_at_command("AT+CREG?")
+    finally:
+        modem.stop_service()
+
+    assert urcs == ["+CPIN: READY"]
+    assert "+CPIN:" not in response
+    assert SIM7600X.parse_registration_status(response) == 1
+
+def test_parse_cell_id_and_hdop():
+    """Test parsing of the serving cell and the HDOP."""
+
+    assert SIM7600X.parse_cell_id("\r\n+CPSI: LTE,Online,228-01,0x1A2B,27447297,123,EUTRAN-BAND3,1300,5,5,-94,-850,-580,15\r\n\r\nOK\r\n") == "228-01:0x1A2B:27447297"
+    assert SIM7600X.parse_cell_id("\r\n+CPSI: NO SERVICE,Online\r\n\r\nOK\r\n") is None
+    assert SIM7600X.parse_hdop("\r\n+CGNSSINFO: 2,09,05,00,4632.190187,N,00749.524780,E,170826,101512.0,2911.3,0.0,,1.4,1.1,0.9\r\n\r\nOK\r\n") == 1.1
+    assert SIM7600X.parse_hdop("\r\n+CGNSSINFO: ,,,,,,,,,,,,,,,\r\n\r\nOK\r\n") is None
+
+def test_gnss_assistance(monkeypatch):
+    """Test the hot start fallback, the XTRA download and the time to first fix."""
+
+    monkeypatch.setattr(sim7600x.serial, "Serial", FakeSerial)
+    FakeSerial.responses = {
+        "AT+CGPSHOT": [b"\r\nERROR\r\n"], # GPS already running or not supported
+        "AT+CGPS=1,1": [b"\r\nOK\r\n"],
+        "AT+CGPSXE?": [b"\r\n+CGPSXE: 1\r\n\r\nOK\r\n"],
+        "AT+CGPSXD=0": [b"\r\nOK\r\n", b"\r\n+CGPSXD: 0\r\n"],
+        "AT+CGPSINFO": [b"\r\n+CGPSINFO: 4632.190187,N,00749.524780,E,170826,101512.0,2911.3,0.0,\r\n\r\nOK\r\n"],
+    }
+
+    modem = SIM7600X()
+    modem.start_gps_session(hot_start=True)
+    assert modem.ser.written[-2:] == ["AT+CGPSHOT", "AT+CGPS=1,1"]
+    assert modem.get_gps_ttff() is None
+
+    assert modem.get_gps_position(max_attempts=1) == ("46.5365", "7.82541", "2911.3")
+    assert 0 <= modem.get_gps_ttff() < 0.5
+
+    assert modem.enable_gnss_assistance()
+    assert modem.download_xtra(timeout=0.5)
+
+    FakeSerial.responses["AT+CGPSXD=0"] = [b"\r\nOK\r\n", b"\r\n+CGPSXD: 3\r\n"]
+    assert not modem.download_xtra(timeout=0.5)
+
+def test_parse_modem_status():
+    """Test parsing of the concatenated modem status response."""
+
+    response = ("\r\n+CSQ: 20,99\r\n\r\n+CREG: 0,1\r\n\r\n+CEREG: 0,1\r\n\r\n+COPS: 0,0,\"Swisscom\",7\r\n"
+                "\r\n+CPSI: LTE,Online,228-01,0x1A2B,27447297,123,EUTRAN-BAND3,1300,5,5,-94,-850,-580,15\r\n"
+                "\r\n+CCLK: \"26/08/17,12:15:12+08\"\r\n\r\nOK\r\n")
+
+    status = SIM7600X.parse_modem_status(response)
+    assert status.csq == 20
+    assert status.rssi == -73
+    assert status.registration_status == 1
+    assert status.operator == "Swisscom"
+    assert status.access_technology == "LTE"
+    assert status.cell_id == "228-01:0x1A2B:27447297"
+    assert (status.rsrq, status.rsrp, status.sinr) == (-9.4, -85.0, 15.0)
+    assert status.clock == "2026-08-17T10:15:12+00:00"
+
+    # Not registered
+    status = SIM7600X.parse_modem_status("\r\n+CSQ: 99,99\r\n\r\n+COPS: 0\r\n\r\n+CPSI: NO SERVICE,Online\r\n\r\nOK\r\n")
+    assert status.rssi is None
+    assert status.operator is None
+    assert status.access_technology is None
+    assert status.clock is None
+
+class FakeNtpSerial(FakeSerial):
+    """Modem whose clock is only set after AT+CNTP."""
+
+    synchronized = False
+
+    def write(self, data: bytes) -> None:
+        super().write(data)
+        command = data.decode().strip()
+        if command == "AT+CNTP":
+            FakeNtpSerial.synchronized = True
+            self.chunks = [b"\r\nOK\r\n", b"\r\n+CNTP: 0\r\n"]
+        elif command == "AT+CCLK?":
+            clock = b"26/08/17,12:15:12+08" if FakeNtpSerial.synchronized else b"80/01/06,00:01:02+00"
+            self.chunks = [b"\r\n+CCLK: \"" + clock + b"\"\r\n\r\nOK\r\n"]
+
+def test_get_utc_time(monkeypatch):
+    """Test that the modem clock is synchronized with NTP if needed and cross-checked with GPS time."""
+
+    monkeypatch.setattr(sim7600x.serial, "Serial", FakeNtpSerial)
+    FakeNtpSerial.synchronized = False
+    FakeSerial.responses = {
+        'AT+CNTP="pool.ntp.org",0': [b"\r\nOK\r\n"],
+        "AT+CGPSINFO": [b"\r\n+CGPSINFO: 4632.190187,N,00749.524780,E,170826,101542.0,2911.3,0.0,\r\n\r\nOK\r\n"],
+    }
+
+    modem = SIM7600X()
+    assert modem.get_network_time(use_ntp=False) is None
+    assert modem.get_utc_time() == datetime(2026, 8, 17, 10, 15, 12, tzinfo=timezone.utc)
+    assert "AT+CNTP" in modem.ser.written
+
+    # GPS time is used if it differs by more than MAX_TIME_DIFFERENCE
+    assert modem.get_utc_time(use_gps=True) == datetime(2026, 8, 17, 10, 15, 42, tzinfo=timezone.utc)
+
+    FakeSerial.responses["AT+CGPSINFO"] = [b"\r\n+CGPSINFO: 4632.190187,N,00749.524780,E,170826,101517.0,2911.3,0.0,\r\n\r\nOK\r\n"]
+    assert modem.get_utc_time(use_gps=True) == datetime(2026, 8, 17, 10, 15, 12, tzinfo=timezone.utc)
+    assert SIM7600X.parse_gps_time("\r\n+CGPSINFO: ,,,,,,,,\r\n\r\nOK\r\n") is None
+
+def test_modem_service_not_started_without_port(monkeypatch):
+    """Test that the service is not started if the serial port could not be opened and commands do not hang."""
+
+    def fail(*args, **kwargs):
+        raise OSError("No such device")
+
+    monkeypatch.setattr(sim7600x.serial, "Serial", fail)
+    modem = SIM7600X()
+    modem.start_service()
+    assert modem.ser is None
+    assert modem.service is None
+
+    # Commands queued after the service stopped are answered immediately
+    monkeypatch.setattr(sim7600x.serial, "Serial", FakeSerial)
+    modem = SIM7600X()
+    modem.start_service()
+    modem.stop_service()
+    assert modem.service.submit("AT+CSQ").result(timeout=1) == ""
+
+def test_gps_polling_stops_with_session(monkeypatch):
+    """Test that the position is no longer polled after the GPS session was stopped."""
+
+    monkeypatch.setattr(sim7600x.serial, "Serial", FakeSerial)
+    FakeSerial.responses = {"AT+CGPSINFO": [b"\r\n+CGPSINFO: ,,,,,,,,\r\n\r\nOK\r\n"], "AT+CGPS=0": [b"\r\nOK\r\n"]}
+
+    modem = SIM7600X()
+    modem.start_service()
+    try:
+        modem.service.start_gps_polling(interval=0.01)
+        modem.stop_gps_session()
+        modem.service.gps_thread.join(timeout=1)
+        assert not modem.service.gps_thread.is_alive()
+        assert not modem.service.gps_fix.done()
+    finally:
+        modem.stop_service()
+
+def test_partial_response_of_concatenated_commands(monkeypatch):
+    """Test that the results before a failing sub-command are parsed instead of discarding the whole response."""
+
+    monkeypatch.setattr(sim7600x.serial, "Serial", FakeSerial)
+    FakeSerial.responses = {
+        "AT+CSQ;+CREG?;+CEREG?;+COPS?;+CPSI?;+CCLK?": [b"\r\n+CSQ: 20,99\r\n\r\n+CREG: 0,2\r\n\r\n+CEREG: 0,2\r\n\r\n+CME ERROR: 14\r\n"],
+        "AT+CSQ;+CREG?;+CEREG?;+CGACT?": [b"\r\n+CSQ: 20,99\r\n\r\n+CREG: 0,2\r\n\r\n+CEREG: 0,2\r\n\r\n+CME ERROR: 14\r\n"],
+    }
+
+    modem = SIM7600X()
+    status = modem.get_modem_status()
+    assert status.csq == 20
+    assert status.registration_status == 2
+    assert status.operator is None
+    assert modem.get_network_state() == SIM7600X.NETWORK_SEARCHING
+
+    FakeSerial.responses["AT+CSQ;+CREG?;+CEREG?;+CGACT?"] = [b"\r\n+CSQ: 99,99\r\n\r\n+CREG: 0,0\r\n\r\n+CEREG: 0,0\r\n\r\n+CME ERROR: 10\r\n"]
+    assert modem.get_network_state() == SIM7600X.NETWORK_NONE
@@ -0,0 +1,63 @@
+from datetime import date, datetime, timedelta
+import re
+import tempfile
+import solar
+
+def test_sunrise_sunset():
+    """Test the sunrise and sunset times against published times for Zurich (UTC, within a few minutes)."""
+
+    table = solar.compute_table(47.37, 8.54)
+
+    sunrise, sunset = solar.day_window(table, date(2026, 6, 21))
+    assert abs(sunrise - (3*60 + 29)) <= 5
+    assert abs(sunset - (19*60 + 26)) <= 5
+
+    sunrise, sunset = solar.day_window(table, date(2026, 12, 21))
+    assert abs(sunrise - (7*60 + 12)) <= 5
+    assert abs(sunset - (15*60 + 37)) <= 5
+
+    civil_dawn, civil_dusk = solar.day_window(table, date(2026, 12, 21), civil_twilight=True)
+    assert civil_dawn < sunrise - 30 and civil_dusk > sunset + 30
+
+    # Polar night on Svalbard
+    assert solar.day_window(solar.compute_table(78.2, 15.6), date(2026, 12, 21)) is None
+
+def test_load_table_is_cached():
+    """Test that the table is saved and loaded again."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        table = solar.load_table(47.37, 8.54, directory)
+        cached_table = solar.load_table(47.37, 8.54, directory)
+        assert (table["sun_rise"] == cached_table["sun_rise"]).all()
+
+def schedule_minutes(schedule: str) -> int:
+    """Sum up the ON and OFF durations of a schedule in minutes."""
+    total = 0
+    for line in schedule.splitlines()[2:]:
+        for unit, value in re.findall(r"([DHM])(\d+)", line.split("\t")[1]):
+            total += int(value) * {"D": 1440, "H": 60, "M": 1}[unit]
+    return total
+
+def test_generate_solar_schedule():
+    """Test that the schedule covers the block of days and only changes once per block."""
+
+    table = solar.compute_table(47.37, 8.54)
+    schedule = solar.generate_solar_schedule(table, date(2026, 6, 21), 7, 30, 4)
+
+    assert schedule.startswith("BEGIN\t")
+    assert schedule_minutes(schedule) == 7 * 1440
+
+    # Same block
+    first_day = date.fromordinal(date(2026, 6, 21).toordinal() // 7 * 7)
+    assert solar.generate_solar_schedule(table, first_day + timedelta(days=6), 7, 30, 4) == schedule
+    assert solar.generate_solar_schedule(table, first_day + timedelta(days=7), 7, 30, 4) != schedule
+
+    # Wake times are aligned to the interval and lie between sunrise and sunset
+    times = solar.wake_times(table, date(2026, 6, 21), 1, 30)
+    sunrise, sunset = solar.day_window(table, date(2026, 6, 21))
+    assert all(wake_time.minute % 30 == 0 for wake_time in times)
+    assert times[0] <= datetime(2026, 6, 21) + timedelta(minutes=sunrise) < times[0] + timedelta(minutes=30)
+    assert times[-1] <= datetime(2026, 6, 21) + timedelta(minutes=sunset) < times[-1] + timedelta(minutes=30)
+
+    # Low battery
+    assert len(solar.wake_times(table, date(2026, 6, 21), 7, 30, max_repetitions=1)) == 7
@@ -0,0 +1,87 @@
+from os import path, utime
+import tempfile
+from spool import UploadSpool
+
+def create_image(directory: str, filename: str, size: int, mtime: float) -> None:
+    """Create a dummy image file with a given size and modification time."""
+    with open(path.join(directory, filename), "wb") as file:
+        file.write(b"\xff" * size)
+    utime(path.join(directory, filename), (mtime, mtime))
+
+def test_next_batch_newest_first_within_budget():
+    """Test that the newest files are uploaded first and the byte budget is respected."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_image(directory, "old.jpg", 100, 1000)
+        create_image(directory, "middle.jpg", 100, 2000)
+        create_image(directory, "new.jpg", 100, 3000)
+
+        spool = UploadSpool(directory)
+        assert spool.scan() == 3
+        assert spool.scan() == 0
+
+        assert spool.next_batch(250) == [("new.jpg", 100), ("middle.jpg", 100)]
+        assert spool.next_batch(10) == [("new.jpg", 100)] # Newest file is always included
+        assert spool.pending() == (3, 300)
+
+def test_file_is_only_deleted_after_confirmed_upload():
+    """Test that failed uploads stay in the spool and successful ones are deleted."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_image(directory, "image.jpg", 100, 1000)
+
+        spool = UploadSpool(directory)
+        spool.add("image.jpg")
+
+        spool.mark_in_flight("image.jpg")
+        spool.mark_failed("image.jpg")
+        assert path.exists(path.join(directory, "image.jpg"))
+        assert spool.get_attempts("image.jpg") == 1
+        assert spool.next_batch(1000) == [("image.jpg", 100)]
+
+        spool.mark_in_flight("image.jpg")
+        spool.mark_done("image.jpg")
+        assert not path.exists(path.join(directory, "image.jpg"))
+        assert spool.get_attempts("image.jpg") == 2
+        assert spool.next_batch(1000) == []
+        assert spool.pending() == (0, 0)
+
+def test_interrupted_upload_is_retried():
+    """Test that files which were in flight during a power cut are pending again after a restart."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_image(directory, "image.jpg", 100, 1000)
+
+        spool = UploadSpool(directory)
+        spool.add("image.jpg")
+        spool.mark_in_flight("image.jpg")
+        assert spool.next_batch(1000) == []
+
+        spool = UploadSpool(directory)
+        assert spool.next_batch(1000) == [("image.jpg", 100)]
+
+def test_add_bytes_writes_file_and_queues_it():
+    """Test that an image captured to memory is written to the spool and queued for upload."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        spool = UploadSpool(directory)
+        spool.add_bytes("image.jpg", b"\xff" * 100)
+
+        assert not path.exists(path.join(directory, "image.jpg.part"))
+        with open(path.join(directory, "image.jpg"), "rb") as file:
+            assert file.read() == b"\xff" * 100
+        assert spool.next_batch(1000) == [("image.jpg", 100)]
+        assert spool.scan() == 0
+
+def test_open_recreates_corrupt_manifest():
+    """Test that a corrupt manifest is moved aside and the files are added again."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_image(directory, "image.jpg", 100, 1000)
+        with open(path.join(directory, "spool.db"), "wb") as file:
+            file.write(b"not a database" * 100)
+
+        spool = UploadSpool.open(directory)
+        assert spool is not None
+        assert path.exists(path.join(directory, "spool.db.corrupt"))
+        assert spool.scan() == 1
@@ -1,5 +1,7 @@
-from datetime import datetime
-from os import remove
+from datetime import datetime, timedelta, timezone
+from os import remove, path
+import tempfile
+from persistent_state import PersistentState
 from witty_pi_4 import WittyPi4
 
 def test_round_time_to_nearest_interval():
@@ -119,3 +121,106 @@ def test_generate_invalid_schedule():
 
     # Delete schedule file
     remove(witty_pi.SCHEDULE_FILE_PATH)
+
+def test_sync_time(monkeypatch):
+    """Test that the clock is only set if it drifted more than the threshold."""
+
+    witty_pi = WittyPi4()
+    commands = []
+    rtc_timestamp = 1786961712 # 2026-08-17 10:15:12 UTC
+
+    def run_command(command: str) -> str:
+        commands.append(command)
+        return str(rtc_timestamp) if command == "get_rtc_timestamp" else ""
+
+    monkeypatch.setattr(witty_pi, "run_command", run_command)
+    utc_time = datetime(2026, 8, 17, 10, 15, 12, tzinfo=timezone.utc)
+
+    assert witty_pi.sync_time(utc_time, max_drift_seconds=2.0) == 0.0
+    assert commands == ["get_rtc_timestamp"]
+
+    rtc_timestamp -= 30
+    assert witty_pi.sync_time(utc_time, max_drift_seconds=2.0) == -30.0
+    assert commands[-1] == f"sudo date -u -s @{int(utc_time.timestamp())} && system_to_rtc"
+
+    # Setting the clock failed
+    monkeypatch.setattr(witty_pi, "run_command", lambda command: str(rtc_timestamp) if command == "get_rtc_timestamp" else "ERROR")
+    assert witty_pi.sync_time(utc_time, max_drift_seconds=2.0) is None
+
+def test_cached_thresholds(monkeypatch):
+    """Test that unchanged thresholds are neither read nor written between verifications."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        state = PersistentState(path.join(directory, "wittypi_state.yaml"))
+        commands = []
+        board = {"low_voltage_threshold": "disabled"}
+
+        def run_command(self, command: str) -> str:
+            commands.append(command)
+            if command.startswith("set_low_voltage_threshold"):
+                board["low_voltage_threshold"] = f"{int(command.split()[1]) / 10}V"
+                return ""
+            return board.get(command[4:], "ERROR")
+
+        monkeypatch.setattr(WittyPi4, "run_command", run_command)
+
+        # First wake cycle verifies the board
+        witty_pi = WittyPi4(use_i2c=False, state=state, verify_every_wakes=3)
+        witty_pi.set_low_voltage_threshold(11.5)
+        assert commands == ["get_low_voltage_threshold", "set_low_voltage_threshold 115"]
+
+        # Next wake cycles use the cache
+        for _ in range(2):
+            commands.clear()
+            witty_pi = WittyPi4(use_i2c=False, state=state, verify_every_wakes=3)
+            assert witty_pi.set_low_voltage_threshold(11.5) == 11.5
+            assert commands == []
+
+        # Changed threshold is written
+        witty_pi.set_low_voltage_threshold(11.0)
+        assert commands == ["get_low_voltage_threshold", "set_low_voltage_threshold 110"]
+
+        # Board is verified again
+        commands.clear()
+        witty_pi = WittyPi4(use_i2c=False, state=state, verify_every_wakes=3)
+        witty_pi.set_low_voltage_threshold(11.0)
+        assert commands == ["get_low_voltage_threshold"]
+
+def test_parse_alarm_time():
+    """Test that only alarms which are still ahead are valid."""
+
+    now = datetime(2026, 8, 17, 10, 0)
+    assert WittyPi4.parse_alarm_time("17 10:30:00", now) == datetime(2026, 8, 17, 10, 30)
+    assert WittyPi4.parse_alarm_time("18 08:00:00", now) is not None
+    assert WittyPi4.parse_alarm_time("17 09:56:00", now) is None # Alarm of this wake cycle
+    assert WittyPi4.parse_alarm_time("00 00:00:00", now) is None
+    assert WittyPi4.parse_alarm_time("", now) is None
+
+    # Next month
+    assert WittyPi4.parse_alarm_time("01 08:00:00", datetime(2026, 12, 31, 20, 0)) == datetime(2027, 1, 1, 8, 0)
+
+def test_apply_schedule_skipped_if_alarms_valid(monkeypatch):
+    """Test that runScript.sh is only run if the schedule changed or the alarms are not valid."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        witty_pi = WittyPi4(use_i2c=False, state=PersistentState(path.join(directory, "wittypi_state.yaml")))
+        witty_pi.SCHEDULE_FILE_PATH = path.join(directory, "schedule.wpi")
+        now = datetime.now()
+        alarms = {"get_startup_time": (now + timedelta(minutes=26)).strftime("%d %H:%M:%S"),
+                  "get_shutdown_time": (now + timedelta(minutes=4)).strftime("%d %H:%M:%S")}
+        monkeypatch.setattr(witty_pi, "run_command", lambda command: alarms.get(command, "ERROR"))
+
+        assert witty_pi.generate_schedule(8, 0, 30, 8)
+        assert not witty_pi.generate_schedule(8, 0, 30, 8)
+
+        # Schedule was never applied by the camera
+        assert witty_pi.schedule_is_applied() is None
+
+        witty_pi.set_cached("schedule_hash", witty_pi.get_schedule_hash())
+        next_startup_time = witty_pi.apply_schedule(schedule_changed=False)
+        assert next_startup_time == (now + timedelta(minutes=26)).strftime("%Y-%m-%d %H:%M:%S")
+        assert witty_pi.apply_schedule_attempts == 0
+
+        # Stale alarm
+        alarms["get_startup_time"] = (now - timedelta(minutes=4)).strftime("%d %H:%M:%S")
+        assert witty_pi.schedule_is_applied() is None
@@ -0,0 +1,84 @@
+from witty_pi_i2c import WittyPiI2C
+from witty_pi_4 import WittyPi4
+
+class FakeSMBus:
+    """Witty Pi 4 on a fake I2C bus, registers are read in blocks."""
+
+    def __init__(self, registers: dict) -> None:
+        self.registers = bytearray(256)
+        for register, value in registers.items():
+            self.registers[register] = value
+        self.reads = 0
+
+    def read_i2c_block_data(self, address: int, register: int, length: int) -> list:
+        assert address == WittyPiI2C.ADDRESS
+        assert length <= 32
+        self.reads += 1
+        return list(self.registers[register:register + length])
+
+    def close(self) -> None:
+        pass
+
+REGISTERS = {
+    WittyPiI2C.REGISTER_FIRMWARE_ID: 0x26,
+    WittyPiI2C.REGISTER_VOLTAGE_IN_I: 12,
+    WittyPiI2C.REGISTER_VOLTAGE_IN_D: 34,
+    WittyPiI2C.REGISTER_VOLTAGE_OUT_I: 5,
+    WittyPiI2C.REGISTER_VOLTAGE_OUT_D: 2,
+    WittyPiI2C.REGISTER_CURRENT_OUT_I: 0,
+    WittyPiI2C.REGISTER_CURRENT_OUT_D: 45,
+    WittyPiI2C.REGISTER_POWER_MODE: 1,
+    WittyPiI2C.REGISTER_LOW_VOLTAGE: 115,
+    WittyPiI2C.REGISTER_RECOVERY_VOLTAGE: 255,
+    WittyPiI2C.REGISTER_TEMPERATURE: 0x17, # 23.5 °C
+    WittyPiI2C.REGISTER_TEMPERATURE + 1: 0x80,
+}
+
+def test_read_snapshot():
+    """Test that all readings are decoded from the bulk read."""
+
+    bus = FakeSMBus(REGISTERS)
+    snapshot = WittyPiI2C(bus).read_snapshot()
+
+    assert bus.reads == 2
+    assert snapshot.firmware_id == 0x26
+    assert snapshot.input_voltage == 12.34
+    assert snapshot.output_voltage == 5.02
+    assert snapshot.output_current == 0.45
+    assert snapshot.power_mode == 1
+    assert snapshot.low_voltage_threshold == 11.5
+    assert snapshot.recovery_voltage_threshold == 0.0
+    assert snapshot.temperature == 23.5
+
+def test_decode_negative_temperature():
+    """Test the two's complement temperature of the LM75B."""
+
+    assert WittyPiI2C.decode_temperature(0xFF, 0xE0) == -0.125
+    assert WittyPiI2C.decode_temperature(0xE7, 0x00) == -25.0
+
+def test_witty_pi_uses_i2c():
+    """Test that the readings of the Witty Pi 4 are taken over I2C if available."""
+
+    witty_pi = WittyPi4(use_i2c=False)
+    witty_pi.i2c = WittyPiI2C(FakeSMBus(REGISTERS))
+    witty_pi.run_command = None # Shell must not be used
+
+    assert witty_pi.get_temperature() == 23.5
+    assert witty_pi.get_battery_voltage() == 12.34
+    assert witty_pi.get_low_voltage_threshold() == 11.5
+    assert witty_pi.get_snapshot().output_voltage == 5.02
+
+def test_snapshot_without_i2c_reads_only_requested_fields():
+    """Test that without I2C only the requested readings are read with utilities.sh."""
+
+    commands = []
+    outputs = {"get_temperature": "23.5°C / 74.3°F", "get_output_voltage": "5.02"}
+
+    witty_pi = WittyPi4(use_i2c=False)
+    witty_pi.run_command = lambda command: (commands.append(command), outputs[command])[1]
+
+    snapshot = witty_pi.get_snapshot(fields=("temperature", "output_voltage"))
+    assert sorted(commands) == ["get_output_voltage", "get_temperature"]
+    assert snapshot.temperature == 23.5
+    assert snapshot.output_voltage == 5.02
+    assert snapshot.input_voltage == 0.0
@@ -0,0 +1,99 @@
+from os import path
+import tempfile
+from threading import Thread
+from time import monotonic
+from witty_pi_4 import WittyPi4
+
+FAKE_UTILITIES = """
+get_temperature() {
+  echo "23.5°C / 74.3°F"
+}
+
+get_pid() {
+  echo $$
+}
+
+get_without_newline() {
+  printf "4.98"
+}
+
+fail() {
+  echo "I2C error"
+  return 1
+}
+
+hang() {
+  sleep 5
+}
+"""
+
+def create_witty_pi(directory: str) -> WittyPi4:
+    """Create a Witty Pi 4 interface which uses a fake utilities.sh."""
+    with open(path.join(directory, "utilities.sh"), "w", encoding="utf-8") as file:
+        file.write(FAKE_UTILITIES)
+
+    witty_pi = WittyPi4()
+    witty_pi.WITTYPI_DIRECTORY = directory
+    return witty_pi
+
+def test_session_is_reused():
+    """Test that all commands run in the same bash process."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        witty_pi = create_witty_pi(directory)
+
+        try:
+            assert witty_pi.get_temperature() == 23.5
+            assert witty_pi.run_command("get_without_newline") == "4.98"
+            assert witty_pi.run_command("fail") == "ERROR"
+
+            pid = witty_pi.run_command("get_pid")
+            assert witty_pi.run_command("get_pid") == pid
+            assert witty_pi.run_command_once("get_pid") != pid
+        finally:
+            witty_pi.close()
+
+def test_concurrent_commands_share_one_session():
+    """Test that stages calling the Witty Pi at the same time do not start several sessions."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        witty_pi = create_witty_pi(directory)
+        pids = []
+
+        try:
+            threads = [Thread(target=lambda: pids.append(witty_pi.run_command("get_pid"))) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert len(pids) == 8
+            assert len(set(pids)) == 1
+        finally:
+            witty_pi.close()
+
+def test_session_restarts_after_failure():
+    """Test that the session is restarted after a timeout or if bash exited."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        witty_pi = create_witty_pi(directory)
+
+        pid = witty_pi.run_command("get_pid")
+
+        # Hanging command
+        witty_pi.COMMAND_TIMEOUT = 0.2
+        start = monotonic()
+        assert witty_pi.run_command("hang") == "ERROR"
+        assert monotonic() - start < 1
+        witty_pi.COMMAND_TIMEOUT = 3
+
+        try:
+            restarted_pid = witty_pi.run_command("get_pid")
+            assert restarted_pid not in ("ERROR", pid)
+
+            # Bash exits, the command is run in a new bash process
+            assert witty_pi.run_command("exit 1") == "ERROR"
+            assert witty_pi.run_command("get_temperature") == "23.5°C / 74.3°F"
+            assert witty_pi.run_command("get_pid") not in ("ERROR", restarted_pid)
+        finally:
+            witty_pi.close()
@@ -1,8 +1,79 @@
 '''A python module for interacting with the Witty Pi 4 board'''
-from subprocess import check_output, STDOUT
-from datetime import datetime
-from os import path
+from subprocess import check_output, Popen, PIPE, STDOUT
+from datetime import datetime, timedelta, timezone
+from os import path, read
+from select import select
+from threading import Lock
+from time import monotonic
+from uuid import uuid4
+from hashlib import sha256
 import logging
+from persistent_state import PersistentState
+from witty_pi_i2c import WittyPiI2C, WittyPiSnapshot
+
+class UtilitiesSession:
+    '''Long running bash process which sources utilities.sh once and runs Witty Pi 4 commands sent over stdin.
+    The end of each output is marked with a sentinel line containing the exit status.'''
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.process = None
+        self.lock = Lock() # Commands of concurrent stages are run one after the other
+        self.sentinel = f"__WITTYPI_DONE_{uuid4().hex}__"
+
+    def start(self) -> None:
+        '''Start bash and source utilities.sh'''
+        self.process = Popen(["/bin/bash"], cwd=self.directory, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        self.process.stdin.write(b". ./utilities.sh\n")
+        self.process.stdin.flush()
+
+    def close(self) -> None:
+        '''Stop the bash process'''
+        if self.process is not None:
+            try:
+                self.process.kill()
+                self.process.wait(timeout=1)
+            except Exception as e:
+                logging.warning("Could not stop Witty Pi 4 session: %s", str(e))
+            self.process = None
+
+    def run(self, command: str, timeout: float = 3) -> tuple:
+        '''Run a command and return (exit status, output). The session is restarted after a timeout or if bash died.'''
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+
+            try:
+                # Output of the command might not end with a newline
+                self.process.stdin.write(f"{command}\nprintf '\\n{self.sentinel} %s\\n' $?\n".encode())
+                self.process.stdin.flush()
+                return self._read_until_sentinel(timeout)
+            except Exception:
+                self.close()
+                raise
+
+    def _read_until_sentinel(self, timeout: float) -> tuple:
+        '''Read the output of the last command until the sentinel line'''
+        output = b""
+        marker = f"\n{self.sentinel} ".encode()
+        deadline = monotonic() + timeout
+
+        while True:
+            index = output.find(marker)
+            if index != -1 and output.endswith(b"\n"):
+                status = int(output[index + len(marker):].strip())
+                return status, output[:index].decode(errors='ignore')
+
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No answer within {timeout} s")
+
+            ready, _, _ = select([self.process.stdout], [], [], remaining)
+            if ready:
+                chunk = read(self.process.stdout.fileno(), 4096)
+                if not chunk:
+                    raise EOFError("Witty Pi 4 session ended")
+                output += chunk
 
 class WittyPi4:
     '''A class for interacting with the Witty Pi 4 board'''
@@ -10,33 +81,164 @@ class WittyPi4:
     WITTYPI_DIRECTORY = "/home/pi/wittypi"
     SCHEDULE_FILE_PATH = f"{WITTYPI_DIRECTORY}/schedule.wpi"
     MAX_DURATION_MINUTES = 4 # Maximum time Raspberry Pi is allowed to run
+    COMMAND_TIMEOUT = 3 # Seconds
 
-    def __init__(self):
+    def __init__(self, use_i2c: bool = True, state: PersistentState = None, verify_every_wakes: int = 24):
+        '''With a state, the applied configuration is cached between wake cycles and only verified against the board
+        every verify_every_wakes wake cycles'''
         logging.info("Initializing Witty Pi 4 interface")
+        self.apply_schedule_attempts = 0
+        self.session = None # Started with the first command
+        self.session_lock = Lock() # Concurrent stages must not start two sessions
+        self.i2c = WittyPiI2C.open() if use_i2c else None # Readings are taken with utilities.sh if not available
+        self.state = state
+        self.verify = True
+
+        if state is not None:
+            wakes_since_verify = state.get("wakes_since_verify", verify_every_wakes)
+            self.verify = wakes_since_verify + 1 >= verify_every_wakes
+            state.set("wakes_since_verify", 0 if self.verify else wakes_since_verify + 1)
+
+            if self.verify:
+                snapshot = self.read_i2c()
+                if snapshot is not None:
+                    state.set("firmware_id", snapshot.firmware_id)
+
+    def get_cached(self, key: str):
+        '''Get a cached configuration value, None if there is no state or the board has to be verified in this wake cycle'''
+        if self.state is None or self.verify:
+            return None
+
+        return self.state.get(key)
+
+    def set_cached(self, key: str, value) -> None:
+        '''Cache a configuration value which was applied to the board'''
+        if self.state is not None:
+            self.state.set(key, value)
 
     # Get WittyPi readings
     # See: https://www.baeldung.com/linux/run-function-in-script
     def run_command(self, command: str) -> str:
-        '''Run a Witty Pi 4 command'''
+        '''Run a Witty Pi 4 command in the shared utilities session'''
+        with self.session_lock:
+            if self.session is None:
+                self.session = UtilitiesSession(self.WITTYPI_DIRECTORY)
+
+        try:
+            status, output = self.session.run(command, self.COMMAND_TIMEOUT)
+            if status != 0:
+                logging.error("Witty Pi 4 command %s failed with status %s: %s", command, status, output.strip())
+                return "ERROR"
+            return output.strip()
+        except TimeoutError as e:
+            logging.error("Witty Pi 4 command %s timed out: %s", command, str(e))
+            return "ERROR"
+        except Exception as e:
+            logging.error("Could not run Witty Pi 4 command in session, spawning bash: %s", str(e))
+            return self.run_command_once(command)
+
+    def run_command_once(self, command: str) -> str:
+        '''Run a Witty Pi 4 command in a new bash process which sources utilities.sh'''
         try:
             command = f"cd {self.WITTYPI_DIRECTORY} && . ./utilities.sh && {command}"
-            output = check_output(command, shell=True, executable="/bin/bash", stderr=STDOUT, universal_newlines=True, timeout=3)
+            output = check_output(command, shell=True, executable="/bin/bash", stderr=STDOUT, universal_newlines=True, timeout=self.COMMAND_TIMEOUT)
             return output.strip()
         except Exception as e:
             logging.error("Could not run Witty Pi 4 command: %s", str(e))
             return "ERROR"
 
-    def sync_time_with_network(self) -> None:
-        '''Sync Witty Pi 4 clock with network time'''
+    def close(self) -> None:
+        '''Stop the utilities session and close the I2C bus'''
+        with self.session_lock:
+            if self.session is not None:
+                self.session.close()
+
+        if self.i2c is not None:
+            self.i2c.close()
+
+    def read_i2c(self) -> WittyPiSnapshot:
+        '''Read all registers over I2C (None if the I2C backend is not available or failed)'''
+        if self.i2c is None:
+            return None
+
+        try:
+            return self.i2c.read_snapshot()
+        except Exception as e:
+            logging.warning("Could not read Witty Pi 4 over I2C, using utilities.sh: %s", str(e))
+            return None
+
+    def get_snapshot(self, fields: tuple = None) -> WittyPiSnapshot:
+        '''Get the readings, with one bulk read over I2C if possible. Without I2C only the given fields (names of
+        WittyPiSnapshot) are read, each one costs a utilities.sh command. Other fields keep their defaults.'''
+        snapshot = self.read_i2c()
+        if snapshot is not None:
+            logging.info("Witty Pi 4 readings: %s", snapshot)
+            return snapshot
+
+        getters = {
+            "input_voltage": self.get_battery_voltage,
+            "output_voltage": self.get_internal_voltage,
+            "output_current": self.get_internal_current,
+            "low_voltage_threshold": self.get_low_voltage_threshold,
+            "recovery_voltage_threshold": self.get_recovery_voltage_threshold,
+            "temperature": self.get_temperature,
+        }
+
+        return WittyPiSnapshot(**{name: getter() for name, getter in getters.items() if fields is None or name in fields})
+
+    def sync_time_with_network(self) -> bool:
+        '''Sync Witty Pi 4 clock with network time, returns True if the clock was set'''
         # See: https://www.uugear.com/forums/technial-support-discussion/witty-pi-4-how-to-synchronise-time-with-internet-on-boot/
         try:
             output = self.run_command("net_to_system && system_to_rtc")
+            if output == "ERROR":
+                logging.error("Could not synchronize time with network.")
+                return False
+
             logging.info("Time synchronized with network: %s", output)
+            return True
         except Exception as e:
             logging.error("Could not synchronize time with network: %s", str(e))
+            return False
+
+    def get_rtc_time(self) -> datetime:
+        '''Get the time of the Witty Pi 4 real time clock in UTC (None if it could not be read)'''
+        try:
+            return datetime.fromtimestamp(int(self.run_command("get_rtc_timestamp")), tz=timezone.utc)
+        except Exception as e:
+            logging.error("Could not get RTC time: %s", str(e))
+            return None
+
+    def sync_time(self, utc_time: datetime, max_drift_seconds: float = 2.0) -> float:
+        '''Set the system clock and the Witty Pi 4 real time clock to utc_time if the RTC drifted more than
+        max_drift_seconds. Returns the drift in seconds (RTC - utc_time), None if the RTC could not be read or the
+        clock could not be set.'''
+        rtc_time = self.get_rtc_time()
+        drift = None if rtc_time is None else round((rtc_time - utc_time).total_seconds(), 1)
+
+        if drift is not None and abs(drift) <= max_drift_seconds:
+            logging.info("RTC drift %s s, not adjusting clock.", drift)
+            return drift
+
+        try:
+            output = self.run_command(f"sudo date -u -s @{int(utc_time.timestamp())} && system_to_rtc")
+            if output == "ERROR":
+                logging.error("Could not synchronize time (drift %s s).", drift)
+                return None
+
+            logging.info("Time synchronized (drift %s s): %s", drift, output)
+        except Exception as e:
+            logging.error("Could not synchronize time: %s", str(e))
+            return None
+
+        return drift
 
     def get_temperature(self) -> float:
         '''Gets the current temperature reading from the Witty Pi 4 in °C'''
+        snapshot = self.read_i2c()
+        if snapshot is not None:
+            return snapshot.temperature
+
         try:
             temperature = self.run_command("get_temperature")
             temperature = temperature.split("/", maxsplit = 1)[0] # Remove the Farenheit reading
@@ -50,6 +252,10 @@ class WittyPi4:
 
     def get_battery_voltage(self) -> float:
         '''Gets the battery voltage reading from the Witty Pi 4 in V'''
+        snapshot = self.read_i2c()
+        if snapshot is not None:
+            return snapshot.input_voltage
+
         try:
             battery_voltage = self.run_command("get_input_voltage")
             battery_voltage = float(battery_voltage) # Remove V
@@ -61,6 +267,10 @@ class WittyPi4:
 
     def get_internal_voltage(self) -> float:
         '''Gets the internal (5V) voltage from the Witty Pi 4 in V'''
+        snapshot = self.read_i2c()
+        if snapshot is not None:
+            return snapshot.output_voltage
+
         try:
             internal_voltage = self.run_command("get_output_voltage")
             internal_voltage = float(internal_voltage)
@@ -72,6 +282,10 @@ class WittyPi4:
 
     def get_internal_current(self) -> float:
         '''Gets the internal (5V) current reading from the Witty Pi 4 in A'''
+        snapshot = self.read_i2c()
+        if snapshot is not None:
+            return snapshot.output_current
+
         try:
             internal_current = self.run_command("get_output_current")
             internal_current = float(internal_current)
@@ -83,6 +297,10 @@ class WittyPi4:
 
     def get_low_voltage_threshold(self) -> float:
         '''Gets the low threshold from the Witty Pi 4'''
+        snapshot = self.read_i2c()
+        if snapshot is not None:
+            return snapshot.low_voltage_threshold
+
         try:
             low_voltage_threshold = self.run_command("get_low_voltage_threshold")
 
@@ -100,6 +318,10 @@ class WittyPi4:
 
     def get_recovery_voltage_threshold(self) -> float:
         '''Gets the recovery threshold from the Witty Pi 4'''
+        snapshot = self.read_i2c()
+        if snapshot is not None:
+            return snapshot.recovery_voltage_threshold
+
         try:
             recovery_voltage_threshold = self.run_command("get_recovery_voltage_threshold")
 
@@ -119,12 +341,19 @@ class WittyPi4:
         '''Sets the low voltage threshold from the Witty Pi 4'''
         try:
             if 2.0 <= voltage <= 25.0 or voltage == 0:
+                if voltage == self.get_cached("low_voltage_threshold"):
+                    logging.info("Low voltage threshold already set to: %s V (cached)", voltage)
+                    return voltage
+
                 if voltage != self.get_low_voltage_threshold():
                     low_voltage_threshold = self.run_command(f"set_low_voltage_threshold {int(voltage*10)}")
                     logging.info("Set low voltage threshold to: %s V", voltage)
+                    if low_voltage_threshold != "ERROR":
+                        self.set_cached("low_voltage_threshold", voltage)
                     return low_voltage_threshold
-                
+
                 logging.info("Low voltage threshold already set to: %s V", voltage)
+                self.set_cached("low_voltage_threshold", voltage)
 
             else:
                 logging.error("Voltage must be between 2.0 and 25.0 V (or 0 to disable).")
@@ -140,12 +369,19 @@ class WittyPi4:
         '''Sets the recovery voltage threshold from the Witty Pi 4'''
         try:
             if 2.0 <= voltage <= 25.0 or voltage == 0:
+                if voltage == self.get_cached("recovery_voltage_threshold"):
+                    logging.info("Recovery voltage threshold already set to: %s V (cached)", voltage)
+                    return voltage
+
                 if voltage != self.get_recovery_voltage_threshold():
                     recovery_voltage_threshold = self.run_command(f"set_recovery_voltage_threshold {int(voltage*10)}")
                     logging.info("Set recovery voltage threshold to: %s V", voltage)
+                    if recovery_voltage_threshold != "ERROR":
+                        self.set_cached("recovery_voltage_threshold", voltage)
                     return recovery_voltage_threshold
 
                 logging.info("Recovery voltage threshold already set to: %s V", voltage)
+                self.set_cached("recovery_voltage_threshold", voltage)
 
             else:
                 logging.error("Voltage must be between 2.0 and 25.0 V (or 0 to disable).")
@@ -171,8 +407,8 @@ class WittyPi4:
         
         return ((end_time - start_time).seconds // 60) // interval + 1
 
-    def generate_schedule(self, start_hour: int, start_minute: int, interval_length_minutes: int, num_repetitions_per_day: int) -> None:
-        '''Generate a startup schedule file for Witty Pi 4'''
+    def generate_schedule(self, start_hour: int, start_minute: int, interval_length_minutes: int, num_repetitions_per_day: int) -> bool:
+        '''Generate a startup schedule file for Witty Pi 4, returns if the schedule file changed'''
 
         # Basic validity check of parameters
         if not 0 < start_hour < 24:
@@ -211,25 +447,101 @@ class WittyPi4:
         if remaining_minutes > 0:
             schedule += f" M{remaining_minutes}"
 
+        return self.write_schedule(schedule)
+
+    def write_schedule(self, schedule: str) -> bool:
+        '''Write the schedule file if it changed, returns if it was written'''
         if path.exists(self.SCHEDULE_FILE_PATH):
             with open(self.SCHEDULE_FILE_PATH, "r", encoding='utf-8') as f:
                 old_schedule = f.read()
 
-                # Write new schedule file if it changed
-                if old_schedule != schedule:
-                    logging.info("Schedule changed - writing new schedule file.")
-                    with open(self.SCHEDULE_FILE_PATH, "w", encoding='utf-8') as f:
-                        f.write(schedule)
-                else:
-                    logging.info("Schedule did not change.")
+            # Write new schedule file if it changed
+            if old_schedule == schedule:
+                logging.info("Schedule did not change.")
+                return False
+
+            logging.info("Schedule changed - writing new schedule file.")
         else:
             logging.warning("Schedule file not found. Writing new schedule file.")
-            with open(self.SCHEDULE_FILE_PATH, "w", encoding='utf-8') as f:
-                f.write(schedule)
 
-    def apply_schedule(self, max_retries: int = 5) -> str:
-        '''Apply schedule to Witty Pi 4'''
+        with open(self.SCHEDULE_FILE_PATH, "w", encoding='utf-8') as f:
+            f.write(schedule)
+        return True
+
+    def clear_shutdown_time(self) -> bool:
+        '''Clear the shutdown alarm so the Raspberry Pi can stay on longer than the schedule (see apply_schedule to set it again)'''
+        output = self.run_command("clear_shutdown_time")
+        logging.info("Cleared shutdown alarm: %s", output)
+        return output != "ERROR"
+
+    def get_schedule_hash(self) -> str:
+        '''Get the SHA-256 hash of the schedule file (None if it does not exist)'''
+        try:
+            with open(self.SCHEDULE_FILE_PATH, "rb") as f:
+                return sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def parse_alarm_time(alarm: str, now: datetime) -> datetime:
+        '''Get the next time of an alarm in "dd HH:MM:SS" format as returned by get_startup_time (None if not set).
+        Alarms only contain the day of month, alarms more than a week ahead can not be told apart from past ones.'''
+        try:
+            day, clock = alarm.split()
+            hour, minute, second = (int(value) for value in clock.split(":"))
+            day = int(day)
+        except ValueError:
+            return None
+
+        if day == 0:
+            return None
+
+        # This month or next month
+        for year, month in ((now.year, now.month), (now.year + now.month // 12, now.month % 12 + 1)):
+            try:
+                alarm_time = datetime(year, month, day, hour, minute, second)
+            except ValueError:
+                continue
+
+            if now < alarm_time <= now + timedelta(days=7):
+                return alarm_time
+
+        return None
+
+    def get_next_startup_time(self, now: datetime = None) -> datetime:
+        '''Get the startup alarm programmed on the Witty Pi 4 if it is still ahead (None if it is missing or stale)'''
+        return self.parse_alarm_time(self.run_command("get_startup_time"), now or datetime.now())
+
+    def get_next_shutdown_time(self, now: datetime = None) -> datetime:
+        '''Get the shutdown alarm programmed on the Witty Pi 4 if it is still ahead (None if it is missing or stale)'''
+        return self.parse_alarm_time(self.run_command("get_shutdown_time"), now or datetime.now())
+
+    def schedule_is_applied(self) -> datetime:
+        '''Check if the schedule file was applied and the alarms set for it are still ahead.
+        The Witty Pi daemon already applies the schedule at boot. Returns the next startup time or None.'''
+        if self.state is not None and self.state.get("schedule_hash") != self.get_schedule_hash():
+            return None
+
+        next_startup_time = self.get_next_startup_time()
+        if next_startup_time is None or self.get_next_shutdown_time() is None:
+            return None
+
+        return next_startup_time
+
+    def apply_schedule(self, max_retries: int = 5, sync_time = None, schedule_changed: bool = True) -> str:
+        '''Apply schedule to Witty Pi 4. After a failed attempt, the clock is synchronized with sync_time()
+        (defaults to sync_time_with_network). If the schedule did not change and the alarms are still valid,
+        runScript.sh is skipped.'''
+        self.apply_schedule_attempts = 0
+
+        if not schedule_changed:
+            next_startup_time = self.schedule_is_applied()
+            if next_startup_time is not None:
+                logging.info("Schedule already applied, next startup at: %s", next_startup_time)
+                return next_startup_time.strftime("%Y-%m-%d %H:%M:%S")
+
         for retry in range(max_retries):
+            self.apply_schedule_attempts = retry + 1
             try:
                 # Apply new schedule
                 command = f"cd {self.WITTYPI_DIRECTORY} && sudo ./runScript.sh"
@@ -240,10 +552,14 @@ class WittyPi4:
                     logging.info("%s", output[0])
                     logging.info("%s", output[1])
                     next_startup_time = output[1][-19:]
+                    self.set_cached("schedule_hash", self.get_schedule_hash())
                     return next_startup_time
 
                 logging.warning("Failed to apply schedule: %s", output[0])
-                self.sync_time_with_network()
+                if sync_time is not None:
+                    sync_time()
+                else:
+                    self.sync_time_with_network()
 
             except Exception as e:
                 logging.error("Failed to apply schedule: %s (%s)", str(e), retry)
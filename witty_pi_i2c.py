@@ -0,0 +1,97 @@
+'''Read the Witty Pi 4 registers directly over I2C instead of through utilities.sh'''
+from dataclasses import dataclass
+import logging
+
+try:
+    from smbus2 import SMBus
+except ImportError:
+    SMBus = None
+
+@dataclass
+class WittyPiSnapshot:
+    '''Sensor readings and configuration of the Witty Pi 4'''
+    firmware_id: int = 0
+    input_voltage: float = 0.0 # V
+    output_voltage: float = 0.0 # V
+    output_current: float = 0.0 # A
+    power_mode: int = 0 # 0 = powered via USB, 1 = powered via Vin
+    low_voltage_threshold: float = 0.0 # V, 0 = disabled
+    recovery_voltage_threshold: float = 0.0 # V, 0 = disabled
+    temperature: float = -273.15 # °C
+
+class WittyPiI2C:
+    '''Witty Pi 4 on the I2C bus, register map as in utilities.sh'''
+
+    ADDRESS = 0x08
+    REGISTER_FIRMWARE_ID = 0
+    REGISTER_VOLTAGE_IN_I = 1
+    REGISTER_VOLTAGE_IN_D = 2
+    REGISTER_VOLTAGE_OUT_I = 3
+    REGISTER_VOLTAGE_OUT_D = 4
+    REGISTER_CURRENT_OUT_I = 5
+    REGISTER_CURRENT_OUT_D = 6
+    REGISTER_POWER_MODE = 7
+    REGISTER_LOW_VOLTAGE = 19
+    REGISTER_RECOVERY_VOLTAGE = 22
+    REGISTER_TEMPERATURE = 50 # LM75B, MSB and LSB
+    THRESHOLD_DISABLED = 255
+    BLOCK_LENGTH = 32 # Maximum length of an SMBus block read
+
+    def __init__(self, bus) -> None:
+        self.bus = bus
+
+    @classmethod
+    def open(cls, bus_number: int = 1):
+        '''Open the I2C bus, returns None if smbus2 is not installed or the bus is not available'''
+        if SMBus is None:
+            logging.info("smbus2 not installed, using utilities.sh for Witty Pi 4.")
+            return None
+
+        try:
+            return cls(SMBus(bus_number))
+        except Exception as e:
+            logging.warning("Could not open I2C bus %s: %s", bus_number, str(e))
+            return None
+
+    def close(self) -> None:
+        '''Close the I2C bus'''
+        self.bus.close()
+
+    def read_registers(self) -> dict:
+        '''Read the configuration and sensor registers in two block reads (register -> value)'''
+        registers = dict(enumerate(self.bus.read_i2c_block_data(self.ADDRESS, 0, self.BLOCK_LENGTH)))
+        temperature = self.bus.read_i2c_block_data(self.ADDRESS, self.REGISTER_TEMPERATURE, 2)
+        registers[self.REGISTER_TEMPERATURE] = temperature[0]
+        registers[self.REGISTER_TEMPERATURE + 1] = temperature[1]
+        return registers
+
+    @classmethod
+    def decode_threshold(cls, value: int) -> float:
+        '''Decode a voltage threshold in 1/10 V (0.0 if disabled)'''
+        return 0.0 if value == cls.THRESHOLD_DISABLED else value / 10
+
+    @staticmethod
+    def decode_temperature(msb: int, lsb: int) -> float:
+        '''Decode the 11 bit two's complement temperature of the LM75B in 1/8 °C'''
+        value = (msb << 3) | (lsb >> 5)
+        if value >= 0x400:
+            value -= 0x800
+        return value * 0.125
+
+    @classmethod
+    def decode(cls, registers: dict) -> WittyPiSnapshot:
+        '''Decode the registers into a snapshot'''
+        return WittyPiSnapshot(
+            firmware_id=registers[cls.REGISTER_FIRMWARE_ID],
+            input_voltage=round(registers[cls.REGISTER_VOLTAGE_IN_I] + registers[cls.REGISTER_VOLTAGE_IN_D] / 100, 2),
+            output_voltage=round(registers[cls.REGISTER_VOLTAGE_OUT_I] + registers[cls.REGISTER_VOLTAGE_OUT_D] / 100, 2),
+            output_current=round(registers[cls.REGISTER_CURRENT_OUT_I] + registers[cls.REGISTER_CURRENT_OUT_D] / 100, 2),
+            power_mode=registers[cls.REGISTER_POWER_MODE],
+            low_voltage_threshold=cls.decode_threshold(registers[cls.REGISTER_LOW_VOLTAGE]),
+            recovery_voltage_threshold=cls.decode_threshold(registers[cls.REGISTER_RECOVERY_VOLTAGE]),
+            temperature=cls.decode_temperature(registers[cls.REGISTER_TEMPERATURE], registers[cls.REGISTER_TEMPERATURE + 1]),
+        )
+
+    def read_snapshot(self) -> WittyPiSnapshot:
+        '''Read and decode all readings'''
+        return self.decode(self.read_registers())